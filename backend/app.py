@@ -1,26 +1,176 @@
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request, send_file, stream_with_context
 from flask_cors import CORS
 from datetime import datetime
-import tensorflow as tf
-from tensorflow.keras.applications.resnet50 import preprocess_input
+import hmac
+import json
 import numpy as np
-from PIL import Image
-import base64
-import io
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from importlib import metadata
+
+import inference_service
+import jobs
+import metrics
+import profiling
+from batching import BufferPool, MicroBatcher, parse_batch_sizes
+from fetching import ImageFetcher
+from imaging import (
+    ImageRejected, decode_image, image_digest, read_image_base64, read_image_file, read_image_path,
+    read_image_stream, read_profile_mapping
+)
+from result_cache import ResultCache
+
+# TensorFlow (and inference.py) are imported by the background loader, so the
+# server binds and answers /health immediately
+tf = None
 
 app = Flask(__name__)
 CORS(app)  # Enable CORS for all routes
 
+# Inference processes (see inference_service.py) import this module only to
+# load the model; they skip the request-side setup (decode and fetch pools,
+# job store, result cache and micro-batcher)
+serves_requests = not inference_service.is_inference_process
+
 # Load the trained model
 MODEL_PATH = os.environ.get('MODEL_PATH', '/app/model/resnet50_profilepic_no_aug.h5')
 model = None
+model_status = 'loading'  # 'loading', then 'loaded' or 'not_loaded'
+inference_fn = None  # traced forward pass wrapping model (see inference.py)
 class_names = ['human', 'avatar', 'animal']  # Order from training data
 
+# Micro-batching window for /classify: concurrent requests arriving within
+# BATCH_MAX_WAIT_MS of each other share one forward pass of up to BATCH_MAX_SIZE
+BATCH_MAX_SIZE = int(os.environ.get('BATCH_MAX_SIZE', '16'))
+BATCH_MAX_WAIT_MS = float(os.environ.get('BATCH_MAX_WAIT_MS', '5'))
+batcher = None
+
+# /classify/batch: images are decoded on a thread pool (PIL releases the GIL)
+# and run through the model BATCH_CHUNK_SIZE at a time
+BATCH_CHUNK_SIZE = int(os.environ.get('BATCH_CHUNK_SIZE', '32'))
+BATCH_MAX_ITEMS = int(os.environ.get('BATCH_MAX_ITEMS', '256'))
+# Streamed batches (?stream=1 or Accept: application/x-ndjson) are answered one
+# JSON line per image, a chunk at a time, so they may be much larger
+BATCH_STREAM_MAX_ITEMS = int(os.environ.get('BATCH_STREAM_MAX_ITEMS', '10000'))
+DECODE_WORKERS = int(os.environ.get('DECODE_WORKERS', str(os.cpu_count() or 4)))
+decode_pool = ThreadPoolExecutor(max_workers=DECODE_WORKERS, thread_name_prefix='decode') if serves_requests else None
+# Images are decoded into batch buffers from a pool and the buffers are
+# reused, keeping up to INPUT_BUFFERS_PER_SIZE idle ones per batch size class
+# (see /buffers/stats for the allocation counters)
+INPUT_BUFFERS_PER_SIZE = int(os.environ.get('INPUT_BUFFERS_PER_SIZE', '16'))
+
+# Uploads are checked from their header before decoding: bigger files or more
+# pixels than this are refused with 413, unsupported formats with 415. JPEGs
+# are decoded at reduced resolution (DCT scaling) unless JPEG_DRAFT_DECODE=0.
+MAX_IMAGE_BYTES = int(os.environ.get('MAX_IMAGE_BYTES', str(20 * 1024 * 1024)))
+MAX_IMAGE_PIXELS = int(os.environ.get('MAX_IMAGE_PIXELS', str(40_000_000)))
+JPEG_DRAFT_DECODE = os.environ.get('JPEG_DRAFT_DECODE', '1') == '1'
+
+# Images can also be sent as URLs or as paths relative to IMAGE_BASE_URL (blob
+# storage) and are then downloaded here (see fetching.py), from
+# FETCH_ALLOWED_HOSTS only (default: the IMAGE_BASE_URL host; '*' allows any)
+IMAGE_BASE_URL = os.environ.get('IMAGE_BASE_URL', '')
+FETCH_ALLOWED_HOSTS = os.environ.get('FETCH_ALLOWED_HOSTS', '')
+FETCH_MAX_CONNECTIONS_PER_HOST = int(os.environ.get('FETCH_MAX_CONNECTIONS_PER_HOST', '8'))
+FETCH_WORKERS = int(os.environ.get('FETCH_WORKERS', '32'))
+FETCH_TIMEOUT_S = float(os.environ.get('FETCH_TIMEOUT_S', '10'))
+FETCH_RETRIES = int(os.environ.get('FETCH_RETRIES', '2'))
+fetcher = ImageFetcher(
+    base_url=IMAGE_BASE_URL,
+    allowed_hosts=[host.strip() for host in FETCH_ALLOWED_HOSTS.split(',')] if FETCH_ALLOWED_HOSTS else None,
+    max_per_host=FETCH_MAX_CONNECTIONS_PER_HOST,
+    workers=FETCH_WORKERS,
+    timeout=FETCH_TIMEOUT_S,
+    retries=FETCH_RETRIES,
+    max_bytes=MAX_IMAGE_BYTES
+) if serves_requests else None
+
+# Input resolution the model is served at: images are decoded to
+# IMAGE_SIZE x IMAGE_SIZE and the model is rebuilt for it if it was built for
+# another size (a multiple of 32; compute scales with the pixel count, see
+# profile_resolution.py for the accuracy cost)
+IMAGE_SIZE = int(os.environ.get('IMAGE_SIZE', '224'))
+
+# Inference engine: 'graph' (traced tf.function) or 'xla' (XLA-compiled per
+# batch-size bucket, falling back to 'graph' if compilation fails)
+INFERENCE_ENGINE = os.environ.get('INFERENCE_ENGINE', 'graph')
+XLA_BATCH_BUCKETS = parse_batch_sizes(os.environ.get('XLA_BATCH_BUCKETS', '1,2,4,8,16,32'))
+# A MODEL_PATH ending in .tflite is served by the TFLite interpreter instead
+TFLITE_THREADS = int(os.environ.get('TFLITE_THREADS', str(os.cpu_count() or 1)))
+
+# Batch sizes run once at startup so the first real requests don't pay for tracing
+# (with INFERENCE_ENGINE=xla every bucket is compiled instead)
+WARMUP_BATCH_SIZES = parse_batch_sizes(
+    os.environ.get('WARMUP_BATCH_SIZES', f'1,{BATCH_MAX_SIZE},{BATCH_CHUNK_SIZE}')
+)
+
+# Result cache keyed by image content hash + model version. RESULT_CACHE_SIZE=0
+# disables it; RESULT_CACHE_PATH adds a SQLite tier that survives restarts.
+RESULT_CACHE_SIZE = int(os.environ.get('RESULT_CACHE_SIZE', '10000'))
+RESULT_CACHE_PATH = os.environ.get('RESULT_CACHE_PATH', '')
+MODEL_VERSION = os.environ.get('MODEL_VERSION', '')
+result_cache = None
+
+# Embedding store (see embeddings.py): with EMBEDDING_DIR set, the model runs
+# only up to the pooled ResNet50 embedding, which is kept per image hash, and
+# the dense head runs in numpy. HEAD_PATH swaps in another head (.npz, or a
+# weights file with dense_4/dense_5) without re-running the base.
+EMBEDDING_DIR = os.environ.get('EMBEDDING_DIR', '')
+HEAD_PATH = os.environ.get('HEAD_PATH', '')
+embedding_store = None
+head = None
+head_path = None  # copy of the head saved in the store, loaded by the HTTP workers
+
+# Two-stage cascade (see cascade.py): the small screening model at
+# CASCADE_MODEL_PATH answers images it is confident about, at the threshold
+# calibrate_cascade.py calibrated (or CASCADE_THRESHOLD), and the rest are
+# escalated to ResNet50. Cannot be combined with EMBEDDING_DIR.
+CASCADE_MODEL_PATH = os.environ.get('CASCADE_MODEL_PATH', '')
+CASCADE_THRESHOLD = os.environ.get('CASCADE_THRESHOLD', '')
+cascade_info = None  # screening model and threshold, once the cascade is serving
+
+# Cold start breakdown in seconds (TF import, graph build, weight load,
+# warm-up), logged at startup and reported by /health and /ready. A
+# MODEL_PATH pointing at a build_artifact.py directory loads fastest.
+# Exceeding COLD_START_BUDGET_S (0 = no budget) logs a warning.
+COLD_START_BUDGET_S = float(os.environ.get('COLD_START_BUDGET_S', '0'))
+cold_start = {}
+model_manifest = None  # manifest.json of a build_artifact.py model
+
+# Classification requests that arrive while the model is loading get a 503
+# telling the client to retry after this many seconds
+LOADING_RETRY_AFTER_S = int(os.environ.get('LOADING_RETRY_AFTER_S', '5'))
+model_ready = threading.Event()  # set once loading has finished (either way)
+
+# POST /admin/profile captures a Python sampling profile or a TensorFlow trace
+# for up to PROFILE_MAX_SECONDS into PROFILE_DIR (see profiling.py). The admin
+# endpoints are disabled unless ADMIN_TOKEN is set; callers send it in the
+# X-Admin-Token header.
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN', '')
+PROFILE_DIR = os.environ.get('PROFILE_DIR', '/tmp/teampics-profiles')
+PROFILE_MAX_SECONDS = float(os.environ.get('PROFILE_MAX_SECONDS', '60'))
+PROFILE_SAMPLE_INTERVAL_MS = float(os.environ.get('PROFILE_SAMPLE_INTERVAL_MS', '5'))
+
+# Asynchronous classification jobs (/jobs, see jobs.py) are checkpointed under
+# JOBS_DIR, so a restarted worker resumes them; JOBS_DIR= disables the API.
+# Point it at a volume for jobs to survive a new container. Mapping CSVs and
+# image references are files under JOB_DATA_ROOT.
+JOBS_DIR = os.environ.get('JOBS_DIR', '/tmp/teampics-jobs')
+JOB_DATA_ROOT = os.environ.get(
+    'JOB_DATA_ROOT', os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'profile_images')
+)
+JOB_MAX_ITEMS = int(os.environ.get('JOB_MAX_ITEMS', '500000'))
+JOB_RESULTS_PAGE_MAX = int(os.environ.get('JOB_RESULTS_PAGE_MAX', '1000'))
+job_store = jobs.JobStore(JOBS_DIR) if JOBS_DIR and serves_requests else None
+job_runner = None
+
 def load_model():
     """Load the Keras model at startup"""
-    global model
+    global model, model_manifest
     import sys
+    from inference import TFLiteInference, is_artifact, load_artifact, load_keras_model
     print("=" * 50, flush=True)
     print("Starting model loading...", flush=True)
     print(f"Looking for model at: {MODEL_PATH}", flush=True)
@@ -31,43 +181,23 @@ def load_model():
             print(f"Model file found, loading...", flush=True)
             sys.stdout.flush()
             
-            # Try direct load first
-            try:
-                model = tf.keras.models.load_model(MODEL_PATH, compile=False)
-                print(f"✓ Model loaded successfully from {MODEL_PATH}", flush=True)
+            start = time.perf_counter()
+            if is_artifact(MODEL_PATH):
+                # Canonical artifact from build_artifact.py: config + memory-mapped weights
+                model, model_manifest = load_artifact(MODEL_PATH, timings=cold_start)
+                print(f"✓ Model artifact {model_manifest['model_version']} loaded "
+                      f"(TensorFlow {model_manifest['tensorflow_version']})", flush=True)
                 print(f"✓ Model input shape: {model.input_shape}", flush=True)
-                sys.stdout.flush()
-            except (TypeError, ValueError, KeyError) as e:
-                # If direct load fails, rebuild architecture and load weights
-                print(f"⚠ Direct load failed ({type(e).__name__}), rebuilding architecture...", flush=True)
-                sys.stdout.flush()
-                
-                from tensorflow.keras import layers, models
-                from tensorflow.keras.applications import ResNet50
-                
-                # Rebuild model architecture
-                inputs = layers.Input(shape=(224, 224, 3))
-                x = preprocess_input(inputs)
-                base_model = ResNet50(include_top=False, weights=None, input_tensor=x)
-                x = layers.GlobalAveragePooling2D()(base_model.output)
-                x = layers.Dropout(0.25)(x, training=False)
-                x = layers.Dense(256, activation='relu')(x)
-                x = layers.Dropout(0.25)(x, training=False)
-                outputs = layers.Dense(3, activation='softmax')(x)
-                model = models.Model(inputs=inputs, outputs=outputs)
-                
-                # Try loading weights
-                weights_path = MODEL_PATH.replace('.h5', '_weights.h5') if '.h5' in MODEL_PATH else MODEL_PATH
-                if os.path.exists(weights_path):
-                    model.load_weights(weights_path)
-                    print(f"✓ Rebuilt architecture and loaded weights from {weights_path}", flush=True)
-                else:
-                    # Try loading from the model file anyway
-                    model.load_weights(MODEL_PATH)
-                    print(f"✓ Rebuilt architecture and loaded weights from {MODEL_PATH}", flush=True)
-                    
+            elif MODEL_PATH.endswith('.tflite'):
+                # TFLite export (float32, dynamic-range or int8) from export_tflite.py
+                model = TFLiteInference(MODEL_PATH, num_threads=TFLITE_THREADS)
+                cold_start['model_load'] = time.perf_counter() - start
+                print(f"✓ TFLite model loaded from {MODEL_PATH} (input dtype {model.input_dtype})", flush=True)
+            else:
+                model = load_keras_model(MODEL_PATH)
+                cold_start['model_load'] = time.perf_counter() - start
                 print(f"✓ Model input shape: {model.input_shape}", flush=True)
-                sys.stdout.flush()
+            sys.stdout.flush()
                 
         else:
             print(f"Warning: Model file not found at {MODEL_PATH}", flush=True)
@@ -84,25 +214,632 @@ def load_model():
     print("=" * 50, flush=True)
     sys.stdout.flush()
 
-# Load model at startup
-print("=" * 50, flush=True)
-print("Starting model loading...", flush=True)
-print(f"Looking for model at: {MODEL_PATH}", flush=True)
-load_model()
-print("=" * 50, flush=True)
+def get_request_image():
+    """Find the image in a /classify request.
+
+    Accepts a raw image/jpeg or image/png body, a multipart upload in the
+    'image' field, the original JSON body with a base64 'image' string, or
+    JSON with a 'url' (an image URL or a path under IMAGE_BASE_URL) to fetch.
+    Returns (read_fn, source), or (None, None) if no image was sent;
+    read_fn(source) produces the payload for image_digest/decode_image.
+    """
+    if request.mimetype.startswith('image/'):
+        if not request.content_length and 'chunked' not in request.headers.get('Transfer-Encoding', ''):
+            # No Content-Length (or 0) and not chunked: there is no body to read
+            return None, None
+        return read_upload_stream, request.stream
+    
+    if request.mimetype == 'multipart/form-data':
+        upload = request.files.get('image')
+        if upload is None:
+            return None, None
+        return read_image_file, upload.stream
+    
+    data = request.get_json(silent=True)
+    if isinstance(data, dict) and data.get('url'):
+        return fetcher.fetch, data['url']
+    if not isinstance(data, dict) or not data.get('image'):
+        return None, None
+    return read_image_base64, data['image']
+
+def read_upload_stream(stream):
+    """Read a raw image body, refusing it as soon as it exceeds MAX_IMAGE_BYTES"""
+    chunks = read_image_stream(stream, max_bytes=MAX_IMAGE_BYTES)
+    if not chunks:
+        # A chunked body can still turn out to be empty
+        raise ImageRejected('No image data provided', 400)
+    return chunks
+
+def decode_upload(payload, out=None):
+    """decode_image with the configured upload limits and JPEG draft decoding"""
+    timings = {}
+    try:
+        return decode_image(payload, size=IMAGE_SIZE, out=out, max_bytes=MAX_IMAGE_BYTES, max_pixels=MAX_IMAGE_PIXELS,
+                            draft=JPEG_DRAFT_DECODE, timings=timings)
+    finally:
+        metrics.observe_stages(timings)
+
+def cache_key(digest):
+    """Result cache key: content hash of the image plus the model version"""
+    return f'{MODEL_VERSION}:{digest}'
+
+def predict_batch(images):
+    """Run a uint8 batch of shape (N, IMAGE_SIZE, IMAGE_SIZE, 3) through the model"""
+    # ResNet50 preprocessing happens inside the traced graph
+    metrics.BATCH_SIZE.observe(len(images))
+    with metrics.INFERENCE_SECONDS.time():
+        return inference_fn(images)
+
+def to_predictions(outputs, digests):
+    """(probabilities, answering cascade stage per row or None) from a forward pass.
+
+    With the embedding store the outputs are embeddings, which are stored and
+    run through the head; with the cascade their last column is the stage.
+    """
+    if embedding_store is not None:
+        embedding_store.put_many(digests, outputs)
+        return head(outputs), None
+    if cascade_info is not None:
+        # Counted here, for the decoded images only (a batch also runs its undecoded cells)
+        from cascade import split_stages
+        probabilities, stages = split_stages(outputs)
+        escalated = stages.count('full')
+        metrics.CASCADE_IMAGES.inc('screen', len(stages) - escalated)
+        metrics.CASCADE_IMAGES.inc('full', escalated)
+        return probabilities, stages
+    return outputs, None
+
+def stored_prediction(digest):
+    """Probabilities from the stored embedding of an image, or None if it has none"""
+    if embedding_store is None or digest is None:
+        return None
+    embedding = embedding_store.get(digest)
+    metrics.EMBEDDING_LOOKUPS.inc('miss' if embedding is None else 'hit')
+    return None if embedding is None else head(embedding[None])[0]
+
+def format_prediction(predictions, stage=None):
+    """Build the classification fields of a response from one prediction row (and the cascade stage that answered)"""
+    predicted_class_idx = int(np.argmax(predictions))
+    fields = {
+        'classification': class_names[predicted_class_idx],
+        'confidence': float(predictions[predicted_class_idx]),
+        'all_predictions': {
+            class_names[i]: float(predictions[i])
+            for i in range(len(class_names))
+        }
+    }
+    if stage is not None:
+        fields['stage'] = stage
+    return fields
+
+def get_model_version():
+    """Identify the loaded model: MODEL_VERSION if set, else the artifact's version or the model file's name, size and mtime"""
+    if MODEL_VERSION:
+        return MODEL_VERSION
+    if model_manifest is not None:
+        return model_manifest['model_version']
+    try:
+        stat = os.stat(MODEL_PATH)
+        return f'{os.path.basename(MODEL_PATH)}-{stat.st_size}-{int(stat.st_mtime)}'
+    except OSError:
+        return os.path.basename(MODEL_PATH)
+
+def classify_payload(payload):
+    """Classify one image payload through the result cache. Returns (fields, cached)."""
+    digest = None
+    
+    def compute():
+        stored = stored_prediction(digest)
+        if stored is not None:
+            return format_prediction(stored)
+        # Decode straight into the batcher's buffer (shared memory with the
+        # inference pool) and predict, sharing a forward pass with concurrent requests
+        with batcher.reserve(1) as batch:
+            decode_upload(payload, out=batch.images[0])
+            with metrics.STAGE_SECONDS.time('predict'):
+                predictions, stages = to_predictions(batch.predict(), [digest])
+            return format_prediction(predictions[0], stages and stages[0])
+    
+    if result_cache is None and embedding_store is None:
+        return compute(), False
+    with metrics.STAGE_SECONDS.time('hash'):
+        digest = image_digest(payload)
+    if result_cache is None:
+        return compute(), False
+    fields, cached = result_cache.get_or_compute(cache_key(digest), compute)
+    metrics.CACHE_LOOKUPS.inc('hit' if cached else 'miss')
+    return fields, cached
+
+def read_batch_item(read, source):
+    """Pool task for /classify/batch: read one image and compute its content hash (if anything is keyed by it)"""
+    with metrics.STAGE_SECONDS.time('read'):
+        payload = read(source)
+    if result_cache is None and embedding_store is None:
+        return payload, None
+    with metrics.STAGE_SECONDS.time('hash'):
+        return payload, image_digest(payload)
+
+def classify_items(read, sources, read_pool=None):
+    """Classify many images (read(source) gives each payload): a result, or error, per source.
+
+    Reads (on read_pool, default the decode pool) and cache lookups run in
+    parallel and a bad image only fails its own slot. Results carry the
+    source's 'index'.
+    """
+    results = [None] * len(sources)
+    misses = {}  # content hash (or index when nothing is keyed by it) -> payload
+    waiting = {}  # same key -> indexes of the images sharing it
+    futures = [(read_pool or decode_pool).submit(read_batch_item, read, source) for source in sources]
+    for i, future in enumerate(futures):
+        try:
+            payload, digest = future.result()
+        except Exception as e:
+            results[i] = {'index': i, 'error': f'Error processing image: {str(e)}'}
+            continue
+        
+        cached = result_cache.get(cache_key(digest)) if result_cache is not None else None
+        if result_cache is not None:
+            metrics.CACHE_LOOKUPS.inc('miss' if cached is None else 'hit')
+        if cached is not None:
+            results[i] = {'index': i, **cached, 'cached': True}
+            continue
+        
+        group = digest if digest is not None else i
+        if group not in misses:
+            stored = stored_prediction(digest)
+            if stored is not None:
+                fields = format_prediction(stored)
+                if result_cache is not None:
+                    result_cache.put(cache_key(digest), fields)
+                results[i] = {'index': i, **fields, 'cached': False}
+                continue
+        misses.setdefault(group, payload)
+        waiting.setdefault(group, []).append(i)
+    
+    # Decode the cache misses (each distinct image once) in parallel, straight
+    # into the batcher's buffers, and run inference in fixed-size chunks
+    groups = list(misses)
+    for start in range(0, len(groups), BATCH_CHUNK_SIZE):
+        chunk = groups[start:start + BATCH_CHUNK_SIZE]
+        with batcher.reserve(len(chunk)) as batch:
+            futures = [
+                decode_pool.submit(decode_upload, misses[group], out=image)
+                for group, image in zip(chunk, batch.images)
+            ]
+            decoded = []  # positions in the chunk; rows of images that failed are ignored
+            for position, (group, future) in enumerate(zip(chunk, futures)):
+                try:
+                    future.result()
+                    decoded.append(position)
+                except Exception as e:
+                    for i in waiting[group]:
+                        results[i] = {'index': i, 'error': f'Error processing image: {str(e)}'}
+            if not decoded:
+                continue
+            try:
+                with metrics.STAGE_SECONDS.time('predict'):
+                    # Rows of images that failed to decode are garbage; keep them out of the store
+                    outputs = np.asarray(batch.predict())[decoded]
+                    predictions, stages = to_predictions(outputs, [chunk[p] for p in decoded])
+                    predictions = dict(zip(decoded, zip(predictions, stages or [None] * len(decoded))))
+            except Exception as e:
+                for position in decoded:
+                    for i in waiting[chunk[position]]:
+                        results[i] = {'index': i, 'error': f'Error classifying image: {str(e)}'}
+                continue
+        for position in decoded:
+            group = chunk[position]
+            fields = format_prediction(*predictions[position])
+            if result_cache is not None:
+                result_cache.put(cache_key(group), fields)
+            for i in waiting[group]:
+                results[i] = {'index': i, **fields, 'cached': False}
+    
+    for result in results:
+        if 'error' not in result:
+            metrics.PREDICTIONS.inc(result['classification'])
+    return results
+
+def stream_items(read, sources, read_pool=None):
+    """NDJSON lines for a streamed /classify/batch: each chunk's results as soon as it is classified, then a summary.
+
+    The next chunk is only read and classified once the server has handed the
+    previous one to the client connection, so a slow client slows the batch
+    down instead of results piling up in memory.
+    """
+    succeeded = failed = 0
+    try:
+        for start in range(0, len(sources), BATCH_CHUNK_SIZE):
+            results = classify_items(read, sources[start:start + BATCH_CHUNK_SIZE], read_pool)
+            with metrics.STAGE_SECONDS.time('serialize'):
+                lines = []
+                for result in results:
+                    result['index'] += start
+                    if 'error' in result:
+                        failed += 1
+                    else:
+                        succeeded += 1
+                    lines.append(json.dumps(result) + '\n')
+            yield ''.join(lines)
+        summary = {'done': True}
+    except Exception as e:
+        # The 200 status is already sent: report the failure on the last line
+        summary = {'done': False, 'error': str(e)}
+    yield json.dumps({
+        **summary,
+        'total': len(sources),
+        'succeeded': succeeded,
+        'failed': failed,
+        'timestamp': datetime.utcnow().isoformat()
+    }) + '\n'
+
+def resolve_data_path(reference):
+    """Absolute path of a file reference under JOB_DATA_ROOT, or None if it points outside it"""
+    root = os.path.realpath(JOB_DATA_ROOT)
+    path = os.path.realpath(os.path.join(root, *str(reference).replace('\\', '/').split('/')))
+    return path if os.path.commonpath([root, path]) == root else None
+
+def job_items_from_mapping(mapping_path):
+    """Job items for every profile of a mapping CSV (path None for profiles without a photo)"""
+    items = []
+    for row in read_profile_mapping(mapping_path):
+        item = {field: row.get(field, '') for field in ('userId', 'displayName', 'userPrincipalName', 'imageType', 'imagePath')}
+        item['path'] = row['path']
+        if row['path'] is not None and resolve_data_path(row['path']) is None:
+            item['path'] = None
+            item['error'] = f"imagePath is outside the data root: {row['imagePath']}"
+        items.append(item)
+    return items
+
+def classify_job_items(items):
+    """JobRunner classify_fn: profiles without a photo are 'no_pic', photos go through classify_items"""
+    results = [None] * len(items)
+    photos = []
+    for i, item in enumerate(items):
+        if item.get('error'):
+            results[i] = {'error': item['error']}
+        elif not item.get('path'):
+            results[i] = {'classification': 'no_pic'}
+        else:
+            photos.append(i)
+    for i, result in zip(photos, classify_items(read_image_path, [items[i]['path'] for i in photos])):
+        result.pop('index')
+        results[i] = result
+    return results
+
+def start_job_runner():
+    """Run checkpointed jobs in this worker once the model is serving"""
+    global job_runner
+    if job_store is not None and model_status == 'loaded':
+        job_runner = jobs.JobRunner(job_store, classify_job_items, chunk_size=BATCH_CHUNK_SIZE).start()
+        print(f"✓ Job runner started ({JOBS_DIR})", flush=True)
+
+def start_result_cache():
+    """Create the result cache (unless disabled) once MODEL_VERSION is known"""
+    global result_cache
+    if RESULT_CACHE_SIZE > 0 or RESULT_CACHE_PATH:
+        result_cache = ResultCache(max_entries=RESULT_CACHE_SIZE, disk_path=RESULT_CACHE_PATH or None)
+        print(f"✓ Result cache enabled ({RESULT_CACHE_SIZE} entries in memory, disk: {RESULT_CACHE_PATH or 'off'})", flush=True)
+
+def start_embeddings(root, store_head):
+    """Open the embedding store at root (one per base model) and classify with store_head"""
+    global embedding_store, head
+    from embeddings import EMBEDDING_DIM, EmbeddingStore
+    
+    if store_head.input_dim != EMBEDDING_DIM or store_head.layers[-1][0].shape[1] != len(class_names):
+        raise ValueError(f'Head {store_head.version} maps {store_head.input_dim} inputs to '
+                         f'{store_head.layers[-1][0].shape[1]} classes, expected {EMBEDDING_DIM} to {len(class_names)}')
+    embedding_store = EmbeddingStore(root, base_version=os.path.basename(root))
+    head = store_head
+    print(f"✓ Embedding store {root} ({embedding_store.stats()['embeddings']} embeddings), head {head.version}", flush=True)
+
+def start_cascade():
+    """Put the screening model in front of inference_fn (see cascade.py)"""
+    global inference_fn, cascade_info
+    from cascade import Cascade, load_screen_model, read_calibration
+    
+    if EMBEDDING_DIR:
+        raise ValueError('CASCADE_MODEL_PATH cannot be combined with EMBEDDING_DIR')
+    calibration = read_calibration(CASCADE_MODEL_PATH)
+    if CASCADE_THRESHOLD:
+        threshold = float(CASCADE_THRESHOLD)
+    elif calibration is not None:
+        threshold = calibration['threshold']
+    else:
+        raise ValueError(f'{CASCADE_MODEL_PATH} has not been calibrated; run calibrate_cascade.py or set CASCADE_THRESHOLD')
+    screen_fn = load_screen_model(CASCADE_MODEL_PATH, image_size=inference_fn.image_size)
+    inference_fn = Cascade(screen_fn, inference_fn, threshold)
+    cascade_info = {
+        'screen_model': os.path.basename(os.path.normpath(CASCADE_MODEL_PATH)),
+        'threshold': threshold,
+        'calibrated': not CASCADE_THRESHOLD
+    }
+    print(f"✓ Cascade: {cascade_info['screen_model']} answers at confidence >= {threshold:g}"
+          + (f" (calibrated escalation rate {calibration['escalation_rate']:.1%})" if calibration and not CASCADE_THRESHOLD else ''),
+          flush=True)
+
+def start_model():
+    """Set up the inference engine for the loaded model and work out MODEL_VERSION"""
+    global INFERENCE_ENGINE, MODEL_VERSION, inference_fn, head_path, embedding_store
+    from inference import TFLiteInference, create_inference, input_size
+    
+    if isinstance(model, TFLiteInference):
+        INFERENCE_ENGINE = 'tflite'
+    # Served at another resolution than it was built for: results and embeddings differ
+    resized = INFERENCE_ENGINE != 'tflite' and input_size(model) not in (None, IMAGE_SIZE)
+    served = model
+    if EMBEDDING_DIR:
+        # Run the ResNet50 base only; its pooled output is stored and the head runs in numpy
+        from embeddings import DenseHead, base_version
+        from inference import split_head
+        if INFERENCE_ENGINE == 'tflite':
+            raise ValueError('EMBEDDING_DIR needs a Keras model or artifact; a TFLite model cannot be split at the pooling')
+        served, model_head = split_head(model)
+        store_version = base_version(served.get_weights(), input_size(served), IMAGE_SIZE)
+        start_embeddings(os.path.join(EMBEDDING_DIR, store_version), DenseHead.load(HEAD_PATH) if HEAD_PATH else model_head)
+        head_path = embedding_store.save_head(head)
+        if not serves_requests:
+            # An inference process only runs the base; the HTTP workers look embeddings up
+            embedding_store.close()
+            embedding_store = None
+    inference_fn = create_inference(served, INFERENCE_ENGINE, image_size=IMAGE_SIZE, xla_buckets=XLA_BATCH_BUCKETS)
+    if resized:
+        print(f"✓ Model rebuilt for {IMAGE_SIZE}px inputs (built for {input_size(model)}px)", flush=True)
+    if CASCADE_MODEL_PATH:
+        start_cascade()
+    warmup_timings = inference_fn.warmup(None if INFERENCE_ENGINE == 'xla' else WARMUP_BATCH_SIZES)
+    cold_start['warm_up'] = sum(warmup_timings.values())
+    print(f"✓ Inference engine '{INFERENCE_ENGINE}' warmed up: " + ", ".join(
+        f"batch {size} {seconds * 1000:.0f}ms" for size, seconds in warmup_timings.items()
+    ), flush=True)
+    MODEL_VERSION = get_model_version()
+    if resized:
+        MODEL_VERSION = f'{MODEL_VERSION}@{IMAGE_SIZE}px'
+    if HEAD_PATH and head is not None:
+        MODEL_VERSION = f'{MODEL_VERSION}+{head.version}'  # results come from the swapped-in head
+    if cascade_info is not None:
+        MODEL_VERSION = f"{MODEL_VERSION}+cascade-{cascade_info['screen_model']}@{cascade_info['threshold']:g}"
+
+def start_serving():
+    """Put the result cache and micro-batcher in front of the in-process model"""
+    global batcher
+    start_result_cache()
+    batcher = MicroBatcher(predict_batch, max_batch_size=BATCH_MAX_SIZE, max_wait_ms=BATCH_MAX_WAIT_MS,
+                           image_shape=(IMAGE_SIZE, IMAGE_SIZE, 3),
+                           buffers=BufferPool((IMAGE_SIZE, IMAGE_SIZE, 3), max_free=INPUT_BUFFERS_PER_SIZE))
+    print(f"✓ Micro-batching enabled (max batch {BATCH_MAX_SIZE}, max wait {BATCH_MAX_WAIT_MS}ms)", flush=True)
+
+def load_in_background():
+    """Import TensorFlow, load and warm up the model; runs on the model-loader thread"""
+    global tf, model, model_status
+    started = time.perf_counter()
+    try:
+        import tensorflow
+        tf = tensorflow
+        cold_start['tf_import'] = time.perf_counter() - started
+        
+        load_model()
+        if model is not None:
+            start_model()
+            if serves_requests:
+                start_serving()
+    except Exception as e:
+        print(f"✗ Error starting model: {str(e)}", flush=True)
+        import traceback
+        traceback.print_exc()
+        model = None
+    
+    cold_start['total'] = time.perf_counter() - started
+    # Only flip the status once everything the request handlers use is in place
+    model_status = 'loaded' if model is not None else 'not_loaded'
+    model_ready.set()
+    start_job_runner()
+    print("Cold start: " + ", ".join(f"{stage} {seconds:.2f}s" for stage, seconds in cold_start.items()), flush=True)
+    if COLD_START_BUDGET_S and cold_start['total'] > COLD_START_BUDGET_S:
+        print(f"⚠ Cold start took {cold_start['total']:.2f}s, over the {COLD_START_BUDGET_S:g}s budget", flush=True)
+
+def attach_shared_inference():
+    """Wait for the inference pool to load the model, then serve through it"""
+    global INFERENCE_ENGINE, MODEL_VERSION, model_status, batcher, cascade_info
+    info = shared_inference.wait_ready()
+    cold_start.update(info.get('cold_start', {}))
+    if info.get('model_status') == 'loaded':
+        INFERENCE_ENGINE = info['inference_engine']
+        MODEL_VERSION = info['model_version']
+        cascade_info = info.get('cascade')
+        if info.get('head_path'):
+            from embeddings import DenseHead
+            start_embeddings(os.path.dirname(os.path.dirname(info['head_path'])), DenseHead.load(info['head_path']))
+        start_result_cache()
+        batcher = shared_inference
+        print(f"✓ Serving through the inference pool (pids {', '.join(map(str, info['pids']))}, model {MODEL_VERSION})", flush=True)
+    model_status = info.get('model_status', 'not_loaded')
+    model_ready.set()
+    start_job_runner()
+
+def get_tensorflow_version():
+    """TensorFlow version, read from package metadata while TensorFlow is still being imported"""
+    if tf is not None:
+        return tf.__version__
+    for distribution in ('tensorflow', 'tensorflow-cpu'):
+        try:
+            return metadata.version(distribution)
+        except metadata.PackageNotFoundError:
+            pass
+    return 'N/A'
+
+def model_loading_response():
+    """Fast 503 for classification requests that arrive before the model is ready"""
+    return jsonify({
+        'error': 'Model is still loading, retry shortly',
+        'model_status': model_status,
+        'timestamp': datetime.utcnow().isoformat()
+    }), 503, {'Retry-After': str(LOADING_RETRY_AFTER_S)}
+
+# Under gunicorn (see gunicorn.conf.py) the model lives in a pool of inference
+# processes shared by all workers, and this process never imports TensorFlow;
+# otherwise it is loaded here.
+# Either way it happens in the background: the server is already bound
+# (gunicorn binds before importing the app) and answers /health and /ready.
+shared_inference = inference_service.connect()
+threading.Thread(
+    target=attach_shared_inference if shared_inference is not None else load_in_background,
+    name='model-loader', daemon=True
+).start()
 
 @app.route('/health', methods=['GET'])
 def health_check():
-    """Health check endpoint that returns TensorFlow version"""
-    model_status = 'loaded' if model is not None else 'not_loaded'
+    """Health check endpoint that returns TensorFlow version (liveness; see /ready)"""
     return jsonify({
         'status': 'healthy',
         'message': 'Backend API is running',
-        'tensorflow_version': tf.__version__,
+        'tensorflow_version': get_tensorflow_version(),
+        'model_status': model_status,
+        'inference_engine': INFERENCE_ENGINE,
+        'model_version': MODEL_VERSION,
+        'cold_start_seconds': {stage: round(seconds, 3) for stage, seconds in cold_start.items()},
+        'timestamp': datetime.utcnow().isoformat()
+    }), 200
+
+@app.route('/ready', methods=['GET'])
+def readiness_check():
+    """Readiness endpoint: 200 once the model is loaded and warmed up, 503 before"""
+    response = jsonify({
+        'ready': model_status == 'loaded',
         'model_status': model_status,
+        'model_version': MODEL_VERSION,
+        'cold_start_seconds': {stage: round(seconds, 3) for stage, seconds in cold_start.items()},
+        'timestamp': datetime.utcnow().isoformat()
+    })
+    if model_status == 'loaded':
+        return response, 200
+    if model_status == 'loading':
+        return response, 503, {'Retry-After': str(LOADING_RETRY_AFTER_S)}
+    return response, 503
+
+def admin_denied():
+    """Error response for a request without the admin token, or None if it may proceed"""
+    if not ADMIN_TOKEN:
+        return jsonify({
+            'error': 'Admin endpoints are disabled (ADMIN_TOKEN is not set)',
+            'timestamp': datetime.utcnow().isoformat()
+        }), 404
+    if not hmac.compare_digest(request.headers.get('X-Admin-Token', ''), ADMIN_TOKEN):
+        return jsonify({
+            'error': 'Invalid admin token',
+            'timestamp': datetime.utcnow().isoformat()
+        }), 403
+    return None
+
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    """Result cache hit/miss counters"""
+    return jsonify({
+        'enabled': result_cache is not None,
+        'model_version': MODEL_VERSION,
+        **(result_cache.stats() if result_cache is not None else {}),
+        'timestamp': datetime.utcnow().isoformat()
+    }), 200
+
+@app.route('/embeddings/stats', methods=['GET'])
+def embedding_stats():
+    """Embedding store size and lookup counters"""
+    return jsonify({
+        'enabled': embedding_store is not None,
+        'head_version': head.version if head is not None else None,
+        **(embedding_store.stats() if embedding_store is not None else {}),
+        'timestamp': datetime.utcnow().isoformat()
+    }), 200
+
+@app.route('/buffers/stats', methods=['GET'])
+def buffer_stats():
+    """Input buffer allocation counters (ring buffer usage with shared inference)"""
+    return jsonify({
+        'shared_inference': shared_inference is not None,
+        **(batcher.buffer_stats() if batcher is not None else {}),
         'timestamp': datetime.utcnow().isoformat()
     }), 200
 
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Stage latencies, batch sizes, cache and prediction counters in Prometheus text format"""
+    gauges = [
+        ('teampics_model_info', 'Loaded model version and inference engine',
+         [([('model_version', MODEL_VERSION), ('engine', INFERENCE_ENGINE), ('status', model_status)], 1)]),
+        ('teampics_queue_depth', 'Requests waiting for a forward pass',
+         [([], batcher.queue_depth() if batcher is not None else 0)]),
+    ]
+    if cascade_info is not None:
+        screened, escalated = metrics.CASCADE_IMAGES.value('screen'), metrics.CASCADE_IMAGES.value('full')
+        gauges.append(('teampics_cascade_escalation_ratio', 'Share of images the screening model escalated to ResNet50',
+                       [([('threshold', cascade_info['threshold'])], escalated / (screened + escalated) if escalated else 0)]))
+    return Response(metrics.registry.render(gauges), mimetype='text/plain; version=0.0.4')
+
+@app.route('/admin/profile', methods=['POST'])
+def capture_profile():
+    """Profile this server for ?seconds= (kind=python: this worker's threads, kind=tensorflow: model ops)"""
+    denied = admin_denied()
+    if denied is not None:
+        return denied
+    
+    kind = request.args.get('kind', 'python')
+    try:
+        seconds = float(request.args.get('seconds', '10'))
+    except ValueError:
+        seconds = 0
+    if kind not in ('python', 'tensorflow') or not 0 < seconds <= PROFILE_MAX_SECONDS:
+        return jsonify({
+            'error': f'Expected kind=python or kind=tensorflow and 0 < seconds <= {PROFILE_MAX_SECONDS:g}',
+            'timestamp': datetime.utcnow().isoformat()
+        }), 400
+    
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    name = f'{kind}-{datetime.utcnow():%Y%m%dT%H%M%S}-{os.getpid()}'
+    try:
+        if kind == 'python':
+            name += '.folded'
+            result = profiling.capture_python_profile(
+                os.path.join(PROFILE_DIR, name), seconds, interval=PROFILE_SAMPLE_INTERVAL_MS / 1000
+            )
+        elif shared_inference is not None:
+            # The model runs in the inference processes; each one traces itself
+            result = {'kind': kind, 'captures': shared_inference.capture_trace(os.path.join(PROFILE_DIR, name), seconds)}
+        else:
+            result = {'kind': kind, 'captures': [profiling.capture_tensorflow_trace(os.path.join(PROFILE_DIR, name), seconds)]}
+    except profiling.CaptureBusy as e:
+        return jsonify({
+            'error': str(e),
+            'timestamp': datetime.utcnow().isoformat()
+        }), 409
+    
+    failed = any('error' in capture for capture in result.get('captures', []))
+    print(f"{'⚠' if failed else '✓'} Profile captured: {os.path.join(PROFILE_DIR, name)}", flush=True)
+    return jsonify({
+        'name': name,
+        'path': os.path.join(PROFILE_DIR, name),
+        'download': f'/admin/profiles/{name}',
+        **result,
+        'timestamp': datetime.utcnow().isoformat()
+    }), 500 if failed else 200
+
+@app.route('/admin/profiles/<name>', methods=['GET'])
+def download_profile(name):
+    """Download a captured profile (TensorFlow traces as a zip)"""
+    denied = admin_denied()
+    if denied is not None:
+        return denied
+    
+    path = os.path.join(PROFILE_DIR, os.path.basename(name))
+    if os.path.isdir(path):
+        return send_file(profiling.zip_directory(path), mimetype='application/zip',
+                         as_attachment=True, download_name=f'{os.path.basename(name)}.zip')
+    if os.path.isfile(path):
+        return send_file(path, mimetype='text/plain', as_attachment=True)
+    return jsonify({
+        'error': f'No profile named {name}',
+        'timestamp': datetime.utcnow().isoformat()
+    }), 404
+
 @app.route('/tensorflow-version', methods=['GET'])
 def tensorflow_version():
     """Get TensorFlow version endpoint"""
@@ -112,7 +849,7 @@ def tensorflow_version():
         keras_version = 'N/A'
     
     return jsonify({
-        'tensorflow_version': tf.__version__,
+        'tensorflow_version': get_tensorflow_version(),
         'keras_version': keras_version,
         'timestamp': datetime.utcnow().isoformat()
     }), 200
@@ -122,27 +859,29 @@ def ping():
     """Alternative ping endpoint"""
     return jsonify({
         'response': 'pong',
-        'tensorflow_version': tf.__version__,
+        'tensorflow_version': get_tensorflow_version(),
         'timestamp': datetime.utcnow().isoformat()
     }), 200
 
 @app.route('/classify', methods=['POST'])
 def classify_image():
     """Classify an image as human, avatar, or animal"""
+    if model_status == 'loading':
+        return model_loading_response()
+    
     try:
-        # Get the image data from request
-        data = request.get_json()
+        # Get the image data from request (raw body, multipart or base64 JSON)
+        with metrics.STAGE_SECONDS.time('parse'):
+            read, source = get_request_image()
         
-        if not data or 'image' not in data:
+        if source is None:
             return jsonify({
                 'error': 'No image data provided',
                 'timestamp': datetime.utcnow().isoformat()
             }), 400
         
-        image_data = data['image']
-        
         # Check if model is loaded
-        if model is None:
+        if model_status != 'loaded':
             return jsonify({
                 'error': 'Model not loaded',
                 'classification': 'human',
@@ -152,45 +891,23 @@ def classify_image():
         
         # Decode and process image
         try:
-            # Remove data URL prefix if present
-            if ',' in image_data:
-                image_data = image_data.split(',')[1]
-            
-            image_bytes = base64.b64decode(image_data)
-            image = Image.open(io.BytesIO(image_bytes))
-            
-            # Convert to RGB if necessary
-            if image.mode != 'RGB':
-                image = image.convert('RGB')
-            
-            # Resize to model input size (224x224)
-            image = image.resize((224, 224))
-            
-            # Convert to numpy array
-            img_array = np.array(image)
-            img_array = np.expand_dims(img_array, axis=0)  # Add batch dimension
-            
-            # Apply ResNet50 preprocessing (CRITICAL - must match training)
-            # This converts RGB [0,255] to the format ResNet50 expects
-            img_array = preprocess_input(img_array)
-            
-            # Make prediction
-            predictions = model.predict(img_array, verbose=0)[0]
+            with metrics.STAGE_SECONDS.time('read'):
+                payload = read(source)
+            fields, cached = classify_payload(payload)
+            metrics.PREDICTIONS.inc(fields['classification'])
             
-            predicted_class_idx = np.argmax(predictions)
-            confidence = float(predictions[predicted_class_idx])
-            classification = class_names[predicted_class_idx]
+            with metrics.STAGE_SECONDS.time('serialize'):
+                result = dict(fields)
+                result['cached'] = cached
+                result['timestamp'] = datetime.utcnow().isoformat()
+                return jsonify(result), 200
             
+        except ImageRejected as e:
+            # Refused from the header (too large / unsupported) before decoding
             return jsonify({
-                'classification': classification,
-                'confidence': confidence,
-                'all_predictions': {
-                    class_names[i]: float(predictions[i]) 
-                    for i in range(len(class_names))
-                },
+                'error': str(e),
                 'timestamp': datetime.utcnow().isoformat()
-            }), 200
-            
+            }), e.status
         except Exception as e:
             return jsonify({
                 'error': f'Error processing image: {str(e)}',
@@ -203,6 +920,170 @@ def classify_image():
             'timestamp': datetime.utcnow().isoformat()
         }), 500
 
+@app.route('/classify/batch', methods=['POST'])
+def classify_batch():
+    """Classify a list of images in one request, with a result (or error) per image"""
+    if model_status == 'loading':
+        return model_loading_response()
+    
+    try:
+        # Multipart uploads in repeated 'images' fields, base64 JSON 'images',
+        # or JSON 'urls' (image URLs or paths under IMAGE_BASE_URL) to fetch
+        read_pool = None
+        with metrics.STAGE_SECONDS.time('parse'):
+            if request.mimetype == 'multipart/form-data':
+                read = read_image_file
+                images = [upload.stream for upload in request.files.getlist('images')]
+            else:
+                data = request.get_json(silent=True)
+                if isinstance(data, dict) and 'urls' in data:
+                    read, read_pool = fetcher.fetch, fetcher.pool
+                    images = data['urls']
+                else:
+                    read = read_image_base64
+                    images = data.get('images') if isinstance(data, dict) else None
+        
+        if not isinstance(images, list) or not images:
+            return jsonify({
+                'error': 'No images provided',
+                'timestamp': datetime.utcnow().isoformat()
+            }), 400
+        stream = (request.args.get('stream', '').lower() in ('1', 'true') or
+                  request.accept_mimetypes.best_match(['application/json', 'application/x-ndjson']) == 'application/x-ndjson')
+        max_items = BATCH_STREAM_MAX_ITEMS if stream else BATCH_MAX_ITEMS
+        if len(images) > max_items:
+            return jsonify({
+                'error': f'Too many images ({len(images)}), maximum is {max_items}',
+                'timestamp': datetime.utcnow().isoformat()
+            }), 413
+        
+        if model_status != 'loaded':
+            return jsonify({
+                'error': 'Model not loaded',
+                'timestamp': datetime.utcnow().isoformat()
+            }), 500
+        
+        if stream:
+            return Response(stream_with_context(stream_items(read, images, read_pool)),
+                            mimetype='application/x-ndjson',
+                            headers={'X-Accel-Buffering': 'no'})  # don't let a proxy buffer the stream
+        
+        results = classify_items(read, images, read_pool)
+        failed = sum(1 for r in results if 'error' in r)
+        with metrics.STAGE_SECONDS.time('serialize'):
+            return jsonify({
+                'results': results,
+                'total': len(results),
+                'succeeded': len(results) - failed,
+                'failed': failed,
+                'timestamp': datetime.utcnow().isoformat()
+            }), 200
+        
+    except Exception as e:
+        return jsonify({
+            'error': str(e),
+            'timestamp': datetime.utcnow().isoformat()
+        }), 500
+
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    """Queue a classification job over a mapping CSV or a list of image paths (under JOB_DATA_ROOT)"""
+    if job_store is None:
+        return jsonify({
+            'error': 'Jobs are disabled (JOBS_DIR is not set)',
+            'timestamp': datetime.utcnow().isoformat()
+        }), 404
+    
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not (isinstance(data.get('mapping'), str) or isinstance(data.get('images'), list)):
+        return jsonify({
+            'error': 'Expected {"mapping": "<csv path>"} or {"images": ["<image path>", ...]}',
+            'timestamp': datetime.utcnow().isoformat()
+        }), 400
+    
+    if 'mapping' in data:
+        mapping_path = resolve_data_path(data['mapping'])
+        if mapping_path is None or not os.path.isfile(mapping_path):
+            return jsonify({
+                'error': f"Mapping CSV not found under the data root: {data['mapping']}",
+                'timestamp': datetime.utcnow().isoformat()
+            }), 400
+        items = job_items_from_mapping(mapping_path)
+        source = {'mapping': data['mapping']}
+    else:
+        items = [
+            {'image': reference, 'path': resolve_data_path(reference)} if isinstance(reference, str)
+            else {'image': reference, 'path': None}
+            for reference in data['images']
+        ]
+        for item in items:
+            if item['path'] is None:
+                item['error'] = f"Not a path under the data root: {item['image']}"
+        source = {'images': len(items)}
+    
+    if not items or len(items) > JOB_MAX_ITEMS:
+        return jsonify({
+            'error': f'A job needs between 1 and {JOB_MAX_ITEMS} images, got {len(items)}',
+            'timestamp': datetime.utcnow().isoformat()
+        }), 400 if not items else 413
+    
+    job = job_store.create(items, source)
+    if job_runner is not None:
+        job_runner.wake()
+    return jsonify({
+        **jobs.job_progress(job),
+        'status_url': f"/jobs/{job['id']}",
+        'results_url': f"/jobs/{job['id']}/results",
+        'timestamp': datetime.utcnow().isoformat()
+    }), 202
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """Progress, throughput and ETA of a job"""
+    job = job_store.get(job_id) if job_store is not None else None
+    if job is None:
+        return jsonify({
+            'error': f'No job {job_id}',
+            'timestamp': datetime.utcnow().isoformat()
+        }), 404
+    return jsonify({
+        **jobs.job_progress(job),
+        'timestamp': datetime.utcnow().isoformat()
+    }), 200
+
+@app.route('/jobs/<job_id>/results', methods=['GET'])
+def job_results(job_id):
+    """A page of a job's results (?offset=&limit=), in item order, as far as it has checkpointed"""
+    job = job_store.get(job_id) if job_store is not None else None
+    if job is None:
+        return jsonify({
+            'error': f'No job {job_id}',
+            'timestamp': datetime.utcnow().isoformat()
+        }), 404
+    try:
+        offset = max(int(request.args.get('offset', '0')), 0)
+        limit = min(max(int(request.args.get('limit', '100')), 1), JOB_RESULTS_PAGE_MAX)
+    except ValueError:
+        return jsonify({
+            'error': 'offset and limit must be integers',
+            'timestamp': datetime.utcnow().isoformat()
+        }), 400
+    
+    results = job_store.results(job_id, offset, limit)
+    next_offset = offset + len(results)
+    finished = job['status'] in (jobs.COMPLETED, jobs.FAILED)
+    return jsonify({
+        'job_id': job_id,
+        'status': job['status'],
+        'total': job['total'],
+        'completed': job['completed'],
+        'offset': offset,
+        'results': results,
+        # None once every result has been read; otherwise poll again from here
+        'next_offset': None if finished and next_offset >= job['completed'] else next_offset,
+        'timestamp': datetime.utcnow().isoformat()
+    }), 200
+
 if __name__ == '__main__':
     # Run on 0.0.0.0 to make it accessible from Docker containers
     app.run(host='0.0.0.0', port=5000, debug=True)
@@ -0,0 +1,247 @@
+"""
+Dynamic micro-batching for the classification endpoints.
+
+Concurrent requests each submit one preprocessed image; a background thread
+gathers whatever arrives within a short window (up to a maximum batch size),
+runs a single batched forward pass and hands each caller its own row back.
+Callers that already hold a full batch (e.g. /classify/batch) can submit it
+as one unit; it runs on the same thread so predict_fn is never called
+concurrently.
+
+reserve() hands out a Reservation: image buffers to decode into, then
+predict. The shared inference process (inference_service.py) implements the
+same interface over shared memory, so request handlers work with either.
+
+With a BufferPool, reservations and the batches assembled from single
+images are preallocated buffers that are reused across requests, so in
+steady state the decode -> predict path allocates no image memory; the
+pool's counters show it.
+"""
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+
+
+class BufferPool:
+    """Reusable uint8 image batch buffers, handed out by size class.
+
+    acquire(count) returns a (count, H, W, C) view of a buffer holding the
+    next power of two images; release() returns it. A buffer is only
+    allocated when its size class has none free.
+    """
+
+    def __init__(self, image_shape=(224, 224, 3), max_free=8):
+        self.image_shape = tuple(image_shape)
+        self.max_free = int(max_free)
+        self._free = {}  # (images, image shape) -> [buffers]
+        self._lock = threading.Lock()
+        self.allocations = 0
+        self.allocated_bytes = 0
+        self.reuses = 0
+        self.discards = 0
+        self.in_use = 0
+
+    def acquire(self, count, image_shape=None):
+        key = (1 << (count - 1).bit_length(), tuple(image_shape or self.image_shape))
+        with self._lock:
+            free = self._free.get(key)
+            buffer = free.pop() if free else None
+            if buffer is not None:
+                self.reuses += 1
+            self.in_use += 1
+        if buffer is None:
+            buffer = np.empty(key[:1] + key[1], dtype=np.uint8)
+            with self._lock:
+                self.allocations += 1
+                self.allocated_bytes += buffer.nbytes
+        return buffer[:count]
+
+    def release(self, images):
+        """Return a view from acquire() to the pool"""
+        buffer = images.base
+        key = (len(buffer), buffer.shape[1:])
+        with self._lock:
+            self.in_use -= 1
+            free = self._free.setdefault(key, [])
+            if len(free) < self.max_free:
+                free.append(buffer)
+            else:
+                self.discards += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'allocations': self.allocations,
+                'allocated_mb': round(self.allocated_bytes / 1e6, 1),
+                'reuses': self.reuses,
+                'discards': self.discards,
+                'in_use': self.in_use,
+                'free': {f'{images}x{"x".join(map(str, shape))}': len(free)
+                         for (images, shape), free in sorted(self._free.items())}
+            }
+
+
+class Reservation:
+    """Buffers for count images: decode into .images, then call predict()"""
+
+    def __init__(self, batcher, images, pool=None):
+        self.batcher = batcher
+        self.images = images
+        self._pool = pool
+
+    def predict(self, timeout=None):
+        """Predictions for every reserved image, shape (count, classes)"""
+        if len(self.images) == 1:
+            # Single images share a forward pass with concurrent requests
+            return self.batcher.predict(self.images[0], timeout=timeout)[np.newaxis]
+        return self.batcher.predict_batch(self.images, timeout=timeout)
+
+    def release(self):
+        """Give the buffers back (to the pool they came from, if any)"""
+        if self._pool is not None:
+            self._pool.release(self.images)
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class MicroBatcher:
+    """Group single-image predictions into batched calls to predict_fn"""
+
+    def __init__(self, predict_fn, max_batch_size=16, max_wait_ms=5.0, name='micro-batcher', buffers=None,
+                 image_shape=(224, 224, 3)):
+        if max_batch_size < 1:
+            raise ValueError('max_batch_size must be at least 1')
+        self.predict_fn = predict_fn
+        self.image_shape = tuple(image_shape)  # default shape of reserved image buffers
+        self.buffers = buffers  # optional BufferPool for reservations and assembled batches
+        self.max_batch_size = int(max_batch_size)
+        self.max_wait = max(float(max_wait_ms), 0.0) / 1000.0
+        self._queue = queue.Queue()
+        self._pending = None
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, image):
+        """Queue one image (H, W, C) and return a Future for its prediction row"""
+        if self._stopped:
+            raise RuntimeError('MicroBatcher has been stopped')
+        future = Future()
+        self._queue.put((image, future, False))
+        return future
+
+    def submit_batch(self, images):
+        """Queue a ready-made batch (N, H, W, C) and return a Future for all N rows"""
+        if self._stopped:
+            raise RuntimeError('MicroBatcher has been stopped')
+        future = Future()
+        self._queue.put((images, future, True))
+        return future
+
+    def predict(self, image, timeout=None):
+        """Blocking helper: submit one image and wait for its prediction row"""
+        return self.submit(image).result(timeout=timeout)
+
+    def predict_batch(self, images, timeout=None):
+        """Blocking helper: submit a whole batch and wait for its predictions"""
+        return self.submit_batch(images).result(timeout=timeout)
+
+    def reserve(self, count, image_shape=None):
+        """Reservation of count uint8 image buffers (release it, e.g. with a with block)"""
+        image_shape = image_shape or self.image_shape
+        if self.buffers is None:
+            return Reservation(self, np.empty((count,) + tuple(image_shape), dtype=np.uint8))
+        return Reservation(self, self.buffers.acquire(count, image_shape), pool=self.buffers)
+
+    def buffer_stats(self):
+        """Allocation counters of the buffer pool"""
+        return self.buffers.stats() if self.buffers is not None else {}
+
+    def queue_depth(self):
+        """Number of images waiting for the next batch"""
+        return self._queue.qsize()
+
+    def stop(self):
+        """Stop the worker thread once the queued images have been served"""
+        self._stopped = True
+        self._queue.put(None)
+        self._thread.join()
+
+    def _collect(self):
+        """Block for the first image, then gather more until the window closes"""
+        if self._pending is not None:
+            first, self._pending = self._pending, None
+        else:
+            first = self._queue.get()
+        if first is None:
+            return None
+        if first[2]:
+            return [first]
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining <= 0:
+                    item = self._queue.get_nowait()
+                else:
+                    item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is None:
+                # Put the sentinel back so the run loop exits after this batch
+                self._queue.put(None)
+                break
+            if item[2]:
+                # Ready-made batches run on their own, right after this one
+                self._pending = item
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            if batch is None:
+                return
+
+            if batch[0][2]:
+                images, future, _ = batch[0]
+                try:
+                    future.set_result(self.predict_fn(images))
+                except Exception as e:
+                    future.set_exception(e)
+                continue
+
+            futures = [future for _, future, _ in batch]
+            images = None
+            try:
+                if self.buffers is not None:
+                    images = self.buffers.acquire(len(batch), batch[0][0].shape)
+                    np.stack([image for image, _, _ in batch], out=images)
+                    predictions = self.predict_fn(images)
+                else:
+                    predictions = self.predict_fn(np.stack([image for image, _, _ in batch]))
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+                continue
+            finally:
+                if images is not None:
+                    self.buffers.release(images)
+
+            for i, future in enumerate(futures):
+                future.set_result(predictions[i])
+
+
+def parse_batch_sizes(value):
+    """Parse a comma-separated list of batch sizes such as '1,8,16'"""
+    return sorted({int(size) for size in value.split(',') if size.strip()})
@@ -0,0 +1,87 @@
+"""
+Benchmark the old (preprocess_input + model.predict) path against the
+inference engines in inference.py and report p50/p99 latency, per-image
+latency and throughput for each batch size.
+
+Usage:
+    python benchmark_inference.py --model model/resnet50_profilepic_no_aug.h5
+    python benchmark_inference.py --model model/resnet50_profilepic   # build_artifact.py directory
+    python benchmark_inference.py --random-weights      # no trained model needed
+    python benchmark_inference.py --random-weights --engines graph,xla
+"""
+import argparse
+import time
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras.applications.resnet50 import preprocess_input
+
+from batching import parse_batch_sizes
+from inference import (build_classifier, create_inference, expects_raw_pixels, input_size, is_artifact,
+                       load_artifact, load_keras_model)
+
+
+def measure(fn, images, iterations, warmup=3):
+    """Per-call latencies in milliseconds"""
+    for _ in range(warmup):
+        fn(images)
+    latencies = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn(images)
+        latencies.append((time.perf_counter() - start) * 1000)
+    return np.array(latencies)
+
+
+def report(name, batch_size, latencies):
+    p50, p99 = np.percentile(latencies, [50, 99])
+    print(f"  {name:<10} batch {batch_size:>3}: p50 {p50:8.2f}ms  p99 {p99:8.2f}ms  "
+          f"per-image {p50 / batch_size:7.2f}ms  {batch_size * 1000 / p50:6.1f} img/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model', help='Keras model (.h5/.keras) or artifact directory')
+    parser.add_argument('--random-weights', action='store_true', help='Benchmark a randomly initialised model')
+    parser.add_argument('--batch-sizes', default='1,8,32')
+    parser.add_argument('--engines', default='predict,graph',
+                        help="Comma-separated paths to compare: predict, graph, xla")
+    parser.add_argument('--iterations', type=int, default=50)
+    args = parser.parse_args()
+
+    if args.model:
+        model = load_artifact(args.model)[0] if is_artifact(args.model) else load_keras_model(args.model)
+    elif args.random_weights:
+        model = build_classifier()
+    else:
+        parser.error('pass --model or --random-weights')
+
+    print(f"TensorFlow: {tf.__version__}")
+    batch_sizes = parse_batch_sizes(args.batch_sizes)
+    image_size = input_size(model) or 224
+    raw_pixels = expects_raw_pixels(model)
+
+    def old_path(images):
+        if raw_pixels:
+            return model.predict(images, verbose=0)
+        return model.predict(preprocess_input(images.astype(np.float32)), verbose=0)
+
+    engines = {}
+    for name in args.engines.split(','):
+        if name == 'predict':
+            engines[name] = old_path
+        else:
+            engine = create_inference(model, name, xla_buckets=batch_sizes)
+            timings = engine.warmup(batch_sizes)
+            print(f"{name} warm-up: " + ", ".join(f"batch {b} {t:.2f}s" for b, t in timings.items()))
+            engines[name] = engine
+
+    for batch_size in batch_sizes:
+        images = np.random.randint(0, 256, size=(batch_size, image_size, image_size, 3), dtype=np.uint8)
+        print(f"\nBatch size {batch_size} ({args.iterations} iterations)")
+        for name, fn in engines.items():
+            report(name, batch_size, measure(fn, images, args.iterations))
+
+
+if __name__ == '__main__':
+    main()
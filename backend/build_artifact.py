@@ -0,0 +1,148 @@
+"""
+Build the canonical, version-pinned model artifact the backend serves.
+
+Replaces the extract_weights.py / fix_keras_model.py / reconstruct_model.py
+workarounds with one step: load the trained classifier however it loads
+(directly or by rebuilding the architecture), fold preprocessing and
+BatchNorm into the convolutions (see fold_model.py), and write a directory
+
+    <output>/manifest.json   architecture config, class names, input spec,
+                             TensorFlow/Keras versions, model version and an
+                             index of every weight tensor
+    <output>/weights.bin     raw little-endian tensors, 64-byte aligned
+
+The backend loads it with MODEL_PATH=<output>: the architecture comes from
+the saved config (no Python rebuild, no h5 parsing) and weights.bin is
+memory-mapped. The model version is a hash of the weights, so it changes
+exactly when the model does and keys the result cache.
+
+Usage:
+    python build_artifact.py --model model/resnet50_profilepic_no_aug.h5 --output model/resnet50_profilepic
+    python build_artifact.py --model model/resnet50_profilepic_no_aug.h5 --output model/resnet50_profilepic --no-fold
+    python build_artifact.py --model model/resnet50_profilepic_no_aug.h5 --output model/resnet50_profilepic_160 --image-size 160
+"""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+from datetime import datetime
+
+import numpy as np
+import tensorflow as tf
+
+from fold_model import DEFAULT_IMAGES, fold_model, sample_images
+from inference import (
+    ARTIFACT_FORMAT, ARTIFACT_MANIFEST, ARTIFACT_WEIGHTS, GraphInference,
+    expects_raw_pixels, load_artifact, load_keras_model, with_input_size
+)
+
+CLASS_NAMES = ['human', 'avatar', 'animal']  # Order from training data
+ALIGNMENT = 64
+
+
+def write_weights(weights, path):
+    """Write tensors back to back (aligned) and return (index, sha256)"""
+    index = []
+    digest = hashlib.sha256()
+    offset = 0
+    with open(path, 'wb') as f:
+        for i, tensor in enumerate(weights):
+            tensor = np.ascontiguousarray(tensor, dtype=tensor.dtype.newbyteorder('<'))
+            padding = (-offset) % ALIGNMENT
+            f.write(b'\0' * padding)
+            offset += padding
+            data = tensor.tobytes()
+            f.write(data)
+            digest.update(data)
+            index.append({
+                'index': i,
+                'shape': list(tensor.shape),
+                'dtype': tensor.dtype.str,
+                'offset': offset,
+                'nbytes': len(data)
+            })
+            offset += len(data)
+    return index, digest.hexdigest()
+
+
+def write_artifact(model, output, name, source_model, version=None, preprocessing=None):
+    """Write model as an artifact directory (replacing output) and return its manifest"""
+    if os.path.exists(output):
+        shutil.rmtree(output)
+    os.makedirs(output)
+
+    image_size = int(model.inputs[0].shape[1])
+    index, weights_hash = write_weights(model.get_weights(), os.path.join(output, ARTIFACT_WEIGHTS))
+    manifest = {
+        'format': ARTIFACT_FORMAT,
+        'name': name,
+        'model_version': version or f'{name}-{weights_hash[:12]}',
+        'weights_sha256': weights_hash,
+        'created': datetime.utcnow().isoformat(),
+        'source_model': source_model,
+        'tensorflow_version': tf.__version__,
+        'keras_version': getattr(tf.keras, '__version__', 'N/A'),
+        'numpy_version': np.__version__,
+        'class_names': CLASS_NAMES,
+        'input': {
+            'shape': [image_size, image_size, 3],
+            'dtype': 'uint8' if expects_raw_pixels(model) else 'float32',
+            'preprocessing': preprocessing or ('folded' if expects_raw_pixels(model) else 'resnet50')
+        },
+        'architecture': json.loads(model.to_json()),
+        'weights': index
+    }
+    with open(os.path.join(output, ARTIFACT_MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=1)
+    return manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model', required=True, help='Trained classifier (.h5 or .keras)')
+    parser.add_argument('--output', required=True, help='Artifact directory to create')
+    parser.add_argument('--name', default='resnet50_profilepic')
+    parser.add_argument('--version', help='Model version (default: <name>-<weights hash>)')
+    parser.add_argument('--no-fold', action='store_true', help='Keep preprocessing and BatchNorm as separate ops')
+    parser.add_argument('--image-size', type=int,
+                        help="Input resolution to build the artifact for, a multiple of 32 (default: the model's)")
+    parser.add_argument('--images', default=DEFAULT_IMAGES, help='Sample images used to verify the artifact')
+    parser.add_argument('--tolerance', type=float, default=1e-4)
+    args = parser.parse_args()
+
+    print(f"TensorFlow: {tf.__version__}")
+    source = load_keras_model(args.model)
+    if args.image_size:
+        source = with_input_size(source, args.image_size)
+    image_size = int(source.inputs[0].shape[1])
+    images = sample_images(args.images, image_size)
+    expected = GraphInference(source, image_size)(images)
+
+    model = source
+    if not args.no_fold and not expects_raw_pixels(source):
+        print("\nFolding preprocessing and BatchNorm...")
+        model = fold_model(source, image_size)
+        print(f"✓ {len(source.layers)} layers -> {len(model.layers)} layers")
+
+    print(f"\nWriting {args.output}...")
+    manifest = write_artifact(model, args.output, args.name, os.path.basename(args.model), version=args.version)
+
+    print("\nVerifying the artifact loads and matches the source model...")
+    timings = {}
+    loaded, _ = load_artifact(args.output, timings=timings)
+    max_diff = float(np.abs(GraphInference(loaded, image_size)(images) - expected).max())
+    print(f"  graph build {timings['graph_build']:.2f}s, weight load {timings['weight_load']:.2f}s, "
+          f"max |Δp| {max_diff:.2e} over {len(images)} images")
+    if max_diff > args.tolerance:
+        shutil.rmtree(args.output)
+        print(f"✗ Artifact differs from the source model by more than {args.tolerance:g}; removed")
+        raise SystemExit(1)
+
+    size_mb = os.path.getsize(os.path.join(args.output, ARTIFACT_WEIGHTS)) / 1e6
+    print(f"\n✓ {manifest['model_version']} written to {args.output} ({size_mb:.1f}MB of weights)")
+    print(f"  Serve it with MODEL_PATH={args.output}" + (f" IMAGE_SIZE={image_size}" if image_size != 224 else ''))
+
+
+if __name__ == '__main__':
+    main()
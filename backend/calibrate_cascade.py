@@ -0,0 +1,144 @@
+"""
+Calibrate the confidence threshold of a cascade screening model (see cascade.py).
+
+Both models classify the labelled profile photos once. The photos are split
+by image hash: the threshold is chosen on one part and the cascade is
+measured on the other (--val-fraction of them), so the reported accuracy and
+escalation rate are not fitted to the photos they are measured on.
+
+Every candidate threshold is scored offline: images the screening model is
+at least that confident about keep its answer, the rest take ResNet50's. The
+chosen threshold is the lowest one whose cascade accuracy on the calibration
+part stays within --max-accuracy-drop of ResNet50 alone - the lowest
+threshold escalates the fewest images. It is written, with the held-out
+escalation rate, accuracy and per-image cost, to the screening model's
+calibration file, which the backend reads when CASCADE_MODEL_PATH points at
+the model.
+
+Usage:
+    python calibrate_cascade.py --model model/resnet50_profilepic --screen model/screen.keras
+    python calibrate_cascade.py --model model/resnet50_profilepic --screen model/screen.keras \\
+        --mapping /mnt/tenant/profile_image_mapping.csv --image-root /mnt/tenant --max-accuracy-drop 0.005
+"""
+import argparse
+import json
+import time
+from datetime import datetime
+
+import numpy as np
+
+from cascade import calibration_path, load_screen_model
+from classify_profiles import DEFAULT_MAPPING, load_engine
+from imaging import image_digest, load_labeled_images, read_image_path
+
+REPORTED_THRESHOLDS = (0.5, 0.6, 0.7, 0.8, 0.85, 0.9, 0.95, 0.98, 0.99)
+
+
+def predict_timed(engine, images, batch_size):
+    """(probabilities, milliseconds per image) at batch_size"""
+    engine(images[:batch_size])  # first call traces the graph
+    started = time.perf_counter()
+    predictions = np.concatenate([
+        np.asarray(engine(images[start:start + batch_size]))
+        for start in range(0, len(images), batch_size)
+    ])
+    return predictions, (time.perf_counter() - started) * 1000 / len(images)
+
+
+def evaluate(threshold, screened, full, labels, screen_ms, full_ms):
+    """Accuracy, agreement with ResNet50, escalation rate and per-image cost of the cascade at threshold"""
+    escalated = screened.max(axis=1) < threshold
+    predicted = np.where(escalated, full.argmax(axis=1), screened.argmax(axis=1))
+    escalation_rate = float(escalated.mean())
+    ms_per_image = screen_ms + escalation_rate * full_ms
+    return {
+        'threshold': float(threshold),
+        'accuracy': float(np.mean(predicted == labels)),
+        'agreement_with_full': float(np.mean(predicted == full.argmax(axis=1))),
+        'escalation_rate': escalation_rate,
+        'ms_per_image': ms_per_image,
+        'expected_speedup': full_ms / ms_per_image
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model', required=True, help='Full model as the backend serves it (MODEL_PATH)')
+    parser.add_argument('--screen', required=True, help='Screening model (artifact directory, .keras/.h5 or .tflite)')
+    parser.add_argument('--mapping', default=DEFAULT_MAPPING, help='profile_image_mapping.csv')
+    parser.add_argument('--image-root', help='Directory imagePath is relative to (default: the CSV directory)')
+    parser.add_argument('--max-accuracy-drop', type=float, default=0.01,
+                        help='Largest accepted accuracy loss versus ResNet50 alone')
+    parser.add_argument('--val-fraction', type=float, default=0.5,
+                        help='Share of photos (by image hash) the calibrated cascade is measured on')
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--limit', type=int, help='Only the first N labelled images')
+    args = parser.parse_args()
+
+    full_engine, class_names, model_version = load_engine(args.model)
+    screen_engine = load_screen_model(args.screen, image_size=full_engine.image_size)
+
+    print(f"Loading labelled images from {args.mapping}...")
+    images, labels, paths = load_labeled_images(args.mapping, class_names, image_root=args.image_root,
+                                                size=full_engine.image_size, limit=args.limit)
+    held_out = np.array([int(image_digest(read_image_path(path))[:8], 16) % 1000 < args.val_fraction * 1000
+                         for path in paths])
+    fit = ~held_out
+    if not fit.any() or not held_out.any():
+        parser.error(f'{len(images)} images cannot be split into calibration and held-out photos '
+                     f'(--val-fraction {args.val_fraction})')
+    print(f"✓ {len(images)} images: {int(fit.sum())} to calibrate on, {int(held_out.sum())} held out")
+
+    full, full_ms = predict_timed(full_engine, images, args.batch_size)
+    screened, screen_ms = predict_timed(screen_engine, images, args.batch_size)
+    print(f"Full model:   held-out accuracy {float(np.mean(full.argmax(axis=1)[held_out] == labels[held_out])):.3f}, "
+          f"{full_ms:.2f}ms/image")
+    print(f"Screen model: held-out accuracy {float(np.mean(screened.argmax(axis=1)[held_out] == labels[held_out])):.3f}, "
+          f"{screen_ms:.2f}ms/image")
+
+    # Every distinct screening confidence is a threshold where the cascade changes,
+    # plus one above them all (everything escalated)
+    fit_full_accuracy = float(np.mean(full.argmax(axis=1)[fit] == labels[fit]))
+    candidates = np.append(np.unique(screened[fit].max(axis=1)), np.nextafter(np.float32(1), np.float32(2)))
+    chosen_threshold = next(
+        t for t in candidates
+        if fit_full_accuracy - evaluate(t, screened[fit], full[fit], labels[fit], screen_ms, full_ms)['accuracy']
+        <= args.max_accuracy_drop)
+
+    # Everything reported from here on is measured on the held-out photos
+    screened, full, labels = screened[held_out], full[held_out], labels[held_out]
+    full_accuracy = float(np.mean(full.argmax(axis=1) == labels))
+    chosen = evaluate(chosen_threshold, screened, full, labels, screen_ms, full_ms)
+
+    print("\n  Held-out photos:")
+    print(f"  {'threshold':>9}  {'accuracy':>8}  {'agreement':>9}  {'escalated':>9}  {'ms/image':>8}  {'speedup':>7}")
+    for threshold in sorted(set(REPORTED_THRESHOLDS) | {chosen['threshold']}):
+        r = evaluate(threshold, screened, full, labels, screen_ms, full_ms)
+        marker = ' <-' if threshold == chosen['threshold'] else ''
+        print(f"  {threshold:>9.4f}  {r['accuracy']:>8.3f}  {r['agreement_with_full']:>9.3f}  "
+              f"{r['escalation_rate']:>9.1%}  {r['ms_per_image']:>8.2f}  {r['expected_speedup']:>6.2f}x{marker}")
+
+    calibration = {
+        **chosen,
+        'full_model': model_version,
+        'full_accuracy': full_accuracy,
+        'full_ms_per_image': full_ms,
+        'screen_ms_per_image': screen_ms,
+        'max_accuracy_drop': args.max_accuracy_drop,
+        'calibration_images': int(fit.sum()),
+        'evaluation_images': int(held_out.sum()),
+        'created': datetime.utcnow().isoformat()
+    }
+    path = calibration_path(args.screen)
+    with open(path, 'w') as f:
+        json.dump(calibration, f, indent=2)
+    print(f"\n✓ Threshold {chosen['threshold']:.4f}: held-out accuracy {chosen['accuracy']:.3f} "
+          f"(drop {full_accuracy - chosen['accuracy']:+.3f}), {chosen['escalation_rate']:.1%} escalated, "
+          f"{chosen['expected_speedup']:.2f}x expected speedup")
+    print(f"Calibration written to {path}")
+    if chosen['escalation_rate'] == 1.0:
+        print("⚠ Every image is escalated at this accuracy budget; the screening model does not pay for itself")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+"""
+Two-stage classification: a small screening model answers the easy images
+and only the uncertain ones go on to ResNet50.
+
+Most profile photos are easy calls, but every one used to pay for a full
+ResNet50 forward pass (about 4 GFLOPs). With CASCADE_MODEL_PATH set, every
+batch goes through the screening model first - a small CNN like the ones in
+create_simple_model.py, distilled or trained on the same classes. Images
+whose top screening probability reaches the threshold keep that answer; the
+rest of the batch is escalated to the full model. The response's 'stage' says
+which one answered.
+
+The threshold is calibrated offline with calibrate_cascade.py. It is the
+lowest confidence at which the cascade stays within an accuracy budget of
+ResNet50 on labelled photos. The result is written to the screening
+model's calibration file (see calibration_path), which the backend reads.
+CASCADE_THRESHOLD overrides it.
+
+Results leave the model with one extra column holding the stage (0 screen,
+1 full), so they fit through the inference pool's ring buffer unchanged.
+"""
+import json
+import os
+
+import numpy as np
+
+STAGE_NAMES = ('screen', 'full')
+SCREEN, FULL = 0, 1
+CALIBRATION_FILE = 'cascade.json'
+
+
+def calibration_path(model_path):
+    """Calibration file of a screening model: cascade.json inside an artifact directory, else <model>.cascade.json"""
+    if os.path.isdir(model_path):
+        return os.path.join(model_path, CALIBRATION_FILE)
+    return f'{model_path}.{CALIBRATION_FILE}'
+
+
+def read_calibration(model_path):
+    """The calibration calibrate_cascade.py wrote for a screening model, or None"""
+    try:
+        with open(calibration_path(model_path)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def load_screen_model(model_path, image_size=224):
+    """Inference engine for a screening model (artifact directory, .keras/.h5 or .tflite)"""
+    import tensorflow as tf
+    from inference import ScreenInference, TFLiteInference, is_artifact, load_artifact
+
+    if model_path.endswith('.tflite'):
+        engine = TFLiteInference(model_path)
+        if engine.image_size != image_size:
+            raise ValueError(f'{model_path} takes {engine.image_size}px images; TFLite screening models '
+                             f'must take the served size ({image_size}px)')
+        return engine
+    if is_artifact(model_path):
+        model = load_artifact(model_path)[0]
+    else:
+        model = tf.keras.models.load_model(model_path, compile=False)
+    return ScreenInference(model, image_size=image_size)
+
+
+def split_stages(outputs):
+    """(probabilities, stage name per row) of cascade outputs"""
+    outputs = np.asarray(outputs)
+    return outputs[:, :-1], [STAGE_NAMES[int(stage)] for stage in outputs[:, -1]]
+
+
+class Cascade:
+    """screen_fn on every image, full_fn on the ones screened below threshold.
+
+    Returns (N, classes + 1) rows: probabilities, then the stage that answered.
+    """
+
+    def __init__(self, screen_fn, full_fn, threshold):
+        self.screen_fn = screen_fn
+        self.full_fn = full_fn
+        self.threshold = float(threshold)
+
+    def __call__(self, images):
+        screened = np.asarray(self.screen_fn(images), dtype=np.float32)
+        outputs = np.empty((len(screened), screened.shape[1] + 1), dtype=np.float32)
+        outputs[:, :-1] = screened
+        outputs[:, -1] = SCREEN
+        escalated = np.flatnonzero(screened.max(axis=1) < self.threshold)
+        if len(escalated):
+            outputs[escalated, :-1] = self.full_fn(images[escalated])
+            outputs[escalated, -1] = FULL
+        return outputs
+
+    def warmup(self, batch_sizes):
+        timings = self.screen_fn.warmup(batch_sizes or getattr(self.full_fn, 'buckets', [1]))
+        for size, seconds in self.full_fn.warmup(batch_sizes).items():
+            timings[size] = timings.get(size, 0.0) + seconds
+        return timings
@@ -0,0 +1,195 @@
+"""
+Classify every profile in profile_image_mapping.csv offline, without the web app.
+
+For whole tenants this replaces /api/classify/all-profiles, which downloads,
+base64-encodes and POSTs one image at a time. The mapping is streamed,
+imagePath is resolved against a local or mounted image root, and photos
+flow through
+
+    decode threads (all cores) -> batched inference -> incremental CSV/JSONL writer
+
+The next batches are decoded straight into reused batch buffers
+(batching.BufferPool) while the current one runs through the model, and
+results are written and flushed batch by batch in mapping order, so memory
+stays flat however big the tenant is and an interrupted run keeps what it
+has written. Profiles without a photo are written as 'no_pic', photos that
+are missing or fail to decode with an error.
+
+Usage:
+    python classify_profiles.py --model model/resnet50_profilepic --output classifications.csv
+    python classify_profiles.py --model model/resnet50_profilepic --output classifications.jsonl \\
+        --mapping /mnt/tenant/profile_image_mapping.csv --image-root /mnt/tenant
+"""
+import argparse
+import csv
+import itertools
+import json
+import os
+import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from batching import BufferPool
+from imaging import decode_image, read_image_path, read_profile_mapping
+
+CLASS_NAMES = ['human', 'avatar', 'animal']  # Order from training data
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_MAPPING = os.path.join(REPO_ROOT, 'profile_images', 'profile_image_mapping.csv')
+PROFILE_FIELDS = ['userId', 'displayName', 'userPrincipalName', 'imageType', 'imagePath']
+
+
+def load_engine(model_path, engine='graph', threads=None):
+    """Inference engine, class names and model version for a model path, as the backend serves it"""
+    from inference import TFLiteInference, create_inference, is_artifact, load_artifact, load_keras_model
+
+    if is_artifact(model_path):
+        model, manifest = load_artifact(model_path)
+        return create_inference(model, engine), manifest['class_names'], manifest['model_version']
+    if model_path.endswith('.tflite'):
+        return TFLiteInference(model_path, num_threads=threads), CLASS_NAMES, os.path.basename(model_path)
+    return create_inference(load_keras_model(model_path), engine), CLASS_NAMES, os.path.basename(model_path)
+
+
+class ResultWriter:
+    """Appends one record per profile (or per fields) to a CSV or JSON Lines file"""
+
+    def __init__(self, path, class_names, fields=PROFILE_FIELDS):
+        self.jsonl = path.endswith(('.jsonl', '.ndjson'))
+        self._file = open(path, 'w', newline='', encoding='utf-8')
+        if not self.jsonl:
+            fields = list(fields) + ['classification', 'confidence'] + list(class_names) + ['error']
+            self._csv = csv.DictWriter(self._file, fieldnames=fields, extrasaction='ignore')
+            self._csv.writeheader()
+
+    def write(self, record):
+        if self.jsonl:
+            self._file.write(json.dumps(record) + '\n')
+        else:
+            row = dict(record)
+            row.update(row.pop('all_predictions', None) or {})
+            self._csv.writerow(row)
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def decode_file(path, out, draft=True):
+    decode_image(read_image_path(path), size=out.shape[0], out=out, draft=draft)
+
+
+def classify_batch(engine, class_names, rows, images, futures):
+    """Wait for a batch's decodes, run the decoded photos and return a record per row"""
+    records = [{field: row.get(field, '') for field in PROFILE_FIELDS} for row in rows]
+    decoded = []
+    for i, (row, future) in enumerate(zip(rows, futures)):
+        if future is None:
+            records[i]['classification'] = 'no_pic'
+            continue
+        try:
+            future.result()
+            decoded.append(i)
+        except Exception as e:
+            records[i]['error'] = f'Error processing image: {e}'
+
+    if decoded:
+        batch = images if len(decoded) == len(rows) else images[decoded]
+        try:
+            predictions = np.asarray(engine(batch))
+        except Exception as e:
+            for i in decoded:
+                records[i]['error'] = f'Error classifying image: {e}'
+            return records
+        for i, prediction in zip(decoded, predictions):
+            index = int(np.argmax(prediction))
+            records[i]['classification'] = class_names[index]
+            records[i]['confidence'] = float(prediction[index])
+            records[i]['all_predictions'] = {name: float(p) for name, p in zip(class_names, prediction)}
+    return records
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model', required=True, help='Model artifact directory, .tflite, .h5 or .keras')
+    parser.add_argument('--output', required=True, help='Results file (.csv, or .jsonl for JSON Lines)')
+    parser.add_argument('--mapping', default=DEFAULT_MAPPING, help='profile_image_mapping.csv')
+    parser.add_argument('--image-root', help='Directory imagePath is relative to (default: the CSV directory)')
+    parser.add_argument('--engine', default='graph', choices=['graph', 'xla'])
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 4, help='Decode threads')
+    parser.add_argument('--prefetch', type=int, default=2, help='Batches decoded ahead of the model')
+    parser.add_argument('--full-decode', action='store_true', help='Decode JPEGs at full size before resizing')
+    parser.add_argument('--limit', type=int, help='Only the first N profiles')
+    args = parser.parse_args()
+
+    print(f"Loading model from {args.model}...")
+    engine, class_names, model_version = load_engine(args.model, args.engine, threads=os.cpu_count())
+    image_size = getattr(engine, 'image_size', 224)
+    print(f"✓ {model_version} ({args.engine if not args.model.endswith('.tflite') else 'tflite'} engine)")
+
+    rows = read_profile_mapping(args.mapping, args.image_root)
+    if args.limit:
+        rows = itertools.islice(rows, args.limit)
+
+    buffers = BufferPool((image_size, image_size, 3), max_free=args.prefetch + 1)
+    decode_pool = ThreadPoolExecutor(max_workers=args.workers, thread_name_prefix='decode')
+    writer = ResultWriter(args.output, class_names)
+    counts = Counter()
+    photos = 0
+    started = last_report = time.perf_counter()
+
+    def submit(chunk):
+        images = buffers.acquire(len(chunk), (image_size, image_size, 3))
+        futures = [
+            decode_pool.submit(decode_file, row['path'], image, not args.full_decode) if row['path'] else None
+            for row, image in zip(chunk, images)
+        ]
+        return chunk, images, futures
+
+    def finish(chunk, images, futures):
+        nonlocal photos, last_report
+        try:
+            records = classify_batch(engine, class_names, chunk, images, futures)
+        finally:
+            buffers.release(images)
+        for record in records:
+            writer.write(record)
+            counts['error' if 'error' in record else record['classification']] += 1
+        writer.flush()
+        photos += sum(1 for future in futures if future is not None)
+        if time.perf_counter() - last_report >= 10:
+            last_report = time.perf_counter()
+            elapsed = last_report - started
+            print(f"  {sum(counts.values())} profiles, {photos / elapsed:.1f} photos/s", flush=True)
+
+    print(f"\nClassifying {args.mapping} -> {args.output} "
+          f"(batch {args.batch_size}, {args.workers} decode threads)...")
+    pending = deque()
+    try:
+        while True:
+            chunk = list(itertools.islice(rows, args.batch_size))
+            if not chunk:
+                break
+            pending.append(submit(chunk))
+            if len(pending) > args.prefetch:
+                finish(*pending.popleft())
+        while pending:
+            finish(*pending.popleft())
+    finally:
+        writer.close()
+        decode_pool.shutdown(cancel_futures=True)
+
+    elapsed = time.perf_counter() - started
+    print(f"\n✓ {sum(counts.values())} profiles in {elapsed:.1f}s ({photos / max(elapsed, 1e-9):.1f} photos/s)")
+    for name, count in counts.most_common():
+        print(f"  {name}: {count}")
+    if counts['error']:
+        print(f"⚠ {counts['error']} profiles could not be classified (see the error column)")
+
+
+if __name__ == '__main__':
+    main()
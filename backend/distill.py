@@ -0,0 +1,398 @@
+"""
+Distill the ResNet50 classifier into a compact student model for CPU serving.
+
+ResNet50 (25M parameters, ~4 GFLOPs per image) is far more network than
+three classes need. Here the served classifier is the teacher: its
+probabilities on every local photo are the soft labels, and a MobileNet-class
+student (or the small CNN from create_simple_model.py) learns to match them
+on CPU:
+
+    profile_images/images (+ --images dirs) -> decode once -> teacher soft labels (cached)
+      -> student training (temperature-softened KL, plus cross-entropy on imageType labels)
+      -> artifact directory (build_artifact.py format) + distill_report.json
+
+Soft labels are cached per image hash and teacher version under --cache-dir,
+so later runs - another architecture, resolution or more images - only run
+the teacher on photos it has not seen. Unlabelled photos are fine: they
+carry the teacher's soft labels only. A fixed share of the photos, chosen by
+image hash, is held out. The student is compared on it with the teacher.
+
+The student takes the same uint8 224px RGB batches as the served model and
+resizes them to --resolution and preprocesses them in its own graph. It is
+served with MODEL_PATH=<output>, or as a cascade screening model with
+CASCADE_MODEL_PATH=<output> (see cascade.py). The report next to it gives
+accuracy, agreement with the teacher, size and latency of both.
+
+Usage:
+    python distill.py --teacher model/resnet50_profilepic --output model/student_mobilenetv3
+    python distill.py --teacher model/resnet50_profilepic --output model/student_simple --arch simple \\
+        --images ../profile_images/images /mnt/photos --resolution 128 --weights none
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras import layers, models
+
+from build_artifact import write_artifact
+from classify_profiles import DEFAULT_MAPPING, load_engine
+from export_tflite import latency_ms
+from fold_model import DEFAULT_IMAGES
+from imaging import decode_image, image_digest, read_image_path, read_profile_mapping
+from inference import ARTIFACT_WEIGHTS, GraphInference, is_artifact, load_artifact
+
+ARCHITECTURES = ('mobilenetv3small', 'mobilenetv2', 'simple')
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp')
+REPORT_FILE = 'distill_report.json'
+SERVED_SIZE = 224
+
+
+def build_student(arch, resolution, class_count, alpha=0.75, weights=None, dropout=0.2, served_size=SERVED_SIZE):
+    """Student taking uint8 (served_size, served_size, 3) RGB, resizing to resolution in its graph"""
+    inputs = layers.Input(shape=(served_size, served_size, 3), dtype='uint8', name='images')
+    x = layers.Rescaling(1.0, name='to_float')(inputs)
+    if resolution != served_size:
+        x = layers.Resizing(resolution, resolution, antialias=True, name='resize')(x)
+    shape = (resolution, resolution, 3)
+    if arch == 'mobilenetv3small':
+        # include_preprocessing: the network takes 0-255 pixels
+        x = tf.keras.applications.MobileNetV3Small(input_shape=shape, include_top=False, weights=weights,
+                                                   alpha=alpha, pooling='avg', include_preprocessing=True)(x)
+    elif arch == 'mobilenetv2':
+        x = layers.Rescaling(1 / 127.5, offset=-1, name='preprocess')(x)
+        x = tf.keras.applications.MobileNetV2(input_shape=shape, include_top=False, weights=weights,
+                                              alpha=alpha, pooling='avg')(x)
+    elif arch == 'simple':
+        # The small CNN of create_simple_model.py
+        x = layers.Rescaling(1 / 255, name='preprocess')(x)
+        x = layers.Conv2D(32, 3, activation='relu')(x)
+        x = layers.MaxPooling2D()(x)
+        x = layers.Conv2D(64, 3, activation='relu')(x)
+        x = layers.MaxPooling2D()(x)
+        x = layers.Conv2D(128, 3, activation='relu')(x)
+        x = layers.GlobalAveragePooling2D()(x)
+        x = layers.Dense(128, activation='relu')(x)
+    else:
+        raise ValueError(f"Unknown architecture '{arch}' (choose from {', '.join(ARCHITECTURES)})")
+    x = layers.Dropout(dropout)(x)
+    logits = layers.Dense(class_count, name='logits')(x)
+    outputs = layers.Activation('softmax', name='probabilities')(logits)
+    return models.Model(inputs, outputs, name=f'student_{arch}_{resolution}')
+
+
+def find_images(mapping, image_root, image_dirs, class_names):
+    """{path: class index or -1} of the mapped profile photos and every image under image_dirs"""
+    found = {}
+    for directory in image_dirs:
+        for root, _, names in os.walk(directory):
+            for name in sorted(names):
+                if name.lower().endswith(IMAGE_EXTENSIONS):
+                    found[os.path.abspath(os.path.join(root, name))] = -1
+    if mapping and os.path.exists(mapping):
+        for row in read_profile_mapping(mapping, image_root):
+            if row['path'] and os.path.exists(row['path']):
+                label = row.get('imageType')
+                found[os.path.abspath(row['path'])] = class_names.index(label) if label in class_names else -1
+    return found
+
+
+def decode_all(paths, workers, size=SERVED_SIZE):
+    """Decode every photo once into a disk-backed uint8 array.
+
+    Returns (images, image hashes, kept path indices); unreadable files and
+    duplicate photos are dropped.
+    """
+    images = np.memmap(tempfile.TemporaryFile(), dtype=np.uint8, mode='w+', shape=(max(len(paths), 1), size, size, 3))
+
+    def decode(i):
+        payload = read_image_path(paths[i])
+        decode_image(payload, size, out=images[i])
+        return image_digest(payload)
+
+    digests, kept, seen = [], [], set()
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='decode') as pool:
+        for i, future in enumerate([pool.submit(decode, i) for i in range(len(paths))]):
+            try:
+                digest = future.result()
+            except Exception as e:
+                print(f"⚠ Skipping {paths[i]}: {e}")
+                continue
+            if digest in seen:
+                continue
+            seen.add(digest)
+            digests.append(digest)
+            kept.append(i)
+    return images, digests, np.array(kept, dtype=np.int64)
+
+
+def teacher_soft_labels(engine, teacher_version, images, rows, digests, cache_dir, batch_size=32):
+    """Teacher probabilities for images[rows], from the cache where the teacher has seen the photo"""
+    cache_path = os.path.join(cache_dir, f'teacher-{teacher_version}.npz')
+    cached = {}
+    if os.path.exists(cache_path):
+        with np.load(cache_path) as data:
+            cached = dict(zip(data['digests'].tolist(), data['probabilities']))
+
+    missing = [i for i, digest in enumerate(digests) if digest not in cached]
+    for start in range(0, len(missing), batch_size):
+        batch = missing[start:start + batch_size]
+        for i, probabilities in zip(batch, np.asarray(engine(images[rows[batch]]))):
+            cached[digests[i]] = probabilities
+    if missing:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = cache_path + '.tmp.npz'
+        np.savez(tmp_path, digests=np.array(list(cached)), probabilities=np.stack(list(cached.values())))
+        os.replace(tmp_path, cache_path)
+    print(f"✓ Teacher soft labels: {len(digests) - len(missing)} cached, {len(missing)} computed -> {cache_path}")
+    return np.stack([cached[digest] for digest in digests]).astype(np.float32)
+
+
+def train_student(model, images, rows, soft, labels, val, epochs=30, batch_size=32, learning_rate=1e-3,
+                  temperature=4.0, hard_weight=0.3, patience=5, seed=0):
+    """Fit the student's logits to the teacher's temperature-softened probabilities.
+
+    The loss is T^2 * KL(teacher_T || student_T), plus hard_weight times the
+    cross-entropy on the labelled photos (label -1 means unlabelled). Stops
+    when the held-out distillation loss has not improved for patience epochs
+    and keeps the best weights. Returns the per-epoch history.
+    """
+    logits_model = models.Model(model.input, model.get_layer('logits').output)
+    optimizer = tf.keras.optimizers.Adam(learning_rate)
+    teacher_logits = np.log(np.clip(soft, 1e-7, 1.0)).astype(np.float32)
+    rng = np.random.RandomState(seed)
+    train = np.flatnonzero(~val)
+
+    def losses(student_logits, targets, y):
+        soft_targets = tf.nn.softmax(targets / temperature)
+        kl = tf.reduce_sum(
+            soft_targets * (tf.math.log(soft_targets + 1e-7) - tf.nn.log_softmax(student_logits / temperature)),
+            axis=1
+        ) * temperature ** 2
+        labelled = y >= 0
+        ce = tf.nn.sparse_softmax_cross_entropy_with_logits(tf.maximum(y, 0), student_logits)
+        ce = tf.where(labelled, ce, tf.zeros_like(ce))
+        return kl, ce
+
+    @tf.function
+    def train_step(x, targets, y):
+        x = tf.image.random_flip_left_right(x)
+        with tf.GradientTape() as tape:
+            kl, ce = losses(logits_model(x, training=True), targets, y)
+            loss = tf.reduce_mean(kl) + hard_weight * tf.reduce_mean(ce)
+        variables = logits_model.trainable_variables
+        optimizer.apply_gradients(zip(tape.gradient(loss, variables), variables))
+        return loss
+
+    def evaluate(indices):
+        kl_total, agree, correct, labelled = 0.0, 0, 0, 0
+        for start in range(0, len(indices), batch_size):
+            batch = indices[start:start + batch_size]
+            student_logits = logits_model(images[rows[batch]], training=False)
+            kl, _ = losses(student_logits, teacher_logits[batch], labels[batch])
+            kl_total += float(tf.reduce_sum(kl))
+            predicted = np.argmax(student_logits, axis=1)
+            agree += int(np.sum(predicted == soft[batch].argmax(axis=1)))
+            correct += int(np.sum((predicted == labels[batch]) & (labels[batch] >= 0)))
+            labelled += int(np.sum(labels[batch] >= 0))
+        return kl_total / max(len(indices), 1), agree / max(len(indices), 1), correct / labelled if labelled else None
+
+    held_out = np.flatnonzero(val)
+    monitor = held_out if len(held_out) else train
+    best = (np.inf, model.get_weights())  # the initial weights, if no epoch has a finite held-out loss
+    history = []
+    stale = 0
+    for epoch in range(1, epochs + 1):
+        started = time.perf_counter()
+        order = rng.permutation(train)
+        train_loss = 0.0
+        for start in range(0, len(order), batch_size):
+            batch = np.sort(order[start:start + batch_size])  # sorted reads from the memmap
+            loss = train_step(tf.constant(images[rows[batch]]), tf.constant(teacher_logits[batch]),
+                              tf.constant(labels[batch]))
+            train_loss += float(loss) * len(batch)
+        val_loss, agreement, accuracy = evaluate(monitor)
+        history.append({
+            'epoch': epoch,
+            'train_loss': round(train_loss / len(order), 4),
+            'val_loss': round(val_loss, 4),
+            'val_agreement': round(agreement, 4),
+            'val_accuracy': None if accuracy is None else round(accuracy, 4),
+            'seconds': round(time.perf_counter() - started, 1)
+        })
+        print(f"  epoch {epoch:>3}: train loss {train_loss / len(order):.4f}, held-out loss {val_loss:.4f}, "
+              f"agreement {agreement:.3f}" + ('' if accuracy is None else f", accuracy {accuracy:.3f}")
+              + f" ({history[-1]['seconds']:.1f}s)")
+        if val_loss < best[0]:
+            best = (val_loss, model.get_weights())
+            stale = 0
+        else:
+            stale += 1
+            if stale >= patience:
+                print(f"  no improvement for {patience} epochs, stopping")
+                break
+    if not np.isfinite(best[0]):
+        print("⚠ No epoch had a finite held-out loss; keeping the initial weights", flush=True)
+    model.set_weights(best[1])
+    return history
+
+
+def throughput(engine, images, batch_size=16, repeats=3):
+    """Images per second at batch_size"""
+    batch = images[:batch_size]
+    engine(batch)
+    started = time.perf_counter()
+    for _ in range(repeats):
+        engine(batch)
+    return len(batch) * repeats / (time.perf_counter() - started)
+
+
+def model_size_mb(path):
+    """Size of a served model: an artifact's weights.bin, or the file"""
+    if is_artifact(path):
+        return os.path.getsize(os.path.join(path, ARTIFACT_WEIGHTS)) / 1e6
+    return os.path.getsize(path) / 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--teacher', required=True, help='Served classifier (artifact directory, .h5/.keras or .tflite)')
+    parser.add_argument('--output', required=True, help='Student artifact directory to create')
+    parser.add_argument('--arch', default='mobilenetv3small', choices=ARCHITECTURES)
+    parser.add_argument('--resolution', type=int, default=160, help='Student input size; 224px batches are resized in-graph')
+    parser.add_argument('--alpha', type=float, default=0.75, help='MobileNet width multiplier')
+    parser.add_argument('--weights', default='imagenet', help="MobileNet initial weights: 'imagenet' or 'none'")
+    parser.add_argument('--name', help='Artifact name (default: student_<arch>_<resolution>)')
+    parser.add_argument('--mapping', default=DEFAULT_MAPPING, help='profile_image_mapping.csv (imageType is the label)')
+    parser.add_argument('--image-root', help='Directory imagePath is relative to (default: the CSV directory)')
+    parser.add_argument('--images', nargs='*', default=[DEFAULT_IMAGES],
+                        help='Directories of further (unlabelled) training photos, searched recursively')
+    parser.add_argument('--cache-dir', default=os.path.join('model', 'distill_cache'), help='Teacher soft label cache')
+    parser.add_argument('--epochs', type=int, default=30)
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--learning-rate', type=float, default=1e-3)
+    parser.add_argument('--temperature', type=float, default=4.0, help='Softmax temperature of the distillation loss')
+    parser.add_argument('--hard-weight', type=float, default=0.3, help='Weight of the cross-entropy on imageType labels')
+    parser.add_argument('--patience', type=int, default=5, help='Epochs without held-out improvement before stopping')
+    parser.add_argument('--val-fraction', type=float, default=0.2, help='Share of photos held out (by image hash)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 4, help='Decoding threads')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--max-accuracy-drop', type=float,
+                        help='Exit with an error if held-out accuracy falls more than this below the teacher')
+    args = parser.parse_args()
+    if args.epochs < 1:
+        parser.error('--epochs must be at least 1')
+    if not 0 <= args.val_fraction < 1:
+        parser.error('--val-fraction must be in [0, 1)')
+
+    started = time.perf_counter()
+    tf.keras.utils.set_random_seed(args.seed)
+    print(f"TensorFlow: {tf.__version__}")
+    print(f"Loading teacher from {args.teacher}...")
+    teacher, class_names, teacher_version = load_engine(args.teacher)
+
+    found = find_images(args.mapping, args.image_root, args.images, class_names)
+    if not found:
+        parser.error('No training photos found')
+    paths = list(found)
+    print(f"Decoding {len(paths)} photos...")
+    images, digests, rows = decode_all(paths, args.workers)
+    labels = np.array([found[paths[i]] for i in rows], dtype=np.int32)
+    val = np.array([int(digest[:8], 16) % 1000 < args.val_fraction * 1000 for digest in digests])
+    print(f"✓ {len(digests)} distinct photos, {int(np.sum(labels >= 0))} labelled, {int(val.sum())} held out")
+    if val.all():
+        parser.error(f'--val-fraction {args.val_fraction} holds out all {len(digests)} photos; nothing is left to train on')
+
+    soft = teacher_soft_labels(teacher, teacher_version, images, rows, digests, args.cache_dir)
+
+    weights = None if args.weights.lower() == 'none' else args.weights
+    student = build_student(args.arch, args.resolution, len(class_names), alpha=args.alpha, weights=weights)
+    print(f"\nTraining {student.name} ({student.count_params():,} parameters) on {int((~val).sum())} photos...")
+    history = train_student(student, images, rows, soft, labels, val, epochs=args.epochs,
+                            batch_size=args.batch_size, learning_rate=args.learning_rate,
+                            temperature=args.temperature, hard_weight=args.hard_weight,
+                            patience=args.patience, seed=args.seed)
+
+    name = args.name or student.name
+    manifest = write_artifact(student, args.output, name, f'distilled from {teacher_version}',
+                              preprocessing=f'{args.arch} (in-graph, {args.resolution}px)')
+    served, _ = load_artifact(args.output)
+    engine = GraphInference(served)
+
+    # Teacher and student on the held-out photos (all photos if none are held out)
+    evaluation = np.flatnonzero(val) if val.any() else np.arange(len(digests))
+    student_probabilities = np.concatenate([
+        engine(images[rows[evaluation[start:start + args.batch_size]]])
+        for start in range(0, len(evaluation), args.batch_size)
+    ])
+    teacher_predicted = soft[evaluation].argmax(axis=1)
+    student_predicted = student_probabilities.argmax(axis=1)
+    labelled = labels[evaluation] >= 0
+
+    def accuracy(predicted):
+        return float(np.mean(predicted[labelled] == labels[evaluation][labelled])) if labelled.any() else None
+
+    sample = np.asarray(images[rows[evaluation[:16]]])
+    report = {
+        'student_version': manifest['model_version'],
+        'teacher_version': teacher_version,
+        'created': datetime.utcnow().isoformat(),
+        'architecture': args.arch,
+        'resolution': args.resolution,
+        'alpha': args.alpha if args.arch != 'simple' else None,
+        'initial_weights': args.weights if args.arch != 'simple' else None,
+        'temperature': args.temperature,
+        'hard_weight': args.hard_weight,
+        'training_photos': int((~val).sum()),
+        'evaluation_photos': int(len(evaluation)),
+        'labelled_evaluation_photos': int(labelled.sum()),
+        'agreement_with_teacher': float(np.mean(student_predicted == teacher_predicted)),
+        'teacher': {
+            'accuracy': accuracy(teacher_predicted),
+            'size_mb': model_size_mb(args.teacher),
+            'latency_ms_batch1': latency_ms(teacher, sample[0]),
+            'images_per_second_batch16': throughput(teacher, sample)
+        },
+        'student': {
+            'accuracy': accuracy(student_predicted),
+            'parameters': int(student.count_params()),
+            'size_mb': model_size_mb(args.output),
+            'latency_ms_batch1': latency_ms(engine, sample[0]),
+            'images_per_second_batch16': throughput(engine, sample)
+        },
+        'history': history,
+        'seconds': round(time.perf_counter() - started, 1)
+    }
+    drop = None
+    if report['teacher']['accuracy'] is not None and report['student']['accuracy'] is not None:
+        drop = report['teacher']['accuracy'] - report['student']['accuracy']
+    report['accuracy_drop'] = drop
+    with open(os.path.join(args.output, REPORT_FILE), 'w') as f:
+        json.dump(report, f, indent=2)
+
+    print(f"\n  {'':<8} {'accuracy':>8}  {'size':>8}  {'batch-1':>9}  {'batch-16':>10}")
+    for role in ('teacher', 'student'):
+        r = report[role]
+        shown = 'n/a' if r['accuracy'] is None else f"{r['accuracy']:.3f}"
+        print(f"  {role:<8} {shown:>8}  {r['size_mb']:>6.1f}MB  {r['latency_ms_batch1']:>7.1f}ms  "
+              f"{r['images_per_second_batch16']:>6.1f} img/s")
+    print(f"  agreement with the teacher: {report['agreement_with_teacher']:.3f} on {len(evaluation)} photos")
+    print(f"\n✓ {manifest['model_version']} written to {args.output} (report: {REPORT_FILE})")
+    print(f"  Serve it with MODEL_PATH={args.output}, or screen with it: CASCADE_MODEL_PATH={args.output}")
+
+    if args.max_accuracy_drop is not None:
+        if drop is None:
+            print("✗ No labelled held-out photos to compare the accuracy on")
+            raise SystemExit(1)
+        if drop > args.max_accuracy_drop:
+            print(f"✗ The student lost {drop:.3f} accuracy (more than {args.max_accuracy_drop:.3f})")
+            raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,265 @@
+"""
+Persistent store of the pooled ResNet50 embedding of every classified image.
+
+The served classifier is a frozen ResNet50 base (about 4 GFLOPs per image)
+followed by GlobalAveragePooling2D and a tiny dense head. With
+EMBEDDING_DIR set, the backend runs only the base in the model, keeps the
+2048-d pooled output of each image here, keyed by the image's content hash,
+and applies the head itself (DenseHead, plain numpy). An image whose
+embedding is stored is never decoded or run through the base again, and a
+new head - a retrained one, or dense_4/dense_5 from a weights file as in
+build_inference_model.py - reclassifies a whole tenant from this file in
+seconds (see reclassify.py).
+
+Layout, under EMBEDDING_DIR/<base version>/ (embeddings are only valid for
+the base weights that produced them):
+
+    meta.json       dimension, dtype and the base model version
+    embeddings.bin  fixed-size records: 32-byte SHA-256 of the image + float16[dim]
+    heads/          heads saved by the backend (<version>.npz)
+
+Records are only ever appended, by whole records under an exclusive flock,
+so every gunicorn worker can write to the same file, and readers memory-map
+it. float16 halves the size of float32 (4 KB per image) and the head's
+output changes by far less than the model's own rounding.
+"""
+import fcntl
+import hashlib
+import json
+import os
+import threading
+
+import numpy as np
+
+EMBEDDING_DIM = 2048
+DIGEST_SIZE = 32
+META_FILE = 'meta.json'
+DATA_FILE = 'embeddings.bin'
+HEADS_DIR = 'heads'
+HEAD_FORMAT = 1
+
+
+def weights_digest(weights):
+    """Short SHA-256 over a list of numpy weight arrays (shapes included)"""
+    digest = hashlib.sha256()
+    for tensor in weights:
+        tensor = np.ascontiguousarray(tensor)
+        digest.update(str(tensor.shape).encode())
+        digest.update(tensor.tobytes())
+    return digest.hexdigest()[:16]
+
+
+def base_version(base_weights, built_size=None, image_size=None):
+    """Name of a base model's store: base-<weights hash>, plus -<size>px when it is served at
+    another input size than it was built for (the embeddings differ with the resolution)"""
+    version = 'base-' + weights_digest(base_weights)
+    if image_size and built_size not in (None, image_size):
+        version += f'-{image_size}px'
+    return version
+
+
+def softmax(x):
+    e = np.exp(x - x.max(axis=-1, keepdims=True))
+    return e / e.sum(axis=-1, keepdims=True)
+
+
+ACTIVATIONS = {
+    'linear': lambda x: x,
+    'relu': lambda x: np.maximum(x, 0),
+    'softmax': softmax
+}
+
+
+class DenseHead:
+    """The layers after the pooling: (kernel, bias, activation) Dense layers, run in numpy.
+
+    Dropout is the identity at inference time, so it has no layer here.
+    """
+
+    def __init__(self, layers):
+        self.layers = [(np.asarray(kernel, dtype=np.float32), np.asarray(bias, dtype=np.float32), activation)
+                       for kernel, bias, activation in layers]
+        for _, _, activation in self.layers:
+            if activation not in ACTIVATIONS:
+                raise ValueError(f"Unsupported head activation '{activation}'")
+        self.version = 'head-' + weights_digest([w for layer in self.layers for w in layer[:2]])
+
+    @property
+    def input_dim(self):
+        return self.layers[0][0].shape[0]
+
+    def __call__(self, embeddings):
+        """Probabilities (N, classes) for embeddings (N, dim), any float dtype"""
+        x = np.asarray(embeddings, dtype=np.float32)
+        for kernel, bias, activation in self.layers:
+            x = ACTIVATIONS[activation](x @ kernel + bias)
+        return x
+
+    def save(self, path):
+        """Write the head as .npz (atomically)"""
+        arrays = {'format': np.array(HEAD_FORMAT), 'activations': np.array([a for _, _, a in self.layers])}
+        for i, (kernel, bias, _) in enumerate(self.layers):
+            arrays[f'kernel_{i}'] = kernel
+            arrays[f'bias_{i}'] = bias
+        with open(path + '.tmp', 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, path):
+        """A head from a .npz written by save(), or from a Keras weights file with dense_4/dense_5 groups"""
+        if path.endswith('.npz'):
+            with np.load(path) as data:
+                if int(data['format']) != HEAD_FORMAT:
+                    raise ValueError(f"Unsupported head format {int(data['format'])} (expected {HEAD_FORMAT})")
+                return cls([(data[f'kernel_{i}'], data[f'bias_{i}'], str(activation))
+                            for i, activation in enumerate(data['activations'])])
+
+        # The trained top layers, as build_inference_model.py reads them
+        import h5py
+        with h5py.File(path, 'r') as f:
+            layers = []
+            for name, activation in (('dense_4', 'relu'), ('dense_5', 'softmax')):
+                if name not in f:
+                    raise ValueError(f'{path} has no {name} weights')
+                group = f[name][name]
+                layers.append((np.array(group['kernel:0']), np.array(group['bias:0']), activation))
+        return cls(layers)
+
+
+class EmbeddingStore:
+    """Append-only float16 embeddings keyed by image SHA-256, memory-mapped for reads"""
+
+    def __init__(self, root, dim=EMBEDDING_DIM, base_version=None):
+        self.root = root
+        self.dim = int(dim)
+        self.record = np.dtype([('digest', f'V{DIGEST_SIZE}'), ('vector', '<f2', (self.dim,))])
+        self.path = os.path.join(root, DATA_FILE)
+        os.makedirs(os.path.join(root, HEADS_DIR), exist_ok=True)
+
+        meta_path = os.path.join(root, META_FILE)
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                meta = json.load(f)
+            if meta['dim'] != self.dim:
+                raise ValueError(f"{root} holds {meta['dim']}-d embeddings, not {self.dim}-d")
+        else:
+            with open(meta_path + '.tmp', 'w') as f:
+                json.dump({'dim': self.dim, 'dtype': 'float16', 'base_version': base_version}, f)
+            os.replace(meta_path + '.tmp', meta_path)
+
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        self._lock = threading.Lock()
+        self._rows = {}  # digest bytes -> record index
+        self._records = None
+        self._count = 0
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        with self._lock:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                # A crash mid-append leaves a partial record at the end
+                size = os.fstat(self._fd).st_size
+                if size % self.record.itemsize:
+                    os.truncate(self.path, size - size % self.record.itemsize)
+                self._refresh()
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _refresh(self):
+        """Map records appended since the last refresh (by any process). Caller holds the locks."""
+        count = os.fstat(self._fd).st_size // self.record.itemsize
+        if count == self._count:
+            return
+        self._records = np.memmap(self.path, dtype=self.record, mode='r', shape=(count,))
+        digests = self._records['digest'][self._count:count]
+        for row, digest in enumerate(digests.tolist(), start=self._count):
+            self._rows.setdefault(digest, row)
+        self._count = count
+
+    def _find(self, digest):
+        """Record index of a digest, re-reading the file once if it has grown. Caller holds the lock."""
+        row = self._rows.get(digest)
+        if row is None and os.fstat(self._fd).st_size // self.record.itemsize != self._count:
+            fcntl.flock(self._fd, fcntl.LOCK_SH)
+            try:
+                self._refresh()
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+            row = self._rows.get(digest)
+        return row
+
+    def get(self, digest):
+        """float32 embedding for a hex SHA-256, or None"""
+        with self._lock:
+            row = self._find(bytes.fromhex(digest))
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return self._records['vector'][row].astype(np.float32)
+
+    def put_many(self, digests, vectors):
+        """Store embeddings (N, dim) for hex digests, skipping ones that are already stored"""
+        vectors = np.asarray(vectors)
+        with self._lock:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                self._refresh()
+                new = {}
+                for digest, vector in zip(digests, vectors):
+                    key = bytes.fromhex(digest)
+                    if key not in self._rows and key not in new:
+                        new[key] = vector
+                if not new:
+                    return 0
+                records = np.empty(len(new), dtype=self.record)
+                records['digest'] = list(new)
+                records['vector'] = np.stack(list(new.values()))
+                data = records.tobytes()
+                written = 0
+                while written < len(data):
+                    written += os.write(self._fd, data[written:])
+                self._refresh()
+                self.writes += len(new)
+                return len(new)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def all(self):
+        """(hex digests, float16 memmap (N, dim)) of everything stored, for bulk reclassification"""
+        with self._lock:
+            fcntl.flock(self._fd, fcntl.LOCK_SH)
+            try:
+                self._refresh()
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+            if self._records is None:
+                return [], np.empty((0, self.dim), dtype=np.float16)
+            return [digest.hex() for digest in self._records['digest'].tolist()], self._records['vector']
+
+    def save_head(self, head):
+        """Save a head next to the embeddings it applies to; returns its path"""
+        path = os.path.join(self.root, HEADS_DIR, f'{head.version}.npz')
+        if not os.path.exists(path):
+            head.save(path)
+        return path
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'path': self.path,
+                'embeddings': self._count,
+                'dim': self.dim,
+                'bytes': self._count * self.record.itemsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'writes': self.writes,
+                'hit_rate': self.hits / lookups if lookups else 0.0
+            }
+
+    def close(self):
+        self._records = None
+        os.close(self._fd)
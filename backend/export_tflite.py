@@ -0,0 +1,185 @@
+"""
+Export the three-class ResNet50 classifier to TensorFlow Lite.
+
+Builds on convert_model.py / build_inference_model.py: the Keras model is
+loaded the same way the backend loads it (rebuilding the architecture if the
+file will not load directly) and exported in up to three variants:
+
+    float32  - plain conversion
+    dynamic  - dynamic-range quantization (int8 weights, float activations)
+    int8     - full integer quantization, calibrated on profile_images/images
+
+Every export takes raw RGB pixels and includes the ResNet50 preprocessing
+(folded models from fold_model.py already do, and are exported as they are),
+so the backend serves it unchanged with MODEL_PATH=<file>.tflite. The
+labelled sample images are split by image hash: int8 is calibrated on one
+part, and every variant is checked against the Keras model on the other
+(--val-fraction of them), so int8 is not measured on its own calibration
+images. The report (size, agreement, accuracy, latency) is written next to
+the files.
+
+Usage:
+    python export_tflite.py --model model/resnet50_profilepic_no_aug.h5
+    python export_tflite.py --model model/resnet50_profilepic_no_aug.h5 --variants int8 --max-accuracy-drop 0.02
+"""
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras.applications.resnet50 import preprocess_input
+
+from imaging import image_digest, load_labeled_images, read_image_path
+from inference import GraphInference, TFLiteInference, expects_raw_pixels, load_keras_model
+
+CLASS_NAMES = ['human', 'avatar', 'animal']  # Order from training data
+VARIANTS = ('float32', 'dynamic', 'int8')
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_MAPPING = os.path.join(REPO_ROOT, 'profile_images', 'profile_image_mapping.csv')
+
+
+def convert(model, variant, calibration_images, image_size=224):
+    """Return the .tflite flatbuffer for one variant"""
+    raw_pixels = expects_raw_pixels(model)
+    if raw_pixels:
+        # Folded model (fold_model.py): already takes uint8 RGB
+        serving_model = model
+    else:
+        # Wrap the classifier so the export takes raw RGB and preprocesses in-graph
+        inputs = tf.keras.Input(shape=(image_size, image_size, 3), name='images')
+        serving_model = tf.keras.Model(inputs, model(preprocess_input(inputs), training=False))
+    converter = tf.lite.TFLiteConverter.from_keras_model(serving_model)
+
+    if variant in ('dynamic', 'int8'):
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+
+    if variant == 'int8':
+        def representative_dataset():
+            for image in calibration_images:
+                yield [image[np.newaxis] if raw_pixels else image[np.newaxis].astype(np.float32)]
+
+        converter.representative_dataset = representative_dataset
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+        if not raw_pixels:
+            # Pixels are 0-255, so a uint8 input calibrates to scale 1 / zero point 0
+            # and the backend can feed decoded images straight in
+            converter.inference_input_type = tf.uint8
+
+    return converter.convert()
+
+
+def predict_in_batches(engine, images, batch_size=16):
+    return np.concatenate([
+        engine(images[start:start + batch_size])
+        for start in range(0, len(images), batch_size)
+    ])
+
+
+def latency_ms(engine, image, iterations=20):
+    """p50 latency of a batch of one"""
+    engine(image[np.newaxis])
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        engine(image[np.newaxis])
+        timings.append((time.perf_counter() - start) * 1000)
+    return float(np.percentile(timings, 50))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model', required=True, help='Keras model (.h5 or .keras)')
+    parser.add_argument('--output-dir', default='model')
+    parser.add_argument('--variants', default=','.join(VARIANTS))
+    parser.add_argument('--mapping', default=DEFAULT_MAPPING, help='profile_image_mapping.csv')
+    parser.add_argument('--image-root', help='Directory imagePath is relative to (default: the CSV directory)')
+    parser.add_argument('--calibration-images', type=int, default=100, help='Most images int8 is calibrated on')
+    parser.add_argument('--val-fraction', type=float, default=0.5,
+                        help='Share of images (by image hash) the variants are checked on, never calibrated on')
+    parser.add_argument('--max-accuracy-drop', type=float, default=0.02,
+                        help='Largest accepted accuracy loss versus the Keras model')
+    args = parser.parse_args()
+
+    variants = [v for v in args.variants.split(',') if v]
+    for variant in variants:
+        if variant not in VARIANTS:
+            parser.error(f"unknown variant '{variant}' (choose from {', '.join(VARIANTS)})")
+
+    print(f"TensorFlow: {tf.__version__}")
+    model = load_keras_model(args.model)
+
+    print(f"\nLoading labelled images from {args.mapping}...")
+    images, labels, paths = load_labeled_images(args.mapping, CLASS_NAMES, image_root=args.image_root)
+    held_out = np.array([int(image_digest(read_image_path(path))[:8], 16) % 1000 < args.val_fraction * 1000
+                         for path in paths])
+    if held_out.all() or not held_out.any():
+        parser.error(f'{len(images)} images cannot be split into calibration and evaluation images '
+                     f'(--val-fraction {args.val_fraction})')
+    calibration_images = images[~held_out][:args.calibration_images]
+    images, labels = images[held_out], labels[held_out]
+    print(f"✓ {len(calibration_images)} images to calibrate int8 on, {len(images)} held out to evaluate on")
+
+    reference = predict_in_batches(GraphInference(model), images)
+    reference_accuracy = float(np.mean(reference.argmax(axis=1) == labels))
+    reference_latency = latency_ms(GraphInference(model), images[0])
+    print(f"Keras model: accuracy {reference_accuracy:.3f}, batch-1 latency {reference_latency:.1f}ms")
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    stem = os.path.splitext(os.path.basename(args.model))[0]
+    report = {
+        'source_model': os.path.abspath(args.model),
+        'tensorflow_version': tf.__version__,
+        'calibration_images': int(len(calibration_images)),
+        'evaluation_images': int(len(images)),
+        'keras': {
+            'accuracy': reference_accuracy,
+            'latency_ms_batch1': reference_latency,
+            'size_mb': os.path.getsize(args.model) / 1e6
+        },
+        'max_accuracy_drop': args.max_accuracy_drop,
+        'variants': {}
+    }
+
+    all_ok = True
+    for variant in variants:
+        print(f"\nConverting {variant}...")
+        flatbuffer = convert(model, variant, calibration_images)
+        output_path = os.path.join(args.output_dir, f'{stem}_{variant}.tflite')
+        with open(output_path, 'wb') as f:
+            f.write(flatbuffer)
+
+        engine = TFLiteInference(output_path)
+        predictions = predict_in_batches(engine, images)
+        accuracy = float(np.mean(predictions.argmax(axis=1) == labels))
+        result = {
+            'path': output_path,
+            'size_mb': len(flatbuffer) / 1e6,
+            'accuracy': accuracy,
+            'accuracy_drop': reference_accuracy - accuracy,
+            'agreement_with_keras': float(np.mean(predictions.argmax(axis=1) == reference.argmax(axis=1))),
+            'max_abs_probability_diff': float(np.abs(predictions - reference).max()),
+            'latency_ms_batch1': latency_ms(engine, images[0]),
+        }
+        result['within_tolerance'] = result['accuracy_drop'] <= args.max_accuracy_drop
+        all_ok = all_ok and result['within_tolerance']
+        report['variants'][variant] = result
+
+        status = '✓' if result['within_tolerance'] else '✗'
+        print(f"{status} {output_path}: {result['size_mb']:.1f}MB, accuracy {accuracy:.3f} "
+              f"(drop {result['accuracy_drop']:+.3f}), agreement {result['agreement_with_keras']:.3f}, "
+              f"max |Δp| {result['max_abs_probability_diff']:.4f}, batch-1 {result['latency_ms_batch1']:.1f}ms")
+
+    report_path = os.path.join(args.output_dir, f'{stem}_tflite_report.json')
+    with open(report_path, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"\nReport written to {report_path}")
+
+    if not all_ok:
+        print(f"✗ At least one variant lost more than {args.max_accuracy_drop:.3f} accuracy")
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
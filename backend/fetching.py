@@ -0,0 +1,107 @@
+"""
+Server-side image fetching for /classify and /classify/batch.
+
+Clients can send an image URL, or a path relative to IMAGE_BASE_URL (blob
+storage), instead of the image itself. The backend then downloads it
+directly. Before this, the frontend downloaded each image, base64-encoded it
+into a data URL and JSON-encoded it, and the backend reversed all of that.
+
+Downloads go through one urllib3 PoolManager. It keeps at most
+max_per_host keep-alive connections to each host, and blocks rather than
+opening more, so that is a per-host concurrency limit. It also holds pools
+for at most max_hosts hosts. A thread pool bounds the total number of
+concurrent downloads. Bodies are streamed in chunks, and a download is
+abandoned as soon as it passes max_bytes.
+
+Only hosts in allowed_hosts can be fetched, so the backend cannot be used
+to reach arbitrary internal addresses. By default that is only the host of
+base_url.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote, urlsplit
+
+import urllib3
+
+from imaging import ImageRejected, read_image_stream
+
+
+class FetchError(ImageRejected):
+    """An image reference that could not be fetched; status is the HTTP status to answer with"""
+
+
+class ImageFetcher:
+    """Pooled, concurrent downloads of image URLs and storage-relative paths"""
+
+    def __init__(self, base_url='', allowed_hosts=None, max_per_host=8, max_hosts=16, workers=32,
+                 timeout=10.0, retries=2, max_bytes=None):
+        self.base_url = base_url.rstrip('/') + '/' if base_url else ''
+        if allowed_hosts is None:
+            allowed_hosts = [urlsplit(base_url).netloc] if base_url else []
+        self.allowed_hosts = {host.lower() for host in allowed_hosts if host}
+        self.max_bytes = max_bytes
+        self.http = urllib3.PoolManager(
+            num_pools=max_hosts,
+            maxsize=max_per_host,
+            block=True,  # wait for a free connection instead of exceeding max_per_host
+            timeout=urllib3.Timeout(connect=min(timeout, 5.0), read=timeout),
+            retries=urllib3.Retry(total=retries, backoff_factor=0.2, status_forcelist=(429, 500, 502, 503, 504),
+                                  raise_on_status=False),
+            headers={'User-Agent': 'teampics-backend'}
+        )
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='fetch')
+
+    def resolve(self, reference):
+        """URL for an absolute http(s) URL or a path relative to base_url; FetchError (400) if not allowed"""
+        if not isinstance(reference, str) or not reference:
+            raise FetchError('Image reference must be a non-empty string', 400)
+        if reference.startswith(('http://', 'https://')):
+            url = reference
+        elif self.base_url:
+            path = reference.replace('\\', '/').lstrip('/')
+            if '..' in path.split('/'):
+                raise FetchError(f'Invalid image path: {reference}', 400)
+            url = self.base_url + quote(path)
+        else:
+            raise FetchError('Storage paths are not enabled (IMAGE_BASE_URL is not set)', 400)
+
+        host = urlsplit(url).netloc.lower()
+        if '*' not in self.allowed_hosts and host not in self.allowed_hosts:
+            raise FetchError(f'Fetching from {host} is not allowed', 400)
+        return url
+
+    def fetch(self, reference):
+        """Download an image as a list of chunks (see imaging.read_image_stream)"""
+        url = self.resolve(reference)
+        try:
+            # No redirects: they could lead to hosts that aren't allowed
+            response = self.http.request('GET', url, preload_content=False, redirect=False)
+        except urllib3.exceptions.MaxRetryError as e:
+            timed_out = isinstance(e.reason, urllib3.exceptions.TimeoutError)
+            raise FetchError(f'Could not fetch {url}: {e.reason}', 504 if timed_out else 502)
+        except urllib3.exceptions.TimeoutError:
+            raise FetchError(f'Timed out fetching {url}', 504)
+        except urllib3.exceptions.HTTPError as e:
+            raise FetchError(f'Could not fetch {url}: {e}', 502)
+
+        complete = False
+        try:
+            if response.status != 200:
+                raise FetchError(f'Fetching {url} returned {response.status}',
+                                 404 if response.status == 404 else 502)
+            length = response.headers.get('Content-Length')
+            if self.max_bytes and length and length.isdigit() and int(length) > self.max_bytes:
+                raise ImageRejected(f'Image is {length} bytes, the limit is {self.max_bytes}', 413)
+            try:
+                chunks = read_image_stream(response, max_bytes=self.max_bytes)
+            except urllib3.exceptions.HTTPError as e:
+                raise FetchError(f'Could not fetch {url}: {e}', 502)
+            complete = True
+            return chunks
+        finally:
+            if not complete:
+                response.close()  # unread body: drop the connection rather than reuse it
+            response.release_conn()
+
+    def close(self):
+        self.pool.shutdown(wait=False)
+        self.http.clear()
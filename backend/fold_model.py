@@ -0,0 +1,222 @@
+"""
+Fold preprocessing and BatchNorm into the ResNet50 convolutions.
+
+Every request used to run preprocess_input (RGB->BGR flip and ImageNet mean
+subtraction), and the rebuilt architectures in app.py,
+build_inference_model.py and rebuild_without_augmentation.py also embed it
+as graph ops. Both are per-pixel affine maps, so they can be folded into the
+conv1 kernel and bias. Each BatchNormalization is likewise folded into the
+convolution before it. The result is a BN-free ResNet50 that takes raw uint8
+RGB; the backend detects it (see inference.expects_raw_pixels) and skips all
+per-request preprocessing.
+
+The transform applied before conv1 is measured by probing the source model
+rather than assumed, so models with or without in-graph preprocess_input
+fold correctly. The folded model is checked against the original serving
+path on random and sample images before it is saved.
+
+Usage:
+    python fold_model.py --model model/resnet50_profilepic_no_aug.h5
+    python fold_model.py --model model/resnet50_profilepic_no_aug.h5 --output model/resnet50_profilepic_folded.keras
+"""
+import argparse
+import os
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras import layers, models
+from tensorflow.keras.applications.resnet50 import preprocess_input
+
+from inference import GraphInference, SpatialBias, expects_raw_pixels, load_keras_model
+
+# (stack name, bottleneck filters, blocks, first stride) for ResNet50
+RESNET50_STACKS = [('conv2', 64, 3, 1), ('conv3', 128, 4, 2), ('conv4', 256, 6, 2), ('conv5', 512, 3, 2)]
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_IMAGES = os.path.join(REPO_ROOT, 'profile_images', 'images')
+
+
+def find_layer(model, name):
+    """Find a layer by name, looking inside nested models"""
+    for layer in model.layers:
+        if layer.name == name:
+            return layer
+        if isinstance(layer, tf.keras.Model):
+            found = find_layer(layer, name)
+            if found is not None:
+                return found
+    return None
+
+
+def dense_layers(model):
+    """Dense layers of the classification head, in order"""
+    found = []
+    for layer in model.layers:
+        if isinstance(layer, tf.keras.Model):
+            found.extend(dense_layers(layer))
+        elif isinstance(layer, layers.Dense):
+            found.append(layer)
+    return found
+
+
+def input_transform(model, image_size):
+    """Measure the per-pixel affine map from raw RGB to conv1's input: pre(x) = x @ A.T + b
+
+    Covers the host-side preprocess_input the backend applies plus anything
+    the model does in-graph before conv1_pad.
+    """
+    conv1_pad = find_layer(model, 'conv1_pad')
+    if conv1_pad is None:
+        raise ValueError('No conv1_pad layer found - is this a ResNet50 classifier?')
+    probe = models.Model(model.inputs[0], conv1_pad.input)
+
+    def served(x):
+        return np.asarray(probe(preprocess_input(x.astype(np.float32).copy()), training=False))
+
+    basis = np.zeros((4, image_size, image_size, 3), dtype=np.float32)
+    for channel in range(3):
+        basis[channel + 1, ..., channel] = 1.0
+    responses = served(basis)[:, 0, 0, :]
+    offset = responses[0]
+    matrix = (responses[1:] - offset).T
+
+    # The fold is only valid if the preprocessing really is affine per pixel
+    sample = np.random.RandomState(0).randint(0, 256, size=(1, image_size, image_size, 3)).astype(np.float32)
+    if not np.allclose(served(sample), sample @ matrix.T + offset, atol=1e-3):
+        raise ValueError('Preprocessing before conv1 is not a per-pixel affine map; cannot fold it')
+    return matrix, offset
+
+
+def bn_scale_shift(bn):
+    """BatchNorm as y = x * scale + shift (inference mode)"""
+    gamma = bn.gamma.numpy() if bn.scale else 1.0
+    beta = bn.beta.numpy() if bn.center else 0.0
+    scale = gamma / np.sqrt(bn.moving_variance.numpy() + bn.epsilon)
+    shift = beta - bn.moving_mean.numpy() * scale
+    return scale, shift
+
+
+def fold_conv_bn(conv, bn):
+    """Kernel and bias of conv followed by bn, as a single convolution"""
+    kernel = conv.kernel.numpy()
+    bias = conv.bias.numpy() if conv.use_bias else np.zeros(kernel.shape[-1], dtype=np.float32)
+    scale, shift = bn_scale_shift(bn)
+    return kernel * scale, bias * scale + shift
+
+
+def fold_conv1(model, image_size):
+    """Fold the input transform and conv1_bn into conv1: returns (kernel, bias map)"""
+    matrix, offset = input_transform(model, image_size)
+    conv = find_layer(model, 'conv1_conv')
+    kernel = conv.kernel.numpy()
+    bias = conv.bias.numpy() if conv.use_bias else 0.0
+
+    # conv(W, pad0(A x + b)) = conv(W A, pad0(x)) + conv(W, pad0(b)); the
+    # second term is constant but varies along the zero-padded border
+    folded_kernel = np.einsum('hwio,ij->hwjo', kernel, matrix)
+    constant = np.broadcast_to(offset, (1, image_size, image_size, 3)).astype(np.float32)
+    constant = np.pad(constant, ((0, 0), (3, 3), (3, 3), (0, 0)))
+    bias_map = tf.nn.conv2d(constant, kernel, strides=2, padding='VALID').numpy()[0] + bias
+
+    scale, shift = bn_scale_shift(find_layer(model, 'conv1_bn'))
+    return folded_kernel * scale, bias_map * scale + shift
+
+
+def build_folded_resnet50(image_size, head):
+    """ResNet50 without BatchNorm taking uint8 RGB; head is [(units, activation), ...]"""
+    inputs = layers.Input(shape=(image_size, image_size, 3), dtype='uint8', name='images')
+    x = layers.Rescaling(1.0, name='to_float')(inputs)
+    x = layers.ZeroPadding2D(padding=((3, 3), (3, 3)), name='conv1_pad')(x)
+    x = layers.Conv2D(64, 7, strides=2, use_bias=False, name='conv1_conv')(x)
+    x = SpatialBias(name='conv1_bias')(x)
+    x = layers.Activation('relu', name='conv1_relu')(x)
+    x = layers.ZeroPadding2D(padding=((1, 1), (1, 1)), name='pool1_pad')(x)
+    x = layers.MaxPooling2D(3, strides=2, name='pool1_pool')(x)
+
+    for stack, filters, blocks, stride in RESNET50_STACKS:
+        for block in range(1, blocks + 1):
+            name = f'{stack}_block{block}'
+            block_stride = stride if block == 1 else 1
+            if block == 1:
+                shortcut = layers.Conv2D(4 * filters, 1, strides=block_stride, name=f'{name}_0_conv')(x)
+            else:
+                shortcut = x
+            y = layers.Conv2D(filters, 1, strides=block_stride, activation='relu', name=f'{name}_1_conv')(x)
+            y = layers.Conv2D(filters, 3, padding='same', activation='relu', name=f'{name}_2_conv')(y)
+            y = layers.Conv2D(4 * filters, 1, name=f'{name}_3_conv')(y)
+            x = layers.Add(name=f'{name}_add')([shortcut, y])
+            x = layers.Activation('relu', name=f'{name}_out')(x)
+
+    x = layers.GlobalAveragePooling2D(name='global_average_pooling2d')(x)
+    for i, (units, activation) in enumerate(head):
+        x = layers.Dense(units, activation=activation, name=f'head_dense_{i}')(x)
+    return models.Model(inputs=inputs, outputs=x, name='resnet50_profilepic_folded')
+
+
+def fold_model(model, image_size=224):
+    """Return the folded, BN-free equivalent of a ResNet50 classifier"""
+    head_layers = dense_layers(model)
+    head = [(layer.units, tf.keras.activations.serialize(layer.activation)) for layer in head_layers]
+    folded = build_folded_resnet50(image_size, head)
+
+    kernel, bias_map = fold_conv1(model, image_size)
+    folded.get_layer('conv1_conv').set_weights([kernel])
+    folded.get_layer('conv1_bias').set_weights([bias_map])
+
+    for layer in folded.layers:
+        if isinstance(layer, layers.Conv2D) and layer.name != 'conv1_conv':
+            bn_name = layer.name[:-len('conv')] + 'bn'
+            layer.set_weights(list(fold_conv_bn(find_layer(model, layer.name), find_layer(model, bn_name))))
+
+    for i, source in enumerate(head_layers):
+        folded.get_layer(f'head_dense_{i}').set_weights(source.get_weights())
+    return folded
+
+
+def sample_images(image_dir, image_size, limit=32):
+    """Random images plus (if present) a few real profile photos, as uint8 batches"""
+    from imaging import decode_image, read_image_path
+
+    images = list(np.random.RandomState(1).randint(0, 256, size=(8, image_size, image_size, 3), dtype=np.uint8))
+    if image_dir and os.path.isdir(image_dir):
+        for name in sorted(os.listdir(image_dir))[:limit]:
+            images.append(decode_image(read_image_path(os.path.join(image_dir, name)), image_size))
+    return np.stack(images)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model', required=True, help='Keras ResNet50 classifier (.h5 or .keras)')
+    parser.add_argument('--output', help='Output .keras path (default: <model>_folded.keras)')
+    parser.add_argument('--image-size', type=int, default=224)
+    parser.add_argument('--images', default=DEFAULT_IMAGES, help='Directory of sample images for verification')
+    parser.add_argument('--tolerance', type=float, default=1e-4,
+                        help='Largest accepted absolute difference in any predicted probability')
+    args = parser.parse_args()
+
+    model = load_keras_model(args.model)
+    if expects_raw_pixels(model):
+        parser.error(f'{args.model} is already folded')
+
+    print("\nFolding preprocessing and BatchNorm...")
+    folded = fold_model(model, args.image_size)
+    print(f"✓ {len(model.layers)} layers -> {len(folded.layers)} layers")
+
+    print("\nVerifying against the original serving path...")
+    images = sample_images(args.images, args.image_size)
+    expected = GraphInference(model, args.image_size)(images)
+    actual = GraphInference(folded, args.image_size)(images)
+    max_diff = float(np.abs(expected - actual).max())
+    agreement = float(np.mean(expected.argmax(axis=1) == actual.argmax(axis=1)))
+    print(f"  {len(images)} images: max |Δp| {max_diff:.2e}, top-1 agreement {agreement:.3f}")
+    if max_diff > args.tolerance:
+        print(f"✗ Folded model differs by more than {args.tolerance:g}; not saving")
+        raise SystemExit(1)
+
+    output = args.output or os.path.splitext(args.model)[0] + '_folded.keras'
+    folded.save(output)
+    print(f"\n✓ Saved folded model to {output}")
+    print(f"  Serve it with MODEL_PATH={output} (input: raw uint8 RGB, no preprocessing)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+"""
+gunicorn settings for the backend.
+
+The model is served by a pool of INFERENCE_PROCESSES inference processes,
+started here in the master before the workers are forked (see
+inference_service.py). The workers only parse requests and decode images
+into shared memory; they never import TensorFlow, so they boot instantly and
+do not compete with inference for the GIL. ResNet50 stays resident once per
+inference process, however many workers there are. SHARED_INFERENCE=0 loads
+the model inside each worker instead.
+
+The /metrics values are moved into shared memory before anything is forked,
+so every worker reports the totals of the whole server.
+"""
+import os
+
+import inference_service
+import metrics
+from embeddings import EMBEDDING_DIM
+
+bind = '0.0.0.0:5000'
+workers = int(os.environ.get('WEB_CONCURRENCY', str(min(os.cpu_count() or 1, 4))))
+# Threads let concurrent /classify requests reach the micro-batcher together
+threads = int(os.environ.get('GUNICORN_THREADS', '8'))
+timeout = 120
+
+SHARED_INFERENCE = os.environ.get('SHARED_INFERENCE', '1') == '1'
+INFERENCE_PROCESSES = int(os.environ.get('INFERENCE_PROCESSES', '1'))
+# Decoded images each inference process's shared-memory ring buffer holds
+INFERENCE_RING_IMAGES = int(os.environ.get('INFERENCE_RING_IMAGES', '128'))
+SHARED_INFERENCE_TIMEOUT_S = float(os.environ.get('SHARED_INFERENCE_TIMEOUT_S', '60'))
+
+
+def result_width():
+    """Columns of a result row in the ring buffers"""
+    if os.environ.get('EMBEDDING_DIR'):
+        return EMBEDDING_DIM  # pooled embeddings, the head runs in the workers
+    if os.environ.get('CASCADE_MODEL_PATH'):
+        return 3 + 1  # probabilities and the cascade stage that answered
+    return 3
+
+
+def on_starting(server):
+    metrics.share()
+    if SHARED_INFERENCE:
+        inference_service.start(
+            processes=INFERENCE_PROCESSES,
+            capacity=INFERENCE_RING_IMAGES,
+            image_size=int(os.environ.get('IMAGE_SIZE', '224')),
+            num_classes=result_width(),
+            timeout=SHARED_INFERENCE_TIMEOUT_S
+        )
+
+
+def on_exit(server):
+    inference_service.stop()
@@ -0,0 +1,257 @@
+"""
+Image reading and decoding helpers shared by the API and the offline tools.
+
+An image arrives as one of three payloads: bytes (base64 JSON bodies, files
+on disk), a list of chunks (raw request bodies, never joined into one
+buffer) or a seekable file object (multipart uploads). image_digest hashes
+any of them for the result cache and decode_image turns any of them into the
+(224, 224, 3) uint8 RGB array the model expects, optionally writing it
+straight into a caller's buffer (e.g. shared memory, see inference_service.py).
+
+Decoding is cheap for large uploads: open_image reads only the header and
+rejects unsupported formats and oversized inputs (ImageRejected) before any
+pixels are decoded, and JPEGs are decoded in draft mode - the DCT is scaled
+down by 2, 4 or 8 during decoding so a 4000x3000 photo never materialises at
+full resolution on its way to 224x224.
+
+The offline tools read the labelled sample set through read_profile_mapping
+and load_labeled_images (profile_images/profile_image_mapping.csv).
+"""
+import base64
+import csv
+import hashlib
+import io
+import os
+import time
+
+import numpy as np
+from PIL import Image, UnidentifiedImageError
+
+# Raw image bodies are read in chunks of this size
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+# Formats accepted by open_image
+ALLOWED_FORMATS = ('JPEG', 'PNG', 'GIF', 'WEBP', 'BMP')
+
+
+class ImageRejected(ValueError):
+    """An upload refused before decoding; status is the HTTP status to answer with"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+class ChunkReader(io.RawIOBase):
+    """Seekable read-only file over a list of chunks, so PIL can open a raw body without joining it"""
+
+    def __init__(self, chunks):
+        self._chunks = chunks
+        self._starts = []
+        self._size = 0
+        for chunk in chunks:
+            self._starts.append(self._size)
+            self._size += len(chunk)
+        self._position = 0
+        self._index = 0  # chunk holding self._position
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self._size
+        self._position = max(offset, 0)
+        self._index = 0
+        while self._index + 1 < len(self._chunks) and self._starts[self._index + 1] <= self._position:
+            self._index += 1
+        return self._position
+
+    def readinto(self, buffer):
+        view = memoryview(buffer).cast('B')
+        written = 0
+        while written < len(view) and self._position < self._size:
+            chunk = self._chunks[self._index]
+            offset = self._position - self._starts[self._index]
+            count = min(len(chunk) - offset, len(view) - written)
+            view[written:written + count] = chunk[offset:offset + count]
+            written += count
+            self._position += count
+            if offset + count == len(chunk):
+                self._index += 1
+        return written
+
+
+def prepare_image(image, size=224, out=None):
+    """Convert a PIL image into the (size, size, 3) uint8 array the model expects (in out, if given)"""
+    # Convert to RGB if necessary
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+
+    # Resize to model input size (224x224)
+    image = image.resize((size, size))
+
+    # Convert to numpy array; the batch dimension is added by the caller
+    if out is not None:
+        out[...] = np.asarray(image)
+        return out
+    return np.asarray(image, dtype=np.uint8)
+
+
+def read_image_base64(image_data):
+    """Decode a base64 image string (optionally a data URL) into bytes"""
+    # Remove data URL prefix if present
+    if ',' in image_data:
+        image_data = image_data.split(',')[1]
+    return base64.b64decode(image_data)
+
+
+def read_image_stream(stream, max_bytes=None):
+    """Read a raw image body as a list of chunks (never joined into one buffer)
+
+    Stops with ImageRejected as soon as the body grows past max_bytes.
+    """
+    chunks = []
+    size = 0
+    for chunk in iter(lambda: stream.read(UPLOAD_CHUNK_SIZE), b''):
+        size += len(chunk)
+        if max_bytes and size > max_bytes:
+            raise ImageRejected(f'Image is larger than {max_bytes} bytes', 413)
+        chunks.append(chunk)
+    return chunks
+
+
+def read_image_file(fp):
+    """Uploaded files (e.g. multipart parts) are already seekable; use them as-is"""
+    return fp
+
+
+def read_image_path(path):
+    """Read an image file from disk"""
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def image_digest(payload):
+    """SHA-256 of an image payload from one of the read_image_* functions"""
+    digest = hashlib.sha256()
+    if isinstance(payload, list):
+        for chunk in payload:
+            digest.update(chunk)
+    elif isinstance(payload, (bytes, bytearray)):
+        digest.update(payload)
+    else:
+        for chunk in iter(lambda: payload.read(UPLOAD_CHUNK_SIZE), b''):
+            digest.update(chunk)
+        payload.seek(0)
+    return digest.hexdigest()
+
+
+def payload_size(payload):
+    """Size in bytes of an image payload"""
+    if isinstance(payload, list):
+        return sum(len(chunk) for chunk in payload)
+    if isinstance(payload, (bytes, bytearray)):
+        return len(payload)
+    size = payload.seek(0, io.SEEK_END)
+    payload.seek(0)
+    return size
+
+
+def open_image(payload, max_bytes=None, max_pixels=None):
+    """Open an image payload reading only its header, and check format, size and dimensions.
+
+    Raises ImageRejected (415 for unsupported formats, 413 for inputs over
+    max_bytes or max_pixels) before any pixel data is decoded.
+    """
+    if max_bytes:
+        size = payload_size(payload)
+        if size > max_bytes:
+            raise ImageRejected(f'Image is {size} bytes, the limit is {max_bytes}', 413)
+
+    if isinstance(payload, list):
+        fp = ChunkReader(payload)
+    elif isinstance(payload, (bytes, bytearray)):
+        fp = io.BytesIO(payload)
+    else:
+        fp = payload
+    try:
+        image = Image.open(fp, formats=ALLOWED_FORMATS)
+    except UnidentifiedImageError:
+        raise ImageRejected(f"Unsupported image format (expected {', '.join(ALLOWED_FORMATS)})", 415)
+    except Image.DecompressionBombError as e:
+        raise ImageRejected(str(e), 413)
+
+    width, height = image.size
+    if max_pixels and width * height > max_pixels:
+        raise ImageRejected(f'Image is {width}x{height}, more than {max_pixels} pixels', 413)
+    return image
+
+
+def decode_image(payload, size=224, out=None, max_bytes=None, max_pixels=None, draft=True, timings=None):
+    """Decode an image payload into a (size, size, 3) uint8 array (written into out, if given)
+
+    The header is checked first (see open_image). With draft, JPEGs are
+    decoded at the smallest 1/2, 1/4 or 1/8 scale that is still at least
+    size x size. If a timings dict is given, the seconds spent decoding and
+    resizing are stored under 'decode' and 'resize'.
+    """
+    start = time.perf_counter()
+    image = open_image(payload, max_bytes=max_bytes, max_pixels=max_pixels)
+    if draft:
+        image.draft('RGB', (size, size))  # no-op for formats other than JPEG
+    image.load()
+    decoded = time.perf_counter()
+    result = prepare_image(image, size, out)
+    if timings is not None:
+        timings['decode'] = decoded - start
+        timings['resize'] = time.perf_counter() - decoded
+    return result
+
+
+def read_profile_mapping(mapping_path, image_root=None):
+    """Rows of profile_image_mapping.csv with imagePath resolved to a local file.
+
+    image_root defaults to the directory holding the CSV (profile_images/),
+    which is what imagePath values like 'images/profile_0000_human.jpg' are
+    relative to. Rows without a photo (imageType 'no_pic') get path None.
+    """
+    if image_root is None:
+        image_root = os.path.dirname(os.path.abspath(mapping_path))
+    with open(mapping_path, newline='', encoding='utf-8') as f:
+        for row in csv.DictReader(f):
+            image_path = row.get('imagePath') or ''
+            if row.get('imageType') == 'no_pic' or not image_path:
+                row['path'] = None
+            else:
+                row['path'] = os.path.join(image_root, *image_path.replace('\\', '/').split('/'))
+            yield row
+
+
+def load_labeled_images(mapping_path, class_names, image_root=None, size=224, limit=None):
+    """Decode every mapped profile photo whose imageType is one of class_names.
+
+    Returns (images, labels, paths): a (N, size, size, 3) uint8 array, the
+    class index of each image and the file it came from. Missing files are
+    skipped.
+    """
+    images, labels, paths = [], [], []
+    for row in read_profile_mapping(mapping_path, image_root):
+        if row['path'] is None or row.get('imageType') not in class_names:
+            continue
+        if not os.path.exists(row['path']):
+            continue
+        images.append(decode_image(read_image_path(row['path']), size))
+        labels.append(class_names.index(row['imageType']))
+        paths.append(row['path'])
+        if limit and len(images) >= limit:
+            break
+    return np.stack(images), np.array(labels), paths
@@ -0,0 +1,426 @@
+"""
+Inference wrappers used by the backend instead of Keras' model.predict.
+
+model.predict builds a data adapter, callbacks and a progress loop on every
+call, which costs milliseconds per request - a lot next to a batch of one.
+GraphInference traces the model once into a tf.function with a fixed input
+signature (uint8 RGB images, any batch size) and does the ResNet50
+preprocessing inside the graph, so a call is a single graph execution.
+
+XlaInference (INFERENCE_ENGINE=xla) additionally JIT-compiles the forward
+pass with XLA, which fuses ResNet50's conv/BN/ReLU chains. XLA compiles one
+executable per input shape, so batches are padded up to a fixed set of
+bucket sizes and the compiled function for each bucket is kept for reuse.
+If compilation fails the engine falls back to the plain graph.
+
+Models produced by fold_model.py take raw uint8 RGB and already contain the
+preprocessing (folded into conv1); GraphInference detects them by their
+uint8 input and skips preprocess_input.
+
+with_input_size rebuilds a model for another input resolution (IMAGE_SIZE);
+the weights are unchanged, so any multiple of 32 can be served or profiled
+(see profile_resolution.py).
+
+split_head cuts a classifier into the ResNet50 base, ending at the pooled
+embedding, and its dense head, for the embedding store (embeddings.py).
+
+load_artifact reads the canonical model artifact written by build_artifact.py:
+a directory with manifest.json (architecture config, versions, weight index)
+and weights.bin, whose tensors are memory-mapped rather than parsed.
+
+ScreenInference runs the small first-stage model of the cascade (cascade.py).
+
+TFLiteInference serves a .tflite export (see export_tflite.py) - float32,
+dynamic-range or full-int8 - through the TFLite interpreter. The exported
+models take raw RGB pixels and include the preprocessing, like the graph.
+"""
+import abc
+import json
+import os
+import time
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras.applications.resnet50 import preprocess_input
+
+
+@tf.keras.utils.register_keras_serializable(package='profilepic')
+class SpatialBias(tf.keras.layers.Layer):
+    """Add a learned (H, W, C) bias map - conv1's bias after folding preprocessing into it.
+
+    Zero padding in raw-pixel space is not zero in preprocessed space, so the
+    folded conv1 bias differs along the image border and cannot be a plain
+    per-channel bias.
+    """
+
+    def build(self, input_shape):
+        self.bias = self.add_weight(name='bias', shape=tuple(input_shape[1:]), initializer='zeros')
+
+    def call(self, inputs):
+        return inputs + self.bias
+
+    @staticmethod
+    def resize(bias, shape, border=4):
+        """The bias map for another (H, W, C): border rows and columns are kept, the constant interior stretched"""
+        for axis, size in enumerate(shape[:2]):
+            old = bias.shape[axis]
+            index = np.concatenate([np.arange(border), np.full(size - 2 * border, border), np.arange(old - border, old)])
+            bias = np.take(bias, index, axis=axis)
+        return bias
+
+
+def expects_raw_pixels(model):
+    """True for models that take uint8 RGB and do their own preprocessing (fold_model.py)"""
+    return str(model.inputs[0].dtype) == 'uint8'
+
+
+def build_classifier(image_size=224, weights=None):
+    """Build the served ResNet50 classifier architecture (preprocessing included)"""
+    from tensorflow.keras import layers, models
+    from tensorflow.keras.applications import ResNet50
+
+    inputs = layers.Input(shape=(image_size, image_size, 3))
+    x = preprocess_input(inputs)
+    base_model = ResNet50(include_top=False, weights=weights, input_tensor=x)
+    x = layers.GlobalAveragePooling2D()(base_model.output)
+    x = layers.Dropout(0.25)(x, training=False)
+    x = layers.Dense(256, activation='relu')(x)
+    x = layers.Dropout(0.25)(x, training=False)
+    outputs = layers.Dense(3, activation='softmax')(x)
+    return models.Model(inputs=inputs, outputs=outputs)
+
+
+def input_size(model):
+    """Square input size a Keras model was built for, or None if it takes any size"""
+    size = model.inputs[0].shape[1]
+    return int(size) if size is not None else None
+
+
+def with_input_size(model, image_size):
+    """The model rebuilt for (image_size, image_size, 3) inputs with the same weights.
+
+    ResNet50 ends in global average pooling, so its weights fit any input
+    size that is a multiple of its 32x downsampling; compute scales with the
+    pixel count. A folded model's conv1 bias map (SpatialBias) only varies
+    along the image border, so it is carried over exactly.
+    """
+    if input_size(model) in (image_size, None):
+        return model
+    if image_size % 32:
+        raise ValueError(f'Input size must be a multiple of 32, got {image_size}')
+    config = model.get_config()
+    shape = [None, image_size, image_size, int(model.inputs[0].shape[-1])]
+    for layer in config['layers']:
+        layer.pop('build_config', None)  # layers are built for the new shape when the graph is rebuilt
+        if layer['class_name'] == 'InputLayer':
+            key = 'batch_shape' if 'batch_shape' in layer['config'] else 'batch_input_shape'
+            layer['config'][key] = shape
+    if config.get('build_input_shape'):
+        config['build_input_shape'] = shape  # Sequential
+    resized = model.__class__.from_config(config)
+    for source, target in zip(model.layers, resized.layers):
+        weights = source.get_weights()
+        if isinstance(source, SpatialBias):
+            weights = [SpatialBias.resize(weights[0], tuple(target.bias.shape))]
+        target.set_weights(weights)
+    return resized
+
+
+def load_keras_model(model_path):
+    """Load a .h5/.keras classifier, rebuilding the architecture if direct loading fails"""
+    try:
+        model = tf.keras.models.load_model(model_path, compile=False)
+        print(f"✓ Model loaded successfully from {model_path}", flush=True)
+    except (TypeError, ValueError, KeyError) as e:
+        # If direct load fails, rebuild architecture and load weights
+        print(f"⚠ Direct load failed ({type(e).__name__}), rebuilding architecture...", flush=True)
+        model = build_classifier()
+
+        # Try loading weights
+        weights_path = model_path.replace('.h5', '_weights.h5') if '.h5' in model_path else model_path
+        if not os.path.exists(weights_path):
+            # Try loading from the model file anyway
+            weights_path = model_path
+        model.load_weights(weights_path)
+        print(f"✓ Rebuilt architecture and loaded weights from {weights_path}", flush=True)
+    return model
+
+
+def split_head(model):
+    """Split a classifier at its GlobalAveragePooling2D into (base model -> pooled embeddings, DenseHead).
+
+    Used with the embedding store (see embeddings.py): the base runs in the
+    graph and the head, which costs next to nothing, in numpy.
+    """
+    from embeddings import DenseHead
+
+    pooling = [i for i, layer in enumerate(model.layers)
+               if isinstance(layer, tf.keras.layers.GlobalAveragePooling2D)]
+    if len(pooling) != 1:
+        raise ValueError(f'Expected one GlobalAveragePooling2D layer, found {len(pooling)}')
+    base = tf.keras.Model(model.inputs, model.layers[pooling[0]].output, name='embedding_base')
+
+    layers = []
+    for layer in model.layers[pooling[0] + 1:]:
+        if isinstance(layer, tf.keras.layers.Dropout):
+            continue  # identity at inference time
+        if not isinstance(layer, tf.keras.layers.Dense):
+            raise ValueError(f'Unsupported layer after the pooling: {layer.name} ({type(layer).__name__})')
+        kernel, bias = layer.get_weights()
+        layers.append((kernel, bias, layer.activation.__name__))
+    return base, DenseHead(layers)
+
+
+ARTIFACT_FORMAT = 1
+ARTIFACT_MANIFEST = 'manifest.json'
+ARTIFACT_WEIGHTS = 'weights.bin'
+
+
+def is_artifact(path):
+    """True for a build_artifact.py directory (or its manifest.json)"""
+    if os.path.basename(path) == ARTIFACT_MANIFEST:
+        path = os.path.dirname(path)
+    return os.path.isfile(os.path.join(path, ARTIFACT_MANIFEST))
+
+
+def read_manifest(path):
+    """Load an artifact's manifest.json"""
+    if os.path.basename(path) == ARTIFACT_MANIFEST:
+        path = os.path.dirname(path)
+    with open(os.path.join(path, ARTIFACT_MANIFEST)) as f:
+        return json.load(f)
+
+
+def load_artifact(path, timings=None):
+    """Load a build_artifact.py model: architecture from its config, weights memory-mapped.
+
+    timings, if given, receives 'graph_build' and 'weight_load' in seconds.
+    Returns (model, manifest).
+    """
+    if os.path.basename(path) == ARTIFACT_MANIFEST:
+        path = os.path.dirname(path)
+    manifest = read_manifest(path)
+    if manifest.get('format') != ARTIFACT_FORMAT:
+        raise ValueError(f"Unsupported artifact format {manifest.get('format')} (expected {ARTIFACT_FORMAT})")
+    if manifest.get('tensorflow_version') != tf.__version__:
+        print(f"⚠ Artifact was built with TensorFlow {manifest.get('tensorflow_version')}, "
+              f"running {tf.__version__}", flush=True)
+
+    start = time.perf_counter()
+    model = tf.keras.models.model_from_json(json.dumps(manifest['architecture']))
+    graph_build = time.perf_counter() - start
+
+    start = time.perf_counter()
+    weights = np.memmap(os.path.join(path, ARTIFACT_WEIGHTS), dtype=np.uint8, mode='r')
+    model.set_weights([
+        np.ndarray(tuple(entry['shape']), dtype=entry['dtype'], buffer=weights, offset=entry['offset'])
+        for entry in manifest['weights']
+    ])
+    weight_load = time.perf_counter() - start
+
+    if timings is not None:
+        timings['graph_build'] = graph_build
+        timings['weight_load'] = weight_load
+    return model, manifest
+
+
+class InferenceEngine(abc.ABC):
+    """Common interface: engine(uint8 images (N, H, W, 3)) -> numpy probabilities (N, classes)"""
+
+    image_size = 224
+
+    @abc.abstractmethod
+    def __call__(self, images):
+        """Run a uint8 numpy batch and return a numpy array of predictions"""
+
+    def warmup(self, batch_sizes):
+        """Run each batch size once so real requests skip first-call costs.
+
+        Returns {batch_size: seconds} for the first call of each size.
+        """
+        timings = {}
+        for batch_size in batch_sizes:
+            dummy = np.zeros((batch_size, self.image_size, self.image_size, 3), dtype=np.uint8)
+            start = time.perf_counter()
+            self(dummy)
+            timings[batch_size] = time.perf_counter() - start
+        return timings
+
+
+class GraphInference(InferenceEngine):
+    """Traced, fixed-signature forward pass: uint8 (N, H, W, 3) -> probabilities (N, classes)"""
+
+    def __init__(self, model, image_size=224):
+        self.model = model
+        self.image_size = image_size
+        self.preprocess = not expects_raw_pixels(model)
+        self.input_signature = [
+            tf.TensorSpec(shape=(None, image_size, image_size, 3), dtype=tf.uint8, name='images')
+        ]
+        self._fn = tf.function(self._forward, input_signature=self.input_signature)
+
+    def _forward(self, images):
+        if not self.preprocess:
+            # Folded model: preprocessing is part of its first convolution
+            return self.model(images, training=False)
+        # Apply ResNet50 preprocessing (CRITICAL - must match training)
+        x = preprocess_input(tf.cast(images, tf.float32))
+        return self.model(x, training=False)
+
+    def __call__(self, images):
+        """Run a uint8 numpy batch and return a numpy array of predictions"""
+        return self._fn(tf.convert_to_tensor(images, dtype=tf.uint8)).numpy()
+
+
+class ScreenInference(GraphInference):
+    """A small screening classifier (cascade.py) over the same uint8 batches as the main model.
+
+    Screening models take RGB pixels (0-255) and do their own preprocessing.
+    Their input may be smaller than the served image size; batches are
+    resized to it inside the graph.
+    """
+
+    def __init__(self, model, image_size=224):
+        super().__init__(model, image_size=image_size)
+        self.input_size = tuple(int(d) for d in model.input_shape[1:3])
+
+    def _forward(self, images):
+        x = tf.cast(images, tf.float32)
+        if self.input_size != (self.image_size, self.image_size):
+            x = tf.image.resize(x, self.input_size, antialias=True)
+        if not self.preprocess:
+            x = tf.cast(tf.round(tf.clip_by_value(x, 0, 255)), tf.uint8)  # model takes uint8
+        return self.model(x, training=False)
+
+
+class XlaInference(GraphInference):
+    """GraphInference compiled with XLA for a fixed set of bucketed batch sizes"""
+
+    def __init__(self, model, image_size=224, buckets=(1, 2, 4, 8, 16, 32)):
+        super().__init__(model, image_size=image_size)
+        self.buckets = sorted(buckets)
+        self._xla_fn = tf.function(self._forward, jit_compile=True)
+        self._compiled = {}
+        self.fallback_reason = None
+
+    def _run_bucket(self, images, n):
+        """Run one bucket-sized batch through its XLA executable and return the first n rows.
+
+        A bucket is traced and compiled on its first run. If that fails, XLA
+        is switched off for good and the plain graph answers instead; errors
+        of a bucket that has already run are raised like any other.
+        """
+        if self.fallback_reason is not None:
+            return super().__call__(images[:n])
+        bucket = images.shape[0]
+        tensor = tf.convert_to_tensor(images, dtype=tf.uint8)
+        fn = self._compiled.get(bucket)
+        if fn is not None:
+            return fn(tensor).numpy()[:n]
+        try:
+            spec = tf.TensorSpec(shape=(bucket, self.image_size, self.image_size, 3), dtype=tf.uint8)
+            fn = self._xla_fn.get_concrete_function(spec)
+            outputs = fn(tensor).numpy()  # the first run compiles the executable
+        except Exception as e:
+            self.fallback_reason = f'{type(e).__name__}: {e}'
+            print(f"⚠ XLA compilation failed for batch {bucket}, falling back to the graph engine "
+                  f"({self.fallback_reason})", flush=True)
+            return super().__call__(images[:n])
+        self._compiled[bucket] = fn
+        return outputs[:n]
+
+    def _run_bucketed(self, images):
+        n = images.shape[0]
+        bucket = next((b for b in self.buckets if b >= n), None)
+        if bucket is None:
+            # Larger than the biggest bucket: run it in bucket-sized pieces
+            largest = self.buckets[-1]
+            return np.concatenate([
+                self._run_bucketed(images[start:start + largest])
+                for start in range(0, n, largest)
+            ])
+        if bucket > n:
+            padding = np.zeros((bucket - n,) + images.shape[1:], dtype=np.uint8)
+            images = np.concatenate([images, padding])
+        return self._run_bucket(images, n)
+
+    def __call__(self, images):
+        """Run through the XLA executable for the batch's bucket, or the plain graph after a fallback"""
+        images = np.asarray(images, dtype=np.uint8)
+        expected = (self.image_size, self.image_size, 3)
+        if images.ndim != 4 or images.shape[1:] != expected:
+            raise ValueError(f'Expected a batch of {expected} images, got shape {images.shape}')
+        if self.fallback_reason is not None:
+            return super().__call__(images)
+        return self._run_bucketed(images)
+
+    def warmup(self, batch_sizes=None):
+        """Compile every bucket up front (batch_sizes defaults to the buckets)"""
+        return super().warmup(batch_sizes or self.buckets)
+
+
+class TFLiteInference(InferenceEngine):
+    """Serve a .tflite classifier; handles quantized (uint8/int8) inputs and outputs"""
+
+    def __init__(self, model_path, num_threads=None):
+        self.model_path = model_path
+        self.interpreter = tf.lite.Interpreter(model_path=model_path, num_threads=num_threads)
+        self._input = self.interpreter.get_input_details()[0]
+        self._output = self.interpreter.get_output_details()[0]
+        self.image_size = int(self._input['shape'][1])
+        self.input_dtype = np.dtype(self._input['dtype'])
+        self._batch_size = None
+
+    def _resize(self, batch_size):
+        """Re-allocate the interpreter's tensors when the batch size changes"""
+        if batch_size != self._batch_size:
+            self.interpreter.resize_tensor_input(
+                self._input['index'], [batch_size, self.image_size, self.image_size, 3]
+            )
+            self.interpreter.allocate_tensors()
+            self._batch_size = batch_size
+
+    def _quantize(self, images):
+        if self.input_dtype == np.float32:
+            return images.astype(np.float32)
+        scale, zero_point = self._input['quantization']
+        if scale and (scale != 1.0 or zero_point != 0):
+            info = np.iinfo(self.input_dtype)
+            images = np.clip(np.round(images / scale + zero_point), info.min, info.max)
+        return images.astype(self.input_dtype)
+
+    def _dequantize(self, outputs):
+        scale, zero_point = self._output['quantization']
+        if outputs.dtype != np.float32 and scale:
+            return (outputs.astype(np.float32) - zero_point) * scale
+        return outputs
+
+    def __call__(self, images):
+        """Run a uint8 numpy batch through the interpreter"""
+        images = np.asarray(images)
+        self._resize(images.shape[0])
+        self.interpreter.set_tensor(self._input['index'], self._quantize(images))
+        self.interpreter.invoke()
+        return self._dequantize(self.interpreter.get_tensor(self._output['index']))
+
+
+def create_inference(model, engine='graph', image_size=None, xla_buckets=None):
+    """Build the inference wrapper selected by INFERENCE_ENGINE ('graph' or 'xla').
+
+    image_size defaults to the model's own input size; a different one
+    rebuilds the model for it (see with_input_size).
+    """
+    if isinstance(model, InferenceEngine):
+        # Already an engine (e.g. a TFLite model); nothing to wrap
+        if image_size not in (None, model.image_size):
+            raise ValueError(f'The model takes {model.image_size}px images and cannot be served at {image_size}px; '
+                             f'export it at that size')
+        return model
+    if image_size is None:
+        image_size = input_size(model) or 224
+    model = with_input_size(model, image_size)
+    if engine == 'xla':
+        return XlaInference(model, image_size=image_size, buckets=xla_buckets or (1, 2, 4, 8, 16, 32))
+    if engine != 'graph':
+        raise ValueError(f"Unknown inference engine '{engine}' (expected 'graph' or 'xla')")
+    return GraphInference(model, image_size=image_size)
@@ -0,0 +1,411 @@
+"""
+Out-of-process inference: a pool of inference processes fed through
+shared-memory ring buffers.
+
+TensorFlow dispatch competes with request parsing, base64 and PIL work for
+the GIL, and every copy of ResNet50 costs its weights plus a runtime. So the
+gunicorn master (see gunicorn.conf.py) starts the inference processes before
+it forks the HTTP workers. Each inference process loads the model by
+importing app.py, which skips its request-side setup there (result cache,
+micro-batcher, decode and fetch pools, job store). Each one owns a ring
+buffer in shared memory:
+
+    images   (capacity, S, S, 3) uint8        decoded pixels (S = IMAGE_SIZE), written in place by the HTTP workers
+    results  (capacity, classes) float32      probabilities (pooled embeddings with EMBEDDING_DIR), written by the inference process
+    state    (capacity,) int8                 FREE / RESERVED / QUEUED / DONE / FAILED per cell
+
+An HTTP worker reserves a contiguous run of cells and decodes straight into
+them (imaging.decode_image(..., out=)). It then queues (start, count). The
+inference process drains its queue and runs requests that sit next to each
+other in the ring as one view of the buffer. Pixel data is never pickled or
+copied between processes; only requests that are not adjacent get
+concatenated, into a reused staging buffer. The probabilities are written back into the ring and the
+waiting workers are woken.
+
+The HTTP workers never import TensorFlow and start immediately. app.py calls
+connect() at import. In an HTTP worker it returns an InferenceClient, whose
+reserve() matches MicroBatcher.reserve(). In an inference process, or
+without gunicorn, it returns None and the model is loaded in-process.
+"""
+import itertools
+import json
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import traceback
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import profiling
+from batching import BufferPool, Reservation
+
+# Cell states
+FREE, RESERVED, QUEUED, DONE, FAILED, ABANDONED = range(6)
+
+# The pool created by start() in the gunicorn master; forked workers inherit it
+shared = None
+# True inside an inference process
+is_inference_process = False
+
+
+class RingBuffer:
+    """One inference process's shared cells, allocator and request queue"""
+
+    def __init__(self, ctx, capacity, image_size, num_classes):
+        self.capacity = int(capacity)
+        self.num_classes = int(num_classes)
+        self._images_memory = shared_memory.SharedMemory(create=True, size=self.capacity * image_size * image_size * 3)
+        self._results_memory = shared_memory.SharedMemory(create=True, size=self.capacity * self.num_classes * 4)
+        self.images = np.ndarray((self.capacity, image_size, image_size, 3), dtype=np.uint8,
+                                 buffer=self._images_memory.buf)
+        self.results = np.ndarray((self.capacity, self.num_classes), dtype=np.float32,
+                                  buffer=self._results_memory.buf)
+        self.state = np.frombuffer(ctx.RawArray('b', self.capacity), dtype=np.int8)
+        self._head = ctx.RawValue('i', 0)
+        # Forward passes run, and how many of them needed a staging copy
+        self.batches = ctx.RawValue('q', 0)
+        self.copied_batches = ctx.RawValue('q', 0)
+        # Guards state and head; notified whenever cells are freed or finished
+        self.changed = ctx.Condition()
+        # Only the workers and the inference process put to this queue: one fed
+        # from the master would rely on a feeder thread the workers don't inherit
+        self.requests = ctx.Queue()
+
+        # Model status, version, engine and cold start timings, as JSON
+        self._info = ctx.Array('c', 16384)
+        self.ready = ctx.Event()
+
+    def reserve(self, count, timeout):
+        """Mark count contiguous cells RESERVED and return the first (None if none free in time)"""
+        if count > self.capacity:
+            raise ValueError(f'Cannot reserve {count} images in a ring buffer of {self.capacity}')
+        deadline = time.monotonic() + timeout
+        with self.changed:
+            while True:
+                start = self._find_free(count)
+                if start is not None:
+                    self.state[start:start + count] = RESERVED
+                    self._head.value = (start + count) % self.capacity
+                    return start
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self.changed.wait(remaining):
+                    return None
+
+    def _find_free(self, count):
+        # Allocate in ring order from the head, wrapping to the start when the
+        # run would not fit before the end
+        for start in (self._head.value, 0):
+            if start + count <= self.capacity and not self.state[start:start + count].any():
+                return start
+        return None
+
+    def submit(self, start, count):
+        with self.changed:
+            self.state[start:start + count] = QUEUED
+        self.requests.put((start, count))
+
+    def collect(self, start, count, timeout):
+        """Wait for submitted cells, free them and return their predictions"""
+        deadline = time.monotonic() + timeout
+        with self.changed:
+            while self.state[start] == QUEUED:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self.changed.wait(remaining):
+                    # The inference process frees the cells when it gets to them
+                    self.state[start:start + count] = ABANDONED
+                    raise TimeoutError(f'Inference process did not answer within {timeout:g}s')
+            failed = self.state[start] == FAILED
+            rows = self.results[start:start + count].copy()
+            self._free(start, count)
+        if failed:
+            raise RuntimeError('Inference failed (see the inference process log)')
+        return rows
+
+    def release(self, start, count):
+        with self.changed:
+            self._free(start, count)
+
+    def finish(self, start, count, rows):
+        """Inference process: store predictions (None on failure) and wake the waiting worker"""
+        if rows is not None:
+            self.results[start:start + count] = rows
+        with self.changed:
+            if self.state[start] == ABANDONED:
+                self._free(start, count)
+            else:
+                self.state[start:start + count] = DONE if rows is not None else FAILED
+                self.changed.notify_all()
+
+    def _free(self, start, count):
+        self.state[start:start + count] = FREE
+        self.changed.notify_all()
+
+    def info(self):
+        return json.loads(self._info.value or b'{}')
+
+    def publish(self, info):
+        self._info.value = json.dumps(info).encode()
+        self.ready.set()
+
+    def close(self, unlink=False):
+        self.images = self.results = None  # release the views so the mappings can close
+        for memory in (self._images_memory, self._results_memory):
+            memory.close()
+            if unlink:
+                memory.unlink()
+
+
+class RingReservation(Reservation):
+    """Reservation backed by cells of a ring buffer (see MicroBatcher.reserve)"""
+
+    def __init__(self, ring, start, count, timeout):
+        super().__init__(None, ring.images[start:start + count])
+        self.ring = ring
+        self.start = start
+        self.count = count
+        self.timeout = timeout
+        self._held = True
+
+    def predict(self, timeout=None):
+        self.ring.submit(self.start, self.count)
+        self._held = False  # collect() frees the cells, even on error
+        return self.ring.collect(self.start, self.count, timeout or self.timeout)
+
+    def release(self):
+        if self._held:
+            self._held = False
+            self.ring.release(self.start, self.count)
+
+
+class InferencePool:
+    """Ring buffers and the inference processes that serve them"""
+
+    def __init__(self, processes=1, capacity=128, image_size=224, num_classes=3, timeout=60.0):
+        ctx = multiprocessing.get_context('fork')
+        self.timeout = float(timeout)
+        self.rings = [RingBuffer(ctx, capacity, image_size, num_classes) for _ in range(processes)]
+        self._processes = [
+            ctx.Process(target=self._serve, args=(ring,), name=f'inference-{i}', daemon=True)
+            for i, ring in enumerate(self.rings)
+        ]
+
+    def start(self):
+        for process in self._processes:
+            process.start()
+        # Workers forked from the master inherit multiprocessing's record of the
+        # inference processes and would try to join them when they exit
+        os.register_at_fork(after_in_child=lambda: [
+            multiprocessing.process._children.discard(process) for process in self._processes
+        ])
+        print(f"✓ Started {len(self._processes)} inference process(es) "
+              f"(pids {', '.join(str(process.pid) for process in self._processes)}, "
+              f"{self.rings[0].capacity} images per ring buffer)", flush=True)
+
+    def stop(self):
+        """Stop the inference processes and release the shared memory (gunicorn master only)"""
+        for ring, process in zip(self.rings, self._processes):
+            if process.is_alive():
+                ring.requests.put(None)
+        for process in self._processes:
+            process.join(timeout=10)
+            if process.is_alive():
+                process.terminate()
+        for ring in self.rings:
+            ring.close(unlink=True)
+
+    def wait_ready(self, timeout=None):
+        """Block until every inference process has loaded (or failed to load) the model"""
+        infos = []
+        for ring in self.rings:
+            if not ring.ready.wait(timeout):
+                return None
+            infos.append(ring.info())
+        info = dict(infos[0])
+        failed = [i for i in infos if i.get('model_status') != 'loaded']
+        if failed:
+            info['model_status'] = failed[0].get('model_status', 'not_loaded')
+        info['pids'] = [i.get('pid') for i in infos]
+        return info
+
+    def _serve(self, ring):
+        """Inference process main loop"""
+        global is_inference_process
+        is_inference_process = True
+        import app  # loads the model on its loader thread, without the request-side setup
+
+        app.model_ready.wait()
+        ring.publish({
+            'model_status': app.model_status,
+            'model_version': app.MODEL_VERSION,
+            'inference_engine': app.INFERENCE_ENGINE,
+            'head_path': app.head_path,
+            'cascade': app.cascade_info,
+            'cold_start': app.cold_start,
+            'pid': os.getpid()
+        })
+
+        max_batch_size = app.BATCH_MAX_SIZE
+        max_wait = app.BATCH_MAX_WAIT_MS / 1000.0
+        staging = BufferPool(ring.images.shape[1:], max_free=2)
+
+        def next_request(timeout=None):
+            """Next (start, count) request or None (stop); TensorFlow trace commands are started on the way"""
+            while True:
+                item = ring.requests.get(timeout=timeout)
+                if item is None or item[0] != 'trace':
+                    return item
+                threading.Thread(target=profiling.capture_tensorflow_trace, args=item[1:],
+                                 name='tensorflow-trace', daemon=True).start()
+
+        pending = None
+        stopping = False
+        while not stopping:
+            first = pending if pending is not None else next_request()
+            pending = None
+            if first is None:
+                break
+
+            # Gather more requests until the batching window closes
+            batch = [first]
+            total = first[1]
+            deadline = time.monotonic() + max_wait
+            while total < max_batch_size:
+                try:
+                    item = next_request(timeout=max(deadline - time.monotonic(), 0.0001))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                if total + item[1] > max_batch_size:
+                    pending = item  # starts the next batch
+                    break
+                batch.append(item)
+                total += item[1]
+
+            self._run(app, ring, batch, staging)
+
+    @staticmethod
+    def _run(app, ring, batch, staging):
+        """Run queued (start, count) requests as one forward pass"""
+        batch.sort()
+        total = sum(count for _, count in batch)
+        staged = None
+        if all(a[0] + a[1] == b[0] for a, b in zip(batch, batch[1:])):
+            # Neighbouring requests: one view of the shared buffer, no copy
+            first = batch[0][0]
+            images = ring.images[first:first + total]
+        else:
+            images = staged = staging.acquire(total)
+            np.concatenate([ring.images[start:start + count] for start, count in batch], out=staged)
+            ring.copied_batches.value += 1
+        ring.batches.value += 1
+
+        try:
+            if app.model_status != 'loaded':
+                raise RuntimeError('Model not loaded')
+            predictions = np.asarray(app.predict_batch(images))
+            if predictions.shape[1] != ring.num_classes:
+                raise ValueError(f'Model has {predictions.shape[1]} classes, ring buffer holds {ring.num_classes}')
+        except Exception:
+            traceback.print_exc()
+            predictions = None
+        finally:
+            if staged is not None:
+                staging.release(staged)
+
+        offset = 0
+        for start, count in batch:
+            ring.finish(start, count, None if predictions is None else predictions[offset:offset + count])
+            offset += count
+
+
+class InferenceClient:
+    """MicroBatcher-compatible front end to the inference pool, used by HTTP workers"""
+
+    def __init__(self, pool):
+        self.pool = pool
+        self._next = itertools.count()
+
+    def wait_ready(self, timeout=None):
+        return self.pool.wait_ready(timeout)
+
+    def reserve(self, count, image_shape=None):
+        """Reserve count cells of one ring buffer to decode images into"""
+        rings = self.pool.rings
+        first = next(self._next) % len(rings)
+        # Round robin, skipping ring buffers that are full right now
+        for i in range(len(rings)):
+            ring = rings[(first + i) % len(rings)]
+            start = ring.reserve(count, timeout=0)
+            if start is not None:
+                return RingReservation(ring, start, count, self.pool.timeout)
+        ring = rings[first]
+        start = ring.reserve(count, timeout=self.pool.timeout)
+        if start is None:
+            raise TimeoutError('No free space in the inference ring buffers')
+        return RingReservation(ring, start, count, self.pool.timeout)
+
+    def predict(self, image, timeout=None):
+        """Run one (H, W, C) uint8 image and return its prediction row"""
+        return self.predict_batch(image[np.newaxis], timeout=timeout)[0]
+
+    def predict_batch(self, images, timeout=None):
+        """Run an (N, H, W, C) uint8 batch (copied into the ring) and return N prediction rows"""
+        capacity = self.pool.rings[0].capacity
+        rows = []
+        for start in range(0, len(images), capacity):
+            piece = images[start:start + capacity]
+            with self.reserve(len(piece)) as reservation:
+                reservation.images[...] = piece
+                rows.append(reservation.predict(timeout))
+        return np.concatenate(rows)
+
+    def queue_depth(self):
+        """Requests waiting for the inference processes"""
+        return sum(ring.requests.qsize() for ring in self.pool.rings)
+
+    def capture_trace(self, logdir, seconds):
+        """TensorFlow profiler trace of every inference process, into logdir/inference-<n>"""
+        logdirs = [os.path.join(logdir, f'inference-{i}') for i in range(len(self.pool.rings))]
+        for ring, path in zip(self.pool.rings, logdirs):
+            ring.requests.put(('trace', path, seconds))
+        return [
+            profiling.wait_for_capture(path, seconds + 30) or {'error': 'Trace did not finish in time', 'logdir': path}
+            for path in logdirs
+        ]
+
+    def buffer_stats(self):
+        """Ring buffer occupancy and how many forward passes needed a staging copy"""
+        return {
+            'ring_buffers': [{
+                'capacity': ring.capacity,
+                'cells_in_use': int(np.count_nonzero(ring.state != FREE)),
+                'batches': ring.batches.value,
+                'copied_batches': ring.copied_batches.value
+            } for ring in self.pool.rings]
+        }
+
+
+def start(processes=1, capacity=128, image_size=224, num_classes=3, timeout=60.0):
+    """Create the inference pool (call in the gunicorn master, before forking)"""
+    global shared
+    shared = InferencePool(processes=processes, capacity=capacity, image_size=image_size,
+                           num_classes=num_classes, timeout=timeout)
+    shared.start()
+    return shared
+
+
+def stop():
+    if shared is not None:
+        shared.stop()
+
+
+def connect():
+    """InferenceClient for an HTTP worker, or None to load the model in-process"""
+    if shared is None or is_inference_process:
+        return None
+    return InferenceClient(shared)
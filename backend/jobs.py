@@ -0,0 +1,242 @@
+"""
+Asynchronous, checkpointed classification jobs, behind the /jobs API.
+
+A job classifies a whole mapping CSV or a list of image references without
+holding a request open. Everything about it lives in its own directory
+under the jobs directory:
+
+    job.json       source, status and progress; rewritten atomically at every checkpoint
+    items.jsonl    the images to classify, one per line, fixed when the job is submitted
+    results.jsonl  one result per item, in item order
+    results.idx    byte offset of every result line (uint64), so pages are read with one seek
+
+Every worker runs a JobRunner thread. A runner claims a job with an exclusive
+flock on its lock file, so only one worker processes it at a time. If that
+worker dies, the kernel drops the lock, and another runner (or the restarted
+worker) resumes the job from its last checkpoint. Results written after that
+checkpoint are truncated first. A checkpoint is taken after every chunk.
+"""
+import fcntl
+import itertools
+import json
+import os
+import re
+import struct
+import threading
+import time
+import traceback
+import uuid
+from datetime import datetime
+
+JOB_FILE = 'job.json'
+ITEMS_FILE = 'items.jsonl'
+RESULTS_FILE = 'results.jsonl'
+INDEX_FILE = 'results.idx'
+LOCK_FILE = 'lock'
+OFFSET = struct.Struct('<Q')
+JOB_ID = re.compile(r'^[0-9a-f]{32}$')
+
+QUEUED, RUNNING, COMPLETED, FAILED = 'queued', 'running', 'completed', 'failed'
+
+
+def job_progress(job):
+    """The public view of a job: counters plus throughput and ETA"""
+    rate = job['completed'] / job['processing_seconds'] if job['processing_seconds'] else None
+    remaining = job['total'] - job['completed']
+    return {
+        **{key: job[key] for key in ('id', 'status', 'source', 'total', 'completed', 'succeeded', 'failed',
+                                     'resumes', 'created', 'started', 'updated', 'finished')},
+        'progress': round(job['completed'] / job['total'], 4) if job['total'] else 1.0,
+        'images_per_second': round(rate, 2) if rate else None,
+        'eta_seconds': round(remaining / rate, 1) if rate and job['status'] in (QUEUED, RUNNING) else None,
+        **({'error': job['error']} if job.get('error') else {})
+    }
+
+
+class JobStore:
+    """Job directories under root"""
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, job_id, name=''):
+        return os.path.join(self.root, job_id, name)
+
+    def create(self, items, source):
+        """Persist a new queued job over items (dicts with at least 'path') and return it"""
+        job_id = uuid.uuid4().hex
+        os.makedirs(self.path(job_id))
+        with open(self.path(job_id, ITEMS_FILE), 'w', encoding='utf-8') as f:
+            for item in items:
+                f.write(json.dumps(item) + '\n')
+        now = datetime.utcnow().isoformat()
+        job = {
+            'id': job_id,
+            'status': QUEUED,
+            'source': source,
+            'total': len(items),
+            'completed': 0,
+            'succeeded': 0,
+            'failed': 0,
+            'resumes': 0,
+            'processing_seconds': 0.0,
+            'results_bytes': 0,
+            'created': now,
+            'started': None,
+            'updated': now,
+            'finished': None
+        }
+        self.save(job)
+        return job
+
+    def get(self, job_id):
+        """The job's last checkpoint, or None for unknown ids"""
+        if not JOB_ID.match(job_id or ''):
+            return None
+        try:
+            with open(self.path(job_id, JOB_FILE), encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def save(self, job):
+        job['updated'] = datetime.utcnow().isoformat()
+        path = self.path(job['id'], JOB_FILE)
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(job, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+
+    def unfinished(self):
+        """Ids of queued and running jobs, oldest first"""
+        jobs = []
+        for job_id in os.listdir(self.root):
+            job = self.get(job_id)
+            if job is not None and job['status'] in (QUEUED, RUNNING):
+                jobs.append((job['created'], job_id))
+        return [job_id for _, job_id in sorted(jobs)]
+
+    def claim(self, job_id):
+        """Lock the job for this process; returns the open lock file, or None if another process holds it"""
+        lock = open(self.path(job_id, LOCK_FILE), 'a')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock.close()
+            return None
+        return lock
+
+    def items(self, job_id, start=0):
+        """Iterate (index, item) from index start"""
+        with open(self.path(job_id, ITEMS_FILE), encoding='utf-8') as f:
+            for index, line in enumerate(f):
+                if index >= start:
+                    yield index, json.loads(line)
+
+    def results(self, job_id, offset=0, limit=100):
+        """Up to limit checkpointed results starting at offset"""
+        job = self.get(job_id)
+        if job is None:
+            return []
+        end = min(offset + limit, job['completed'])
+        if offset >= end:
+            return []
+        with open(self.path(job_id, INDEX_FILE), 'rb') as f:
+            f.seek(offset * OFFSET.size)
+            start = OFFSET.unpack(f.read(OFFSET.size))[0]
+        with open(self.path(job_id, RESULTS_FILE), 'rb') as f:
+            f.seek(start)
+            return [json.loads(f.readline()) for _ in range(end - offset)]
+
+
+class JobRunner:
+    """Background thread that claims unfinished jobs and runs them chunk by chunk.
+
+    classify_fn(items) returns one result dict per item (classification
+    fields, or 'error').
+    """
+
+    def __init__(self, store, classify_fn, chunk_size=32, poll_interval=2.0):
+        self.store = store
+        self.classify_fn = classify_fn
+        self.chunk_size = chunk_size
+        self.poll_interval = poll_interval
+        self._wake = threading.Event()
+        self._thread = threading.Thread(target=self._loop, name='job-runner', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def wake(self):
+        """Look for work now (e.g. after a submission) instead of at the next poll"""
+        self._wake.set()
+
+    def _loop(self):
+        while True:
+            for job_id in self.store.unfinished():
+                lock = self.store.claim(job_id)
+                if lock is None:
+                    continue  # another worker is running it
+                try:
+                    self.run(job_id)
+                except Exception as e:
+                    traceback.print_exc()
+                    job = self.store.get(job_id)
+                    job.update(status=FAILED, error=str(e), finished=datetime.utcnow().isoformat())
+                    self.store.save(job)
+                finally:
+                    lock.close()
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+
+    def run(self, job_id):
+        """Process a claimed job from its last checkpoint to the end"""
+        store = self.store
+        job = store.get(job_id)
+        if job['status'] not in (QUEUED, RUNNING):
+            return  # finished by another worker since it was listed
+        if job['status'] == RUNNING:
+            job['resumes'] += 1
+            print(f"⚠ Resuming job {job_id} at {job['completed']}/{job['total']}", flush=True)
+        job['status'] = RUNNING
+        job['started'] = job['started'] or datetime.utcnow().isoformat()
+        store.save(job)
+
+        with open(store.path(job_id, RESULTS_FILE), 'ab') as results, \
+                open(store.path(job_id, INDEX_FILE), 'ab') as index:
+            # Drop anything written after the last checkpoint
+            results.truncate(job['results_bytes'])
+            index.truncate(job['completed'] * OFFSET.size)
+            offset = job['results_bytes']
+
+            items = store.items(job_id, job['completed'])
+            while True:
+                chunk = list(itertools.islice(items, self.chunk_size))
+                if not chunk:
+                    break
+                started = time.perf_counter()
+                for (i, item), result in zip(chunk, self.classify_fn([item for _, item in chunk])):
+                    record = {'index': i, **{k: v for k, v in item.items() if k != 'path'}, **result}
+                    line = (json.dumps(record) + '\n').encode('utf-8')
+                    results.write(line)
+                    index.write(OFFSET.pack(offset))
+                    offset += len(line)
+                    job['failed' if 'error' in result else 'succeeded'] += 1
+                results.flush()
+                index.flush()
+                os.fsync(results.fileno())
+                os.fsync(index.fileno())
+
+                # Checkpoint
+                job['completed'] += len(chunk)
+                job['results_bytes'] = offset
+                job['processing_seconds'] += time.perf_counter() - started
+                store.save(job)
+
+        job['status'] = COMPLETED
+        job['finished'] = datetime.utcnow().isoformat()
+        store.save(job)
+        print(f"✓ Job {job_id} completed: {job['succeeded']} classified, {job['failed']} failed", flush=True)
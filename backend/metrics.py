@@ -0,0 +1,205 @@
+"""
+Request, batching and cache metrics, served by /metrics in Prometheus text format.
+
+Every value lives in one flat array of doubles. Under gunicorn, share() is
+called in the master before it forks the inference processes and the HTTP
+workers (see gunicorn.conf.py) and moves that array into shared memory, so
+whichever worker answers a scrape reports totals for the whole server, and
+the forward passes counted in an inference process show up too. That is why
+the metrics and their label values are all declared here, up front.
+Without gunicorn the array is simply process-local.
+"""
+import bisect
+import multiprocessing
+import threading
+import time
+from contextlib import contextmanager
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+
+# Stages of a classification request: request parsing, reading the image bytes
+# (base64 decode, upload read or download), the result cache key, PIL decode,
+# RGB conversion and resize into the input buffer, waiting for the
+# (micro-batched) model, and building the JSON response. ResNet50
+# preprocessing runs inside the model graph, so it is part of 'predict'.
+STAGES = ('parse', 'read', 'hash', 'decode', 'resize', 'predict', 'serialize')
+CLASS_NAMES = ('human', 'avatar', 'animal')  # Order from training data
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in labels) + '}'
+
+
+def format_value(value):
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Registry:
+    """Declared metrics and the array holding their values"""
+
+    def __init__(self):
+        self.metrics = []
+        self._values = []
+        self._lock = threading.Lock()
+
+    def allocate(self, count):
+        """Reserve count values and return the offset of the first"""
+        offset = len(self._values)
+        self._values.extend([0.0] * count)
+        return offset
+
+    def share(self):
+        """Move the values into shared memory; call before forking"""
+        values = multiprocessing.RawArray('d', len(self._values))
+        values[:] = self._values
+        self._values = values
+        self._lock = multiprocessing.Lock()
+
+    def counter(self, name, help, label=None, values=()):
+        metric = Counter(self, name, help, label, values)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS, label=None, values=()):
+        metric = Histogram(self, name, help, buckets, label, values)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self, gauges=()):
+        """Prometheus text exposition of every metric, plus gauges given as (name, help, [(labels, value)])"""
+        with self._lock:
+            values = list(self._values)
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render(values))
+        for name, help, samples in gauges:
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} gauge')
+            for labels, value in samples:
+                lines.append(f'{name}{format_labels(labels)} {format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+class Counter:
+    """Monotonic count, optionally split by one label with fixed values"""
+
+    def __init__(self, registry, name, help, label=None, values=()):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.label = label
+        self._offsets = {value: registry.allocate(1) for value in (values if label else (None,))}
+
+    def inc(self, value=None, amount=1):
+        """Add amount to the series for label value (ignored for values that weren't declared)"""
+        offset = self._offsets.get(value)
+        if offset is None:
+            return
+        with self.registry._lock:
+            self.registry._values[offset] += amount
+
+    def value(self, value=None):
+        """Current count of the series for label value"""
+        with self.registry._lock:
+            return self.registry._values[self._offsets[value]]
+
+    def render(self, values):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        for value, offset in self._offsets.items():
+            labels = [(self.label, value)] if self.label else []
+            lines.append(f'{self.name}{format_labels(labels)} {format_value(values[offset])}')
+        return lines
+
+
+class Histogram:
+    """Bucketed distribution, optionally split by one label with fixed values"""
+
+    def __init__(self, registry, name, help, buckets=LATENCY_BUCKETS, label=None, values=()):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = tuple(sorted(buckets))
+        # Per series: one count per bucket, one for +Inf, then the sum
+        self._offsets = {value: registry.allocate(len(self.buckets) + 2)
+                         for value in (values if label else (None,))}
+
+    def observe(self, amount, value=None):
+        offset = self._offsets.get(value)
+        if offset is None:
+            return
+        bucket = bisect.bisect_left(self.buckets, amount)
+        with self.registry._lock:
+            self.registry._values[offset + bucket] += 1
+            self.registry._values[offset + len(self.buckets) + 1] += amount
+
+    @contextmanager
+    def time(self, value=None):
+        """Observe the seconds spent in the with block"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, value)
+
+    def render(self, values):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        for value, offset in self._offsets.items():
+            labels = [(self.label, value)] if self.label else []
+            count = 0
+            for i, bound in enumerate(self.buckets + (float('inf'),)):
+                count += values[offset + i]
+                le = '+Inf' if i == len(self.buckets) else format_value(bound)
+                lines.append(f'{self.name}_bucket{format_labels(labels + [("le", le)])} {format_value(count)}')
+            lines.append(f'{self.name}_sum{format_labels(labels)} {format_value(values[offset + len(self.buckets) + 1])}')
+            lines.append(f'{self.name}_count{format_labels(labels)} {format_value(count)}')
+        return lines
+
+
+registry = Registry()
+
+STAGE_SECONDS = registry.histogram(
+    'teampics_request_stage_seconds',
+    'Time spent in each stage of a classification: read, hash, decode and resize per image, predict per '
+    'forward pass (one image, or a batch request chunk), parse per request and serialize per response or streamed chunk',
+    label='stage', values=STAGES
+)
+INFERENCE_SECONDS = registry.histogram(
+    'teampics_inference_seconds', 'Duration of one forward pass of the model'
+)
+BATCH_SIZE = registry.histogram(
+    'teampics_batch_size', 'Images per forward pass of the model', buckets=BATCH_SIZE_BUCKETS
+)
+CACHE_LOOKUPS = registry.counter(
+    'teampics_result_cache_lookups_total', 'Result cache lookups by outcome',
+    label='result', values=('hit', 'miss')
+)
+EMBEDDING_LOOKUPS = registry.counter(
+    'teampics_embedding_lookups_total', 'Embedding store lookups by outcome (hits skip decoding and the model)',
+    label='result', values=('hit', 'miss')
+)
+CASCADE_IMAGES = registry.counter(
+    'teampics_cascade_images_total', 'Images answered by each cascade stage (full = escalated to ResNet50)',
+    label='stage', values=('screen', 'full')
+)
+PREDICTIONS = registry.counter(
+    'teampics_predictions_total', 'Classifications returned, by predicted class',
+    label='class', values=CLASS_NAMES
+)
+
+
+def share():
+    registry.share()
+
+
+def observe_stages(timings):
+    """Record a {stage: seconds} dict in STAGE_SECONDS"""
+    for stage, seconds in timings.items():
+        STAGE_SECONDS.observe(seconds, stage)
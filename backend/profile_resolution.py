@@ -0,0 +1,152 @@
+"""
+Profile accuracy against throughput at each input resolution.
+
+ResNet50 ends in global average pooling, so the same weights classify any
+input size that is a multiple of 32, and compute scales roughly with the
+pixel count: 160px costs about half of 224px. What the smaller sizes cost in
+accuracy depends on the photos, so this measures it. For every --sizes entry
+the model is rebuilt for that size (inference.with_input_size), the labelled
+profile photos are decoded at that size, and it reports
+
+    accuracy against imageType in profile_image_mapping.csv, and agreement
+    with the largest size; images/sec of the forward pass at --batch-size and
+    the p50 latency of a batch of one; and the decode time per image.
+
+The recommended size is the smallest whose accuracy is within
+--max-accuracy-drop of the best size (or at least --min-accuracy). Serve it
+with IMAGE_SIZE=<size>, or bake it into an artifact with
+build_artifact.py --image-size <size>.
+
+Usage:
+    python profile_resolution.py --model model/resnet50_profilepic
+    python profile_resolution.py --model model/resnet50_profilepic --sizes 128,160,192,224 \\
+        --mapping /mnt/tenant/profile_image_mapping.csv --image-root /mnt/tenant --output resolution_profile.json
+"""
+import argparse
+import json
+import os
+import time
+from datetime import datetime
+
+import numpy as np
+import tensorflow as tf
+
+from batching import parse_batch_sizes
+from classify_profiles import CLASS_NAMES, DEFAULT_MAPPING
+from export_tflite import latency_ms
+from imaging import load_labeled_images
+from inference import create_inference, input_size, is_artifact, load_artifact, load_keras_model
+
+
+def images_per_second(engine, images, batch_size, min_seconds=2.0):
+    """Forward pass throughput over images at batch_size, repeated for at least min_seconds"""
+    engine(images[:batch_size])  # first call traces the graph
+    count = 0
+    started = time.perf_counter()
+    while True:
+        for start in range(0, len(images), batch_size):
+            engine(images[start:start + batch_size])
+        count += len(images)
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_seconds:
+            return count / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model', required=True, help='Keras model (.h5/.keras) or artifact directory')
+    parser.add_argument('--sizes', default='160,192,224', help='Input resolutions to profile (multiples of 32)')
+    parser.add_argument('--engine', default='graph', choices=('graph', 'xla'))
+    parser.add_argument('--mapping', default=DEFAULT_MAPPING, help='profile_image_mapping.csv (imageType is the label)')
+    parser.add_argument('--image-root', help='Directory imagePath is relative to (default: the CSV directory)')
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--limit', type=int, help='Only the first N labelled images')
+    parser.add_argument('--max-accuracy-drop', type=float, default=0.01,
+                        help='Accuracy the recommended size may lose against the best size')
+    parser.add_argument('--min-accuracy', type=float, help='Recommend the smallest size reaching this accuracy instead')
+    parser.add_argument('--output', help='Write the profile as JSON here')
+    args = parser.parse_args()
+
+    sizes = sorted(parse_batch_sizes(args.sizes))
+    if any(size % 32 for size in sizes):
+        parser.error('--sizes must be multiples of 32')
+    if args.model.endswith('.tflite'):
+        parser.error('TFLite models have a fixed input size; profile the Keras model or artifact instead')
+
+    print(f"TensorFlow: {tf.__version__}")
+    model = load_artifact(args.model)[0] if is_artifact(args.model) else load_keras_model(args.model)
+    built_size = input_size(model)
+    print(f"Model built for {built_size or 'any'}px inputs, profiling {', '.join(f'{s}px' for s in sizes)}")
+
+    results = []
+    reference = None
+    for size in reversed(sizes):  # largest first: it is the agreement reference
+        started = time.perf_counter()
+        images, labels, _ = load_labeled_images(args.mapping, CLASS_NAMES, image_root=args.image_root,
+                                                size=size, limit=args.limit)
+        decode_ms = (time.perf_counter() - started) * 1000 / len(images)
+
+        engine = create_inference(model, args.engine, image_size=size)
+        predicted = np.concatenate([
+            engine(images[start:start + args.batch_size]) for start in range(0, len(images), args.batch_size)
+        ]).argmax(axis=1)
+        if reference is None:
+            reference = predicted
+        result = {
+            'size': size,
+            'relative_pixels': (size / sizes[-1]) ** 2,
+            'accuracy': float(np.mean(predicted == labels)),
+            'agreement_with_largest': float(np.mean(predicted == reference)),
+            'images_per_second': images_per_second(engine, images, args.batch_size),
+            'latency_ms_batch1': latency_ms(engine, images[0]),
+            'decode_ms_per_image': decode_ms
+        }
+        results.insert(0, result)
+        print(f"  {size}px: accuracy {result['accuracy']:.3f}, agreement {result['agreement_with_largest']:.3f}, "
+              f"{result['images_per_second']:.1f} img/s, batch-1 {result['latency_ms_batch1']:.1f}ms")
+
+    best = max(r['accuracy'] for r in results)
+    if args.min_accuracy is not None:
+        meets = [r for r in results if r['accuracy'] >= args.min_accuracy]
+        bar = f'accuracy >= {args.min_accuracy:.3f}'
+    else:
+        meets = [r for r in results if best - r['accuracy'] <= args.max_accuracy_drop]
+        bar = f'within {args.max_accuracy_drop:.3f} of the best accuracy ({best:.3f})'
+    recommended = meets[0] if meets else None
+
+    print(f"\n  {'size':>5}  {'pixels':>6}  {'accuracy':>8}  {'agreement':>9}  {'img/s':>7}  {'batch-1':>8}  {'decode':>7}")
+    for r in results:
+        marker = ' <-' if r is recommended else ''
+        print(f"  {r['size']:>3}px  {r['relative_pixels']:>6.2f}  {r['accuracy']:>8.3f}  "
+              f"{r['agreement_with_largest']:>9.3f}  {r['images_per_second']:>7.1f}  "
+              f"{r['latency_ms_batch1']:>6.1f}ms  {r['decode_ms_per_image']:>5.1f}ms{marker}")
+    print(f"  ({len(labels)} labelled images, batch size {args.batch_size}, engine '{args.engine}')")
+
+    if recommended is None:
+        print(f"\n✗ No size reaches {bar}")
+    else:
+        speedup = recommended['images_per_second'] / results[-1]['images_per_second']
+        print(f"\n✓ {recommended['size']}px is the smallest size {bar}: "
+              f"{speedup:.2f}x the throughput of {results[-1]['size']}px")
+        print(f"  Serve it with IMAGE_SIZE={recommended['size']}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'model': os.path.abspath(args.model),
+                'built_size': built_size,
+                'created': datetime.utcnow().isoformat(),
+                'engine': args.engine,
+                'batch_size': args.batch_size,
+                'evaluation_images': int(len(labels)),
+                'accuracy_bar': bar,
+                'recommended_size': recommended['size'] if recommended else None,
+                'sizes': results
+            }, f, indent=2)
+        print(f"Profile written to {args.output}")
+    if recommended is None:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+"""
+On-demand profiling of a live server, for the /admin/profile endpoint.
+
+Two kinds of capture, each for a bounded number of seconds:
+
+    python      a sampling profile of every thread in this worker (Flask
+                handlers, PIL decode, the batcher). Written in the folded
+                stack format ("frame;frame;frame count" per line) that
+                flamegraph.pl and speedscope read.
+    tensorflow  a TensorFlow profiler trace of op-level time in the model,
+                for TensorBoard's profile plugin. Captured in the process
+                that runs the model: this one, or each inference process
+                with shared inference (see inference_service.py).
+
+Nothing runs between captures: the sampler is a thread that only exists for
+the length of a capture, and the TensorFlow profiler is only started for it.
+Only one capture runs at a time per process.
+"""
+import io
+import json
+import os
+import sys
+import threading
+import time
+import zipfile
+from collections import Counter
+from datetime import datetime
+
+CAPTURE_INFO = 'capture.json'
+
+_capture_lock = threading.Lock()
+
+
+class CaptureBusy(RuntimeError):
+    """Another capture is already running in this process"""
+
+
+def sample_stacks(seconds, interval=0.005):
+    """Sample the stacks of all other threads for seconds; returns (Counter of folded stacks, samples)"""
+    own = threading.get_ident()
+    stacks = Counter()
+    samples = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            frames = []
+            while frame is not None:
+                code = frame.f_code
+                frames.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                frame = frame.f_back
+            frames.append(names.get(ident, f'thread-{ident}'))
+            stacks[';'.join(reversed(frames))] += 1
+        samples += 1
+        time.sleep(interval)
+    return stacks, samples
+
+
+def top_frames(stacks, limit=20):
+    """Innermost frames by share of samples (self time), summed over threads"""
+    counts = Counter()
+    for stack, count in stacks.items():
+        counts[stack.rsplit(';', 1)[-1]] += count
+    total = sum(counts.values()) or 1
+    return [{'frame': frame, 'samples': count, 'fraction': round(count / total, 4)}
+            for frame, count in counts.most_common(limit)]
+
+
+def capture_python_profile(path, seconds, interval=0.005):
+    """Write a folded-stack sampling profile of this process to path and summarise it"""
+    if not _capture_lock.acquire(blocking=False):
+        raise CaptureBusy('A profile capture is already running')
+    try:
+        started = time.perf_counter()
+        stacks, samples = sample_stacks(seconds, interval)
+        elapsed = time.perf_counter() - started
+    finally:
+        _capture_lock.release()
+
+    with open(path, 'w') as f:
+        for stack, count in sorted(stacks.items()):
+            f.write(f'{stack} {count}\n')
+    return {
+        'kind': 'python',
+        'pid': os.getpid(),
+        'seconds': round(elapsed, 3),
+        'samples': samples,
+        'interval_ms': interval * 1000,
+        'top': top_frames(stacks)
+    }
+
+
+def capture_tensorflow_trace(logdir, seconds):
+    """Trace TensorFlow in this process into logdir for seconds and write capture.json there.
+
+    Errors (another trace running, profiler unavailable) are recorded in
+    capture.json rather than raised, so a waiting HTTP worker sees them.
+    """
+    info = {'kind': 'tensorflow', 'pid': os.getpid(), 'started': datetime.utcnow().isoformat()}
+    os.makedirs(logdir, exist_ok=True)
+    if not _capture_lock.acquire(blocking=False):
+        info['error'] = 'A profile capture is already running'
+    else:
+        try:
+            import tensorflow as tf
+            tf.profiler.experimental.start(logdir)
+            try:
+                time.sleep(seconds)
+            finally:
+                tf.profiler.experimental.stop()
+            info['seconds'] = seconds
+            info['files'] = sorted(
+                os.path.relpath(os.path.join(root, name), logdir)
+                for root, _, names in os.walk(logdir) for name in names
+            )
+        except Exception as e:
+            info['error'] = str(e)
+        finally:
+            _capture_lock.release()
+
+    path = os.path.join(logdir, CAPTURE_INFO)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(info, f, indent=1)
+    os.replace(path + '.tmp', path)  # appears complete to wait_for_capture
+    return info
+
+
+def wait_for_capture(logdir, timeout):
+    """capture.json of a trace taken by another process, or None if it doesn't appear in time"""
+    path = os.path.join(logdir, CAPTURE_INFO)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if os.path.exists(path):
+            with open(path) as f:
+                return json.load(f)
+        time.sleep(0.2)
+    return None
+
+
+def zip_directory(path):
+    """An in-memory zip of a trace directory"""
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for root, _, names in os.walk(path):
+            for name in names:
+                full = os.path.join(root, name)
+                archive.write(full, os.path.relpath(full, path))
+    buffer.seek(0)
+    return buffer
@@ -0,0 +1,133 @@
+"""
+Reclassify from stored embeddings with another dense head, without running ResNet50.
+
+The backend keeps the pooled ResNet50 embedding of every image it classifies
+when EMBEDDING_DIR is set (see embeddings.py). A new head - retrained, or
+dense_4/dense_5 from a weights file - only costs two small matrix products
+per image on top of that, so a whole tenant is reclassified in seconds:
+
+    memory-mapped float16 embeddings -> head (numpy) -> CSV/JSONL writer
+
+With --mapping, every profile photo is hashed (not decoded) and matched to
+its stored embedding, and the output has the same columns as
+classify_profiles.py. Photos the backend has never seen are written with an
+error. Without --mapping, every stored embedding is written by image hash.
+
+Usage:
+    python reclassify.py --embeddings /data/embeddings/base-b0fd2c99d6e1861a --head new_head.npz \\
+        --output reclassified.csv
+    python reclassify.py --embeddings /data/embeddings/base-b0fd2c99d6e1861a \\
+        --head model/resnet50_profilepic_classifier_weights.h5 --output reclassified.jsonl \\
+        --mapping /mnt/tenant/profile_image_mapping.csv --image-root /mnt/tenant
+"""
+import argparse
+import itertools
+import os
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from classify_profiles import CLASS_NAMES, DEFAULT_MAPPING, PROFILE_FIELDS, ResultWriter
+from embeddings import META_FILE, DenseHead, EmbeddingStore
+from imaging import image_digest, read_image_path, read_profile_mapping
+
+
+def hash_file(path):
+    return image_digest(read_image_path(path))
+
+
+def predict(head, vectors, rows, batch_size):
+    """Head probabilities for vectors[rows], batch_size rows at a time"""
+    return np.concatenate([
+        head(vectors[rows[start:start + batch_size]])
+        for start in range(0, len(rows), batch_size)
+    ]) if len(rows) else np.empty((0, len(CLASS_NAMES)), dtype=np.float32)
+
+
+def prediction_fields(prediction):
+    index = int(np.argmax(prediction))
+    return {
+        'classification': CLASS_NAMES[index],
+        'confidence': float(prediction[index]),
+        'all_predictions': {name: float(p) for name, p in zip(CLASS_NAMES, prediction)}
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--embeddings', required=True, help='Embedding store of one base model (EMBEDDING_DIR/base-...)')
+    parser.add_argument('--head', required=True, help='Head to apply (.npz, or a weights file with dense_4/dense_5)')
+    parser.add_argument('--output', required=True, help='Results file (.csv, or .jsonl for JSON Lines)')
+    parser.add_argument('--mapping', nargs='?', const=DEFAULT_MAPPING,
+                        help='Write per profile of this profile_image_mapping.csv (default file if no value)')
+    parser.add_argument('--image-root', help='Directory imagePath is relative to (default: the CSV directory)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 4, help='Hashing threads')
+    parser.add_argument('--batch-size', type=int, default=8192, help='Embeddings per head evaluation')
+    parser.add_argument('--limit', type=int, help='Only the first N profiles')
+    args = parser.parse_args()
+
+    if not os.path.exists(os.path.join(args.embeddings, META_FILE)):
+        parser.error(f'{args.embeddings} is not an embedding store (no {META_FILE})')
+    store = EmbeddingStore(args.embeddings)
+    head = DenseHead.load(args.head)
+    digests, vectors = store.all()
+    print(f"✓ {len(digests)} embeddings in {args.embeddings}, head {head.version}")
+
+    started = time.perf_counter()
+    counts = Counter()
+    writer = ResultWriter(args.output, CLASS_NAMES,
+                          fields=PROFILE_FIELDS if args.mapping else ['digest'])
+    try:
+        if not args.mapping:
+            predictions = predict(head, vectors, np.arange(len(digests)), args.batch_size)
+            for digest, prediction in zip(digests, predictions):
+                record = {'digest': digest, **prediction_fields(prediction)}
+                writer.write(record)
+                counts[record['classification']] += 1
+        else:
+            rows = read_profile_mapping(args.mapping, args.image_root)
+            if args.limit:
+                rows = itertools.islice(rows, args.limit)
+            rows = list(rows)
+            with ThreadPoolExecutor(max_workers=args.workers, thread_name_prefix='hash') as pool:
+                futures = [pool.submit(hash_file, row['path']) if row['path'] else None for row in rows]
+
+            stored = {digest: i for i, digest in enumerate(digests)}
+            records = [{field: row.get(field, '') for field in PROFILE_FIELDS} for row in rows]
+            found = []  # (record index, embedding row)
+            for i, future in enumerate(futures):
+                if future is None:
+                    records[i]['classification'] = 'no_pic'
+                    continue
+                try:
+                    digest = future.result()
+                except Exception as e:
+                    records[i]['error'] = f'Error reading image: {e}'
+                    continue
+                if digest in stored:
+                    found.append((i, stored[digest]))
+                else:
+                    records[i]['error'] = 'No stored embedding (not classified by the backend yet)'
+
+            predictions = predict(head, vectors, np.array([row for _, row in found], dtype=np.int64), args.batch_size)
+            for (i, _), prediction in zip(found, predictions):
+                records[i].update(prediction_fields(prediction))
+            for record in records:
+                writer.write(record)
+                counts['error' if 'error' in record else record['classification']] += 1
+    finally:
+        writer.close()
+        store.close()
+
+    elapsed = time.perf_counter() - started
+    print(f"\n✓ {sum(counts.values())} {'profiles' if args.mapping else 'images'} reclassified in {elapsed:.2f}s -> {args.output}")
+    for name, count in counts.most_common():
+        print(f"  {name}: {count}")
+    if counts['error']:
+        print(f"⚠ {counts['error']} profiles could not be reclassified (see the error column)")
+
+
+if __name__ == '__main__':
+    main()
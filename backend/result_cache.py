@@ -0,0 +1,142 @@
+"""
+Content-hash cache for classification results.
+
+Results are keyed by a hash of the image bytes plus the model version, so an
+unchanged profile photo is never decoded or run through the model twice.
+There is a bounded in-memory LRU tier and an optional SQLite tier on disk
+that survives restarts. Concurrent lookups for the same key while it is
+being computed wait for the first caller instead of running inference again.
+"""
+import json
+import sqlite3
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+
+class ResultCache:
+    """Two-tier (memory LRU + optional SQLite file) cache of JSON-serialisable results"""
+
+    def __init__(self, max_entries=10000, disk_path=None):
+        self.max_entries = int(max_entries)
+        self.disk_path = disk_path
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._db = None
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.collapsed = 0
+        self.evictions = 0
+
+        if disk_path:
+            self._db = sqlite3.connect(disk_path, check_same_thread=False)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value TEXT NOT NULL)'
+            )
+            self._db.commit()
+
+    def get(self, key):
+        """Return the cached value for key, or None (counts as a hit or miss)"""
+        with self._lock:
+            value = self._lookup(key)
+            if value is None:
+                self.misses += 1
+            return value
+
+    def put(self, key, value):
+        """Store a value in both tiers"""
+        with self._lock:
+            self._store(key, value)
+
+    def get_or_compute(self, key, compute_fn):
+        """Return (value, cached), computing and storing the value on a miss.
+
+        If another thread is already computing the same key, wait for its
+        result rather than calling compute_fn a second time.
+        """
+        with self._lock:
+            value = self._lookup(key)
+            if value is not None:
+                return value, True
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._inflight[key] = future
+                self.misses += 1
+            else:
+                self.collapsed += 1
+
+        if not owner:
+            return future.result(), True
+
+        try:
+            value = compute_fn()
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+        with self._lock:
+            self._store(key, value)
+        future.set_result(value)
+        return value, False
+
+    def stats(self):
+        """Counters for monitoring"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'disk_enabled': self._db is not None,
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'collapsed': self.collapsed,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0
+            }
+
+    def _lookup(self, key):
+        """Memory tier first, then disk (promoting disk hits). Caller holds the lock."""
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key]
+
+        if self._db is not None:
+            row = self._db.execute('SELECT value FROM results WHERE key = ?', (key,)).fetchone()
+            if row is not None:
+                value = json.loads(row[0])
+                self._remember(key, value)
+                self.hits += 1
+                self.disk_hits += 1
+                return value
+
+        return None
+
+    def _store(self, key, value):
+        """Caller holds the lock"""
+        self._remember(key, value)
+        if self._db is not None:
+            self._db.execute(
+                'INSERT OR REPLACE INTO results (key, value) VALUES (?, ?)',
+                (key, json.dumps(value))
+            )
+            self._db.commit()
+
+    def _remember(self, key, value):
+        """Insert into the LRU tier, evicting the least recently used entries"""
+        if self.max_entries <= 0:
+            return
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
@@ -0,0 +1,335 @@
+"""
+Retrain only the classifier's dense head from user corrections, on CPU.
+
+The ResNet50 base stays frozen, so the head only needs the pooled embeddings
+the backend already keeps with EMBEDDING_DIR (see embeddings.py). Training
+2048 -> 256 -> 3 in numpy on those takes seconds to minutes, instead of a
+full Colab retrain and a hand-copied .h5 (ACCURACY_FIX_PLAN.md), so the
+correction loop can run nightly:
+
+    profile_image_mapping.csv labels (imageType)
+      + corrections.json from the frontend (they override the mapping label)
+      -> image hashes -> stored embeddings -> train head -> heads/<version>.npz
+
+Photos without a stored embedding are embedded with --model and added to
+the store, or skipped without it. A fixed share of the images, chosen by
+image hash, is held out. The new head is compared on it with the starting
+head (--init-head, else the head of --model). The head, and a report next
+to it, are written to the store's heads/ directory, named by the head's
+weights hash. The backend serves the new head with HEAD_PATH=<that .npz>.
+
+Usage:
+    python retrain_head.py --embeddings /data/embeddings/base-b0fd2c99d6e1861a \\
+        --corrections ../corrections/corrections.json --init-head /data/embeddings/base-b0fd2c99d6e1861a/heads/head-34df444a67614568.npz
+    python retrain_head.py --embeddings /data/embeddings/base-b0fd2c99d6e1861a --model model/resnet50_profilepic \\
+        --mapping /mnt/tenant/profile_image_mapping.csv --image-root /mnt/tenant --max-accuracy-drop 0.01
+"""
+import argparse
+import json
+import os
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import numpy as np
+
+from classify_profiles import CLASS_NAMES, DEFAULT_MAPPING
+from embeddings import EMBEDDING_DIM, HEADS_DIR, META_FILE, DenseHead, EmbeddingStore, base_version
+from imaging import decode_image, image_digest, read_image_path, read_profile_mapping
+
+# The frontend shows the 'animal' class as 'other'
+LABEL_ALIASES = {'other': 'animal'}
+
+
+def load_base(model_path, image_size=None):
+    """(inference engine producing pooled embeddings, the model's own head, base version) for a model.
+
+    image_size is the backend's IMAGE_SIZE; the base runs at it and the
+    version matches the store the backend writes at that size.
+    """
+    from inference import create_inference, input_size, is_artifact, load_artifact, load_keras_model, split_head
+
+    model = load_artifact(model_path)[0] if is_artifact(model_path) else load_keras_model(model_path)
+    base, head = split_head(model)
+    version = base_version(base.get_weights(), input_size(base), image_size)
+    return create_inference(base, image_size=image_size), head, version
+
+
+def read_corrections(path):
+    """{userId: class name} from the frontend's corrections.json ('no_pic' corrections drop the photo)"""
+    with open(path, encoding='utf-8') as f:
+        corrections = json.load(f)
+    labels = {}
+    for user_id, correction in corrections.items():
+        label = correction.get('correctedClassification')
+        labels[user_id] = LABEL_ALIASES.get(label, label)
+    return labels
+
+
+def training_samples(mapping, image_root, corrections, workers):
+    """[(path, class index, corrected, image hash)] of every labelled photo, plus counts of what was left out"""
+    samples = []
+    skipped = Counter()
+    for row in read_profile_mapping(mapping, image_root):
+        label = row.get('imageType')
+        corrected = row.get('userId') in corrections
+        if corrected:
+            label = corrections[row['userId']]
+        if row['path'] is None or not os.path.exists(row['path']):
+            skipped['no photo'] += 1
+        elif label not in CLASS_NAMES:
+            skipped[f'label {label}'] += 1
+        else:
+            samples.append((row['path'], CLASS_NAMES.index(label), corrected))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='hash') as pool:
+        digests = list(pool.map(lambda sample: image_digest(read_image_path(sample[0])), samples))
+    return [sample + (digest,) for sample, digest in zip(samples, digests)], skipped
+
+
+def embed_missing(store, engine, samples, batch_size=32):
+    """Run the base over photos without a stored embedding and add them to the store"""
+    missing = {}
+    for path, _, _, digest in samples:
+        if store.get(digest) is None:
+            missing.setdefault(digest, path)
+    items = list(missing.items())
+    for start in range(0, len(items), batch_size):
+        chunk = items[start:start + batch_size]
+        images = np.empty((len(chunk), engine.image_size, engine.image_size, 3), dtype=np.uint8)
+        for (_, path), image in zip(chunk, images):
+            decode_image(read_image_path(path), size=engine.image_size, out=image)
+        store.put_many([digest for digest, _ in chunk], engine(images))
+    return len(items)
+
+
+def forward(layers, x, rng=None, dropout=0.0):
+    """Activations of every layer (input first); dropout before each Dense when rng is given"""
+    activations = [x]
+    masks = []
+    for kernel, bias, activation in layers:
+        if rng is not None and dropout:
+            mask = (rng.random(x.shape) >= dropout) / (1.0 - dropout)
+            x = x * mask
+            activations[-1] = x
+        else:
+            mask = None
+        masks.append(mask)
+        z = x @ kernel + bias
+        if activation == 'relu':
+            x = np.maximum(z, 0)
+        elif activation == 'softmax':
+            e = np.exp(z - z.max(axis=1, keepdims=True))
+            x = e / e.sum(axis=1, keepdims=True)
+        else:
+            x = z
+        activations.append(x)
+    return activations, masks
+
+
+def loss_and_accuracy(layers, x, y, weights=None):
+    probabilities = forward(layers, x)[0][-1]
+    weights = np.ones(len(y)) if weights is None else weights
+    loss = -np.sum(weights * np.log(probabilities[np.arange(len(y)), y] + 1e-12)) / weights.sum()
+    return float(loss), float(np.mean(probabilities.argmax(axis=1) == y))
+
+
+def train_head(head, x, y, weights, x_val, y_val, epochs=40, batch_size=64, learning_rate=3e-4,
+               weight_decay=1e-4, dropout=0.25, patience=6, seed=0):
+    """Fine-tune a DenseHead (softmax output) with Adam on weighted cross-entropy.
+
+    Keeps the weights of the epoch with the lowest validation loss (training
+    loss without a validation set) and stops after patience epochs without
+    improvement. The starting head's loss is the bar to beat: if no epoch
+    improves on it, the starting head itself is returned. Returns
+    (DenseHead, history).
+    """
+    if head.layers[-1][2] != 'softmax':
+        raise ValueError('The head must end in a softmax layer')
+    rng = np.random.default_rng(seed)
+    layers = [[kernel.copy(), bias.copy(), activation] for kernel, bias, activation in head.layers]
+    moments = [[np.zeros_like(p) for p in layer[:2]] + [np.zeros_like(p) for p in layer[:2]] for layer in layers]
+    beta1, beta2, step = 0.9, 0.999, 0
+    start_loss = loss_and_accuracy(layers, x_val, y_val)[0] if len(y_val) else loss_and_accuracy(layers, x, y, weights)[0]
+    best, best_loss, stale, history = None, start_loss, 0, []
+
+    for epoch in range(epochs):
+        order = rng.permutation(len(y))
+        for start in range(0, len(order), batch_size):
+            batch = order[start:start + batch_size]
+            activations, masks = forward(layers, x[batch], rng, dropout)
+            w = weights[batch] / weights[batch].sum()
+            # Softmax + cross-entropy gradient, then back through the layers
+            delta = activations[-1].copy()
+            delta[np.arange(len(batch)), y[batch]] -= 1
+            delta *= w[:, None]
+            step += 1
+            for i in reversed(range(len(layers))):
+                kernel, bias, _ = layers[i]
+                grads = [activations[i].T @ delta + weight_decay * kernel, delta.sum(axis=0)]
+                if i:
+                    delta = delta @ kernel.T
+                    if masks[i] is not None:
+                        delta *= masks[i]
+                    if layers[i - 1][2] == 'relu':
+                        delta *= activations[i] > 0
+                for j, grad in enumerate(grads):
+                    m, v = moments[i][j], moments[i][j + 2]
+                    m[:] = beta1 * m + (1 - beta1) * grad
+                    v[:] = beta2 * v + (1 - beta2) * grad * grad
+                    m_hat = m / (1 - beta1 ** step)
+                    v_hat = v / (1 - beta2 ** step)
+                    layers[i][j] -= learning_rate * m_hat / (np.sqrt(v_hat) + 1e-8)
+
+        train_loss, train_accuracy = loss_and_accuracy(layers, x, y, weights)
+        val_loss, val_accuracy = loss_and_accuracy(layers, x_val, y_val) if len(y_val) else (train_loss, train_accuracy)
+        history.append({'epoch': epoch + 1, 'train_loss': round(train_loss, 4), 'train_accuracy': round(train_accuracy, 4),
+                        'val_loss': round(val_loss, 4), 'val_accuracy': round(val_accuracy, 4)})
+        print(f"  epoch {epoch + 1}: loss {train_loss:.4f}, val loss {val_loss:.4f}, val accuracy {val_accuracy:.1%}", flush=True)
+        if val_loss < best_loss - 1e-4:
+            best, best_loss, stale = [(k.copy(), b.copy(), a) for k, b, a in layers], val_loss, 0
+        else:
+            stale += 1
+            if stale >= patience:
+                break
+    if best is None:
+        print(f"⚠ No epoch improved on the starting head's loss ({start_loss:.4f}); keeping the starting head",
+              flush=True)
+        return head, history
+    return DenseHead(best), history
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--embeddings', required=True, help='Embedding store of the served base model (EMBEDDING_DIR/base-...)')
+    parser.add_argument('--mapping', default=DEFAULT_MAPPING, help='profile_image_mapping.csv (imageType is the label)')
+    parser.add_argument('--image-root', help='Directory imagePath is relative to (default: the CSV directory)')
+    parser.add_argument('--corrections', help="The frontend's corrections.json (CORRECTIONS_FILE)")
+    parser.add_argument('--init-head', help='Head to fine-tune and compare against (default: the head of --model)')
+    parser.add_argument('--model', help='Served model: embeds photos missing from the store, and its head is the default start')
+    parser.add_argument('--image-size', type=int, default=224,
+                        help="The backend's IMAGE_SIZE: --model embeds photos at it (default: 224)")
+    parser.add_argument('--output-dir', help="Where to write the head (default: the store's heads/)")
+    parser.add_argument('--epochs', type=int, default=40)
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--learning-rate', type=float, default=3e-4)
+    parser.add_argument('--correction-weight', type=float, default=3.0, help='Loss weight of corrected photos')
+    parser.add_argument('--val-fraction', type=float, default=0.2, help='Share of photos held out (by image hash)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 4, help='Hashing threads')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--max-accuracy-drop', type=float,
+                        help='Exit with an error if held-out accuracy falls more than this below the starting head')
+    args = parser.parse_args()
+
+    if not os.path.exists(os.path.join(args.embeddings, META_FILE)):
+        parser.error(f'{args.embeddings} is not an embedding store (no {META_FILE})')
+    started = time.perf_counter()
+    store = EmbeddingStore(args.embeddings)
+    corrections = read_corrections(args.corrections) if args.corrections else {}
+    samples, skipped = training_samples(args.mapping, args.image_root, corrections, args.workers)
+    print(f"✓ {len(samples)} labelled photos ({sum(1 for s in samples if s[2])} corrected), "
+          f"{len(corrections)} corrections in total")
+    for reason, count in skipped.items():
+        print(f"  skipped ({reason}): {count}")
+
+    init_head = DenseHead.load(args.init_head) if args.init_head else None
+    if args.model:
+        print(f"Loading model from {args.model}...")
+        engine, model_head, model_base = load_base(args.model, args.image_size)
+        if model_base != os.path.basename(os.path.normpath(args.embeddings)):
+            parser.error(f'{args.model} has base {model_base}; its embeddings are not in {args.embeddings} '
+                         f'(pass the IMAGE_SIZE the backend serves with as --image-size)')
+        init_head = init_head or model_head
+        print(f"✓ Embedded {embed_missing(store, engine, samples)} photos missing from the store")
+    if init_head is None:
+        parser.error('--init-head or --model is needed to start from a head')
+    if init_head.input_dim != EMBEDDING_DIM:
+        parser.error(f'{init_head.version} takes {init_head.input_dim} inputs, the store holds {EMBEDDING_DIM}-d embeddings')
+
+    # Stored embeddings; photos the backend has never classified are left out
+    vectors, labels, corrected, held_out = [], [], [], []
+    missing = 0
+    for _, label, is_corrected, digest in samples:
+        vector = store.get(digest)
+        if vector is None:
+            missing += 1
+            continue
+        vectors.append(vector)
+        labels.append(label)
+        corrected.append(is_corrected)
+        held_out.append(int(digest[:8], 16) % 1000 < args.val_fraction * 1000)
+    if missing:
+        print(f"⚠ {missing} photos have no stored embedding and are left out (pass --model to embed them)")
+    if not vectors:
+        parser.error('No labelled photo has a stored embedding')
+    x = np.stack(vectors)
+    y = np.array(labels)
+    corrected = np.array(corrected)
+    held_out = np.array(held_out)
+
+    # Balance the classes, and weigh corrections (the model's mistakes) more
+    train = ~held_out
+    counts = np.bincount(y[train], minlength=len(CLASS_NAMES))
+    weights = len(y[train]) / (len(CLASS_NAMES) * np.maximum(counts, 1))
+    sample_weights = weights[y] * np.where(corrected, args.correction_weight, 1.0)
+
+    print(f"\nTraining on {train.sum()} photos, {held_out.sum()} held out "
+          f"({', '.join(f'{name} {count}' for name, count in zip(CLASS_NAMES, counts))})...")
+    head, history = train_head(init_head, x[train], y[train], sample_weights[train], x[held_out], y[held_out],
+                               epochs=args.epochs, batch_size=args.batch_size,
+                               learning_rate=args.learning_rate, seed=args.seed)
+
+    if head is init_head:
+        store.close()
+        print(f"\n✗ Retraining did not beat {init_head.version}; no head written, keep serving it")
+        raise SystemExit(1)
+
+    def evaluate(candidate, mask):
+        if not mask.any():
+            return None
+        return float(np.mean(candidate(x[mask]).argmax(axis=1) == y[mask]))
+
+    report = {
+        'head_version': head.version,
+        'parent_head': init_head.version,
+        'base_version': os.path.basename(os.path.normpath(args.embeddings)),
+        'created': datetime.utcnow().isoformat(),
+        'class_names': CLASS_NAMES,
+        'mapping': os.path.abspath(args.mapping),
+        'corrections': os.path.abspath(args.corrections) if args.corrections else None,
+        'train_photos': int(train.sum()),
+        'held_out_photos': int(held_out.sum()),
+        'corrected_photos': int(corrected.sum()),
+        'corrected_held_out_photos': int((corrected & held_out).sum()),
+        'accuracy': {
+            # Both measured on held-out photos only: corrected ones are mostly trained on
+            'held_out': {'before': evaluate(init_head, held_out), 'after': evaluate(head, held_out)},
+            'corrected_held_out': {'before': evaluate(init_head, corrected & held_out),
+                                   'after': evaluate(head, corrected & held_out)}
+        },
+        'history': history,
+        'seconds': round(time.perf_counter() - started, 2)
+    }
+
+    output_dir = args.output_dir or os.path.join(args.embeddings, HEADS_DIR)
+    os.makedirs(output_dir, exist_ok=True)
+    path = os.path.join(output_dir, f'{head.version}.npz')
+    head.save(path)
+    with open(os.path.join(output_dir, f'{head.version}.json'), 'w') as f:
+        json.dump(report, f, indent=2)
+    store.close()
+
+    print(f"\n✓ Head {head.version} (from {init_head.version}) written to {path} in {report['seconds']:.1f}s")
+    for subset, accuracy in report['accuracy'].items():
+        if accuracy['before'] is not None:
+            print(f"  {subset.replace('_', ' ')} accuracy: {accuracy['before']:.1%} -> {accuracy['after']:.1%}")
+    print(f"  Serve it with HEAD_PATH={path}")
+
+    before, after = report['accuracy']['held_out']['before'], report['accuracy']['held_out']['after']
+    if args.max_accuracy_drop is not None and before is not None and after < before - args.max_accuracy_drop:
+        print(f"✗ Held-out accuracy dropped by {before - after:.1%}, more than {args.max_accuracy_drop:.1%}")
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
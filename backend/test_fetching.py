@@ -0,0 +1,143 @@
+"""
+Check fetching.ImageFetcher against a local HTTP stand-in for blob storage.
+
+Serves profile_images/images under /profile-images/ on 127.0.0.1 and checks
+that every image comes back byte for byte with concurrent downloads capped
+by the per-host limit, and that missing blobs, disallowed hosts, '..' paths
+and oversized images are refused with the right status.
+
+Concurrency is counted on the client: connections checked out of urllib3's
+pools and not yet returned. The server cannot count it reliably, because a
+handler thread finishes after its response has already been read, so it
+overlaps the fetcher's next request on the freed connection.
+
+Usage:
+    python test_fetching.py
+    python test_fetching.py --model model/resnet50_profilepic   # also classify by URL through app.py
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+from urllib3.connectionpool import HTTPConnectionPool
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+IMAGES_DIR = os.path.join(REPO_ROOT, 'profile_images', 'images')
+MAX_PER_HOST = 4
+
+in_flight = 0
+peak_in_flight = 0
+lock = threading.Lock()
+
+
+def count_checked_out_connections():
+    """Track how many pooled connections are checked out at once (peak_in_flight)"""
+    get_conn, put_conn = HTTPConnectionPool._get_conn, HTTPConnectionPool._put_conn
+
+    def counted_get(self, timeout=None):
+        global in_flight, peak_in_flight
+        conn = get_conn(self, timeout=timeout)
+        with lock:
+            in_flight += 1
+            peak_in_flight = max(peak_in_flight, in_flight)
+        return conn
+
+    def counted_put(self, conn):
+        global in_flight
+        with lock:
+            in_flight -= 1
+        put_conn(self, conn)
+
+    HTTPConnectionPool._get_conn = counted_get
+    HTTPConnectionPool._put_conn = counted_put
+
+
+class BlobStandIn(SimpleHTTPRequestHandler):
+    """Serves IMAGES_DIR at /profile-images/, slowly enough for downloads to overlap"""
+
+    def do_GET(self):
+        if not self.path.startswith('/profile-images/'):
+            self.send_error(404)
+            return
+        self.path = self.path[len('/profile-images'):]
+        time.sleep(0.02)
+        super().do_GET()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def check(name, ok):
+    print(f"{'✓' if ok else '✗'} {name}")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model', help='Also classify by URL through app.py with this MODEL_PATH')
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), partial(BlobStandIn, directory=IMAGES_DIR))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f'http://127.0.0.1:{server.server_port}/profile-images'
+    print(f"Blob storage stand-in at {base_url}")
+
+    from fetching import FetchError, ImageFetcher
+    from imaging import ImageRejected
+
+    count_checked_out_connections()
+
+    fetcher = ImageFetcher(base_url=base_url, max_per_host=MAX_PER_HOST, workers=16, max_bytes=2 * 1024 * 1024)
+    names = sorted(os.listdir(IMAGES_DIR))
+    start = time.perf_counter()
+    futures = [fetcher.pool.submit(fetcher.fetch, name) for name in names]
+    payloads = [b''.join(future.result()) for future in futures]
+    elapsed = time.perf_counter() - start
+
+    ok = True
+    ok &= check(f"{len(names)} images fetched in {elapsed:.2f}s, identical to the files",
+                all(payload == open(os.path.join(IMAGES_DIR, name), 'rb').read()
+                    for name, payload in zip(names, payloads)))
+    ok &= check(f"at most {MAX_PER_HOST} downloads in flight (peak {peak_in_flight}) with 16 fetch threads",
+                peak_in_flight <= MAX_PER_HOST)
+    ok &= check("absolute URLs on the storage host are fetched",
+                b''.join(fetcher.fetch(f'{base_url}/{names[0]}')) == payloads[0])
+
+    def status_of(reference, fetcher=fetcher):
+        try:
+            fetcher.fetch(reference)
+        except (FetchError, ImageRejected) as e:
+            return e.status
+        return 200
+
+    ok &= check("missing blob -> 404", status_of('does_not_exist.jpg') == 404)
+    ok &= check("other hosts -> 400", status_of('http://169.254.169.254/latest/meta-data') == 400)
+    ok &= check("'..' paths -> 400", status_of('../mappings/profile_image_mapping.csv') == 400)
+    small = ImageFetcher(base_url=base_url, max_bytes=1000)
+    ok &= check("images over max_bytes -> 413", status_of(names[0], small) == 413)
+    ok &= check("fetching still works after a refused download", status_of(names[0]) == 200)
+
+    if args.model:
+        os.environ.update(MODEL_PATH=args.model, IMAGE_BASE_URL=base_url, WARMUP_BATCH_SIZES='1', JOBS_DIR='')
+        import app
+        app.model_ready.wait()
+        client = app.app.test_client()
+        single = client.post('/classify', json={'url': names[0]})
+        ok &= check(f"/classify by storage path -> {single.status_code} {single.get_json().get('classification')}",
+                    single.status_code == 200)
+        batch = client.post('/classify/batch', json={'urls': [f'{base_url}/{name}' for name in names[:20]] + ['nope.jpg']})
+        data = batch.get_json()
+        ok &= check(f"/classify/batch by URL -> {data['succeeded']} succeeded, {data['failed']} failed",
+                    data['succeeded'] == 20 and data['failed'] == 1)
+
+    server.shutdown()
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
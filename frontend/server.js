@@ -1,4 +1,5 @@
 const express = require('express');
+const fs = require('fs');
 const path = require('path');
 const fetch = require('node-fetch');
 
@@ -17,6 +18,11 @@ const MAPPING_CSV_URL = `${STORAGE_BASE_URL}/mappings/profile_image_mapping.csv`
 const TENANT_ID = process.env.TENANT_ID;
 const CLIENT_ID = process.env.CLIENT_ID;
 const CLIENT_SECRET = process.env.CLIENT_SECRET;
+// Number of profile photos sent to the backend's /classify/batch per request
+const CLASSIFY_BATCH_SIZE = parseInt(process.env.CLASSIFY_BATCH_SIZE || '32');
+// Corrections are kept in this JSON file so they survive restarts and can be
+// used to retrain the classifier's head (backend/retrain_head.py)
+const CORRECTIONS_FILE = process.env.CORRECTIONS_FILE || path.join(__dirname, 'data', 'corrections.json');
 
 // Cache for access token
 let cachedToken = null;
@@ -203,14 +209,33 @@ app.get('/api/users/profiles', async (req, res) => {
     }
 });
 
-// In-memory storage for corrections
-let corrections = {};
+// Corrections by user id, loaded from and saved to CORRECTIONS_FILE
+let corrections = loadCorrections();
+
+function loadCorrections() {
+    try {
+        if (fs.existsSync(CORRECTIONS_FILE)) {
+            const saved = JSON.parse(fs.readFileSync(CORRECTIONS_FILE, 'utf8'));
+            console.log(`Loaded ${Object.keys(saved).length} corrections from ${CORRECTIONS_FILE}`);
+            return saved;
+        }
+    } catch (error) {
+        console.error(`Error loading corrections from ${CORRECTIONS_FILE}:`, error.message);
+    }
+    return {};
+}
+
+function saveCorrections() {
+    // Write a temporary file and rename it, so a crash never leaves a truncated file
+    fs.mkdirSync(path.dirname(CORRECTIONS_FILE), { recursive: true });
+    const tmpFile = `${CORRECTIONS_FILE}.tmp`;
+    fs.writeFileSync(tmpFile, JSON.stringify(corrections, null, 2));
+    fs.renameSync(tmpFile, CORRECTIONS_FILE);
+}
 
 // Get weekly analytics data
 app.get('/api/analytics/weekly', async (req, res) => {
     try {
-        const fs = require('fs');
-        const path = require('path');
         const csvPath = path.join(__dirname, 'data', 'weekly_analytics.csv');
         
         if (!fs.existsSync(csvPath)) {
@@ -294,53 +319,45 @@ app.post('/api/classify/all-profiles', async (req, res) => {
         const usersWithPhotos = users.filter(u => u.hasPhoto);
         console.log(`Classifying ${usersWithPhotos.length} profiles with photos...`);
         
-        for (const user of usersWithPhotos) {
+        for (let start = 0; start < usersWithPhotos.length; start += CLASSIFY_BATCH_SIZE) {
+            const group = usersWithPhotos.slice(start, start + CLASSIFY_BATCH_SIZE);
+            console.log(`[CLASSIFY] Processing profiles ${start + 1}-${start + group.length} of ${usersWithPhotos.length}`);
+            
             try {
-                console.log(`[CLASSIFY] Processing ${user.displayName}`);
-                console.log(`[CLASSIFY] Image URL: ${user.photo}`);
-                
-                // Fetch the image directly from Azure Storage
-                const imageResponse = await fetch(user.photo);
-                if (!imageResponse.ok) {
-                    console.error(`[CLASSIFY] Failed to fetch image for ${user.displayName}: ${imageResponse.status}`);
-                    user.classification = 'error';
-                    user.confidence = 0;
-                    continue;
-                }
-                
-                // Convert to base64
-                const buffer = await imageResponse.buffer();
-                const base64 = buffer.toString('base64');
-                const contentType = imageResponse.headers.get('content-type') || 'image/jpeg';
-                const dataUrl = `data:${contentType};base64,${base64}`;
-                
-                console.log(`[CLASSIFY] Got image (${buffer.length} bytes), calling backend for ${user.displayName}`);
-                
-                // Call backend to classify with base64 image
-                const classifyResponse = await fetch(`${BACKEND_URL}/classify`, {
+                // Classify the whole group with one backend call; the backend
+                // downloads the images from Azure Storage itself
+                const classifyResponse = await fetch(`${BACKEND_URL}/classify/batch`, {
                     method: 'POST',
                     headers: { 'Content-Type': 'application/json' },
-                    body: JSON.stringify({ image: dataUrl })
+                    body: JSON.stringify({ urls: group.map(user => user.photo) })
                 });
                 
                 console.log(`[CLASSIFY] Backend response status: ${classifyResponse.status} ${classifyResponse.statusText}`);
                 
-                if (classifyResponse.ok) {
-                    const result = await classifyResponse.json();
-                    console.log(`[CLASSIFY] Result for ${user.displayName}: ${result.classification} (${result.confidence})`);
+                if (!classifyResponse.ok) {
+                    const errorText = await classifyResponse.text();
+                    throw new Error(`${classifyResponse.status} - ${errorText}`);
+                }
+                
+                const { results } = await classifyResponse.json();
+                group.forEach((user, i) => {
+                    const result = results[i];
+                    if (result.error) {
+                        console.error(`[CLASSIFY] Backend error for ${user.displayName}: ${result.error}`);
+                        user.classification = 'error';
+                        user.confidence = 0;
+                        return;
+                    }
                     // Map 'animal' to 'other' for frontend compatibility
                     user.classification = result.classification === 'animal' ? 'other' : result.classification;
                     user.confidence = result.confidence;
-                } else {
-                    const errorText = await classifyResponse.text();
-                    console.error(`[CLASSIFY] Backend error for ${user.displayName}: ${classifyResponse.status} - ${errorText}`);
+                });
+            } catch (error) {
+                console.error('[CLASSIFY] Error classifying profile batch:', error.message);
+                group.forEach(user => {
                     user.classification = 'error';
                     user.confidence = 0;
-                }
-            } catch (error) {
-                console.error(`[CLASSIFY] Error classifying ${user.displayName}:`, error.message);
-                user.classification = 'error';
-                user.confidence = 0;
+                });
             }
         }
         
@@ -374,6 +391,7 @@ app.post('/api/corrections', async (req, res) => {
             correctedClassification,
             timestamp: new Date().toISOString()
         };
+        saveCorrections();
         
         console.log(`Saved correction for user ${userId}: ${originalClassification} -> ${correctedClassification}`);
         